@@ -1,9 +1,13 @@
+import concurrent.futures
+import glob
 import pathlib
 
 from ckan import logic
-from dcor_shared import get_ckan_config_option, s3, sha256sum
 
-from .util import make_id
+from .checksum_cache import get_checksum_cache
+from . import metrics
+from . import s3_util
+from .util import get_s3_bucket_name, get_s3_object_name, make_id
 
 
 def admin_context():
@@ -22,70 +26,156 @@ def append_ckan_resource_to_active_dataset(dataset_id, res_dict):
     If the ID specified already exists in the dataset, then nothing
     is changed or updated.
     """
-    for key in ["name", "id"]:
-        if key not in res_dict:
-            raise ValueError(f"You must provide '{key}' in `res_dict`")
+    append_ckan_resources_to_active_dataset(dataset_id, [res_dict])
 
-    package_show = logic.get_action("package_show")
-    ds_dict = package_show(context=admin_context(),
-                           data_dict={"id": dataset_id})
 
-    # Make sure the resource is in the CKAN database
-    for res_other in ds_dict["resources"]:
-        if res_dict["id"] == res_other["id"]:
+def append_ckan_resources_to_active_dataset(dataset_id, res_dicts):
+    """Admin-only method to add multiple resource entries to a dataset
+
+    Same as :func:`append_ckan_resource_to_active_dataset`, but all
+    resources in `res_dicts` are appended with one `package_revise` call.
+    """
+    for res_dict in res_dicts:
+        for key in ["name", "id"]:
+            if key not in res_dict:
+                raise ValueError(f"You must provide '{key}' in `res_dict`")
+
+    package_show = logic.get_action("package_show")
+    with metrics.timer("ckan_show"):
+        ds_dict = package_show(context=admin_context(),
+                               data_dict={"id": dataset_id})
+
+    # Make sure the resources are in the CKAN database
+    existing = [res_other["id"] for res_other in ds_dict["resources"]]
+    new_res_dicts = []
+    for res_dict in res_dicts:
+        if res_dict["id"] in existing:
             print(f"Resource {res_dict['name']} already in CKAN database")
-            break
-    else:
-        print(f"Adding resource {res_dict['name']} to CKAN database")
+        else:
+            print(f"Adding resource {res_dict['name']} to CKAN database")
+            new_res_dicts.append(res_dict)
+            existing.append(res_dict["id"])
+
+    if new_res_dicts:
         package_revise = logic.get_action("package_revise")
-        package_revise(
-            context=admin_context(),
-            data_dict={"match__id": dataset_id,
-                       "update__resources__extend": [res_dict]
-                       }
-        )
+        with metrics.timer("ckan_revise"):
+            package_revise(
+                context=admin_context(),
+                data_dict={"match__id": dataset_id,
+                           "update__resources__extend": new_res_dicts
+                           }
+            )
 
 
 def append_resource(path: pathlib.Path | str,
                     dataset_id: str,
                     delete_source: bool = False):
     """Upload a resource to S3 and append to an existing dataset"""
-    path = pathlib.Path(path)
+    append_resources(paths=[path],
+                     dataset_id=dataset_id,
+                     delete_source=delete_source)
+
+
+def append_resources(paths: list[pathlib.Path | str],
+                     dataset_id: str,
+                     delete_source: bool = False,
+                     num_jobs: int = 4):
+    """Upload multiple resources to S3 and append them to a dataset
+
+    The entries in `paths` may also be directories (all files in
+    the directory are appended) or glob patterns (see
+    :func:`expand_paths`). Up to `num_jobs` files are hashed and
+    uploaded concurrently. All resources are added to the dataset
+    with a single `package_revise` call after the uploads are done.
+    If some of the uploads fail, the other resources are still added
+    (and their source files deleted if `delete_source` is set) and
+    a ValueError listing the failed files is raised.
+    """
+    paths = expand_paths(paths)
+    if not paths:
+        raise ValueError("No files to append!")
+
     package_show = logic.get_action("package_show")
-    ds_dict = package_show(context=admin_context(),
-                           data_dict={"id": dataset_id})
-
-    sha256 = sha256sum(path)
-
-    # Create a resource ID from the dataset ID and the resource hash
-    rid = make_id([ds_dict["id"], path.name, sha256])
-
-    # Upload the resource to S3
-    bucket_name = get_ckan_config_option(
-        "dcor_object_store.bucket_name").format(
-        organization_id=ds_dict["organization"]["id"])
-    object_name = f"resource/{rid[:3]}/{rid[3:6]}/{rid[6:]}"
-    s3_url = s3.upload_file(
-        bucket_name=bucket_name,
-        object_name=object_name,
-        path=path,
-        sha256=sha256,
-        private=ds_dict["private"],
-        override=False,
-    )
-
-    # Append the resource to the CKAN dataset entry
-    append_ckan_resource_to_active_dataset(
-        dataset_id=ds_dict["id"],
-        res_dict={"id": rid,
-                  "name": path.name,
-                  "s3_available": True,
-                  "s3_url": s3_url,
-                  "size": path.stat().st_size,
-                  "url_type": "s3_upload",
-                  })
+    with metrics.timer("ckan_show"):
+        ds_dict = package_show(context=admin_context(),
+                               data_dict={"id": dataset_id})
+    bucket_name = get_s3_bucket_name(ds_dict["organization"]["id"])
+
+    def upload(path):
+        sha256 = get_checksum_cache().sha256sum(path)
+
+        # Create a resource ID from the dataset ID and the resource hash
+        rid = make_id([ds_dict["id"], path.name, sha256])
+
+        # Upload the resource to S3
+        object_name = get_s3_object_name(rid)
+        s3_url, _ = s3_util.upload_file(
+            bucket_name=bucket_name,
+            object_name=object_name,
+            path=path,
+            sha256=sha256,
+            private=ds_dict["private"],
+            override=False,
+        )
+        return {"id": rid,
+                "name": path.name,
+                "s3_available": True,
+                "s3_url": s3_url,
+                "size": path.stat().st_size,
+                "url_type": "s3_upload",
+                }
+
+    # create the bucket before fanning out
+    s3_util.require_bucket(bucket_name)
+    res_dicts = []
+    uploaded = []
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_jobs) as pool:
+        futures = [pool.submit(upload, path) for path in paths]
+        for path, future in zip(paths, futures):
+            try:
+                res_dicts.append(future.result())
+            except Exception as exc:
+                errors.append((path, exc))
+            else:
+                uploaded.append(path)
+
+    # Append the successfully uploaded resources to the CKAN dataset
+    # entry, so that there are no orphaned objects on S3.
+    if res_dicts:
+        append_ckan_resources_to_active_dataset(dataset_id=ds_dict["id"],
+                                                res_dicts=res_dicts)
 
     # If we got here without any exceptions, then it is safe to
-    # delete the input path.
+    # delete the input paths of the uploaded resources.
     if delete_source:
-        path.unlink()
+        for path in uploaded:
+            path.unlink()
+
+    if errors:
+        raise ValueError(
+            f"Failed to upload {len(errors)} of {len(paths)} files to "
+            f"dataset {ds_dict['id']}: "
+            + ", ".join(f"{path} ({exc!r})" for path, exc in errors)
+        ) from errors[0][1]
+
+
+def expand_paths(paths):
+    """Expand directories and glob patterns in a list of paths
+
+    Directories are replaced by the (non-hidden) files they contain
+    and glob patterns (e.g. "/data/*.rtdc") by the matching files.
+    Returns a sorted list of unique `pathlib.Path` objects.
+    """
+    expanded = []
+    for path in paths:
+        path = pathlib.Path(path)
+        if path.is_dir():
+            expanded += [pp for pp in path.iterdir()
+                         if pp.is_file() and not pp.name.startswith(".")]
+        elif not path.exists() and any(ch in str(path) for ch in "*?["):
+            expanded += [pathlib.Path(pp) for pp in glob.glob(str(path))
+                         if pathlib.Path(pp).is_file()]
+        else:
+            expanded.append(path)
+    return sorted(set(expanded))
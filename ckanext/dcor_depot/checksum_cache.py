@@ -0,0 +1,92 @@
+"""Persistent cache for SHA256 sums of files on block storage
+
+Computing the SHA256 sum of a large file requires reading it entirely.
+The :class:`ChecksumCache` stores the SHA256 sums of files in an SQLite
+database together with the device, inode, size, and modification time
+of the file. As long as these do not change, a SHA256 sum is looked up
+at the cost of a `stat` call.
+"""
+import functools
+import os
+import pathlib
+import sqlite3
+import threading
+
+from . import metrics
+from .util import get_tmp_dir, sha256sum
+
+
+class ChecksumCache:
+    """SQLite-backed cache of SHA256 sums
+
+    The database is stored at `path` (defaults to "sha256_cache.sqlite3"
+    in :func:`.util.get_tmp_dir`). It may be shared by several threads
+    and processes.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = get_tmp_dir() / "sha256_cache.sqlite3"
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path,
+                                     timeout=30,
+                                     check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sha256 ("
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+            "sha256 TEXT, PRIMARY KEY (dev, ino))")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get(self, path, stat=None):
+        """Return the cached SHA256 sum of a file or None
+
+        Raises FileNotFoundError if `path` does not exist.
+        """
+        if stat is None:
+            stat = os.stat(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sha256 FROM sha256 WHERE dev=? AND ino=? "
+                "AND size=? AND mtime_ns=?",
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, path, sha256, stat=None):
+        """Store the SHA256 sum of a file
+
+        If the SHA256 sum was computed from the data of the file,
+        pass the `stat` result obtained before reading the file,
+        so that modifications in the meantime are detected.
+        """
+        if stat is None:
+            stat = os.stat(path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sha256 VALUES (?, ?, ?, ?, ?)",
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                 sha256))
+
+    def sha256sum(self, path):
+        """Return the SHA256 sum of a file, computing it if necessary"""
+        stat = os.stat(path)
+        sha256 = self.get(path, stat=stat)
+        if sha256 is None:
+            with metrics.timer("hash"):
+                sha256 = sha256sum(path)
+            metrics.add_bytes("hashed", stat.st_size)
+            self.set(path, sha256, stat=stat)
+        return sha256
+
+
+@functools.lru_cache()
+def get_checksum_cache():
+    """Return the :class:`ChecksumCache` of the depot"""
+    return ChecksumCache()
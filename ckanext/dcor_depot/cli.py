@@ -1,4 +1,8 @@
+import collections
+import concurrent.futures
+import csv
 import datetime
+import json
 import pathlib
 import time
 import traceback as tb
@@ -8,12 +12,20 @@ import ckan.model as model
 import click
 
 from dcor_shared import (
-    DC_MIME_TYPES, s3, s3cc, get_resource_info, sha256sum
+    DC_MIME_TYPES, s3
 )
 
 from . import app_res
 from .figshare import figshare
+from .inventory import get_inventory
 from . import jobs
+from .journal import MigrationJournal, get_journal_path
+from . import metrics
+from . import migrate
+from . import query
+from . import reconcile
+from . import s3_util
+from .util import get_s3_bucket_name, get_s3_object_name, get_tmp_dir
 
 
 def click_echo(message, am_on_a_new_line):
@@ -22,81 +34,156 @@ def click_echo(message, am_on_a_new_line):
     click.echo(message)
 
 
+def report_timings(timings):
+    """Print the phase timings (if `timings`) and export the metrics"""
+    if timings:
+        click.echo(metrics.get_metrics().summary())
+    metrics.flush()
+
+
 @click.command()
-@click.argument('path')
+@click.argument('paths', nargs=-1, required=True)
 @click.argument('dataset_id')
 @click.option('--delete-source', is_flag=True,
-              help='Delete the original local file')
-def append_resource(path, dataset_id, delete_source=False):
-    """Append a resource to a dataset
+              help='Delete the original local files')
+@click.option("--jobs", "num_jobs", default=4, type=click.IntRange(min=1),
+              help="Number of files to hash and upload concurrently")
+@click.option("--timings", is_flag=True,
+              help="Print the time spent in each phase (database, "
+                   "hashing, S3, CKAN) at the end")
+def append_resource(paths, dataset_id, delete_source=False, num_jobs=4,
+                    timings=False):
+    """Append resources to a dataset
 
     This can be done even after the dataset is made active.
     It can be used to e.g. append post-processed DC data to an
     existing dataset.
 
-    Pass the path `path` to a resource, and it will be added to the
-    specified `dataset_id` (id or name).
+    Pass one or more paths `paths` to resources, and they will be
+    added to the specified `dataset_id` (id or name). Directories
+    and (quoted) glob patterns are expanded to the files they contain.
     """
-    path = pathlib.Path(path)
-    app_res.append_resource(path=path,
-                            dataset_id=dataset_id,
-                            delete_source=delete_source)
+    if timings:
+        metrics.enable()
+    app_res.append_resources(paths=paths,
+                             dataset_id=dataset_id,
+                             delete_source=delete_source,
+                             num_jobs=num_jobs)
+    report_timings(timings)
 
 
 @click.command()
 @click.option('--limit', default=0, help='Limit number of datasets imported')
-def dcor_import_figshare(limit):
+@click.option("--jobs", "num_jobs", default=4, type=click.IntRange(min=1),
+              help="Number of files to download and upload concurrently")
+@click.option("--max-inflight-bytes", default=0, type=click.IntRange(min=0),
+              help="Maximum total size of the files processed concurrently "
+                   "(0 means no limit)")
+@click.option("--stage-on-disk", is_flag=True,
+              help="Download files to the temporary directory before "
+                   "uploading them instead of streaming them to S3")
+@click.option("--download-segments", default=1, type=click.IntRange(min=1),
+              help="Number of parallel range requests for downloading "
+                   "large files with --stage-on-disk")
+@click.option("--incremental", is_flag=True,
+              help="Skip datasets that are already complete in CKAN and "
+                   "on S3 (determined with bulk queries)")
+@click.option("--timings", is_flag=True,
+              help="Print the time spent in each phase (database, "
+                   "hashing, S3, CKAN) at the end")
+def dcor_import_figshare(limit, num_jobs=4, max_inflight_bytes=0,
+                         stage_on_disk=False, download_segments=1,
+                         incremental=False, timings=False):
     """Import a predefined list of datasets from figshare"""
-    figshare(limit=limit)
+    if timings:
+        metrics.enable()
+    try:
+        figshare(limit=limit,
+                 num_jobs=num_jobs,
+                 max_inflight_bytes=max_inflight_bytes,
+                 stage_on_disk=stage_on_disk,
+                 download_segments=download_segments,
+                 incremental=incremental)
+    finally:
+        report_timings(timings)
 
 
 @click.command()
 @click.argument('dataset_id')
-def dcor_list_s3_objects_for_dataset(dataset_id):
+@click.option("--format", "output_format", default="text",
+              type=click.Choice(["text", "json"]),
+              help="Output format")
+@click.option("--jobs", "num_jobs", default=8, type=click.IntRange(min=1),
+              help="Number of concurrent S3 requests")
+def dcor_list_s3_objects_for_dataset(dataset_id, output_format="text",
+                                     num_jobs=8):
     """List S3 resource and other data locations for a dataset
 
     The resources are printed as "bucket:path (message)" and the
     colors indicate whether the object is publicly available (green),
-    private (blue), or not there (red).
+    private (blue), or not there (red). With `--format json`, a list
+    of dictionaries (one for each object) is printed instead.
     """
     package_show = logic.get_action("package_show")
     dataset_dict = package_show(context={'ignore_auth': True,
                                          'user': 'default'},
                                 data_dict={"id": dataset_id})
+    bucket_name = get_s3_bucket_name(dataset_dict["organization"]["id"])
     # For each resource, list the objects that are currently in S3 along
     # with the S3 object tags.
+    objects = []
     for res_dict in dataset_dict["resources"]:
         rid = res_dict["id"]
-        bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
-            rid, artifact="resource")
-        paths = [object_name]
+        artifacts = ["resource"]
         if res_dict["mimetype"] in DC_MIME_TYPES:
-            paths.append(s3cc.get_s3_bucket_object_for_artifact(
-                rid, artifact="condensed")[1])
-            paths.append(s3cc.get_s3_bucket_object_for_artifact(
-                rid, artifact="preview")[1])
-        s3_client, _, _ = s3.get_s3()
-        for pp in paths:
-            try:
-                response = s3_client.get_object_tagging(
-                    Bucket=bucket_name,
-                    Key=pp)
-                tags = []
-                for item in response["TagSet"]:
-                    tags.append(f"{item['Key']}={item['Value']}")
-                if tags.count("public=true"):
-                    # As mentioned in the s3 submodule, we define public
-                    # access by the presence of the "public=true" tag for
-                    # an object.
-                    color = "green"
-                else:
-                    color = "blue"
-                    tags.append("PRIVATE")
-                message = " ".join(tags)
-            except s3_client.exceptions.NoSuchKey:
-                color = "red"
-                message = "not found"
-            click.secho(f"{bucket_name}:{pp} ({message})", fg=color)
+            artifacts += ["condensed", "preview"]
+        for artifact in artifacts:
+            objects.append({
+                "resource_id": rid,
+                "artifact": artifact,
+                "bucket": bucket_name,
+                "object": get_s3_object_name(rid, artifact),
+            })
+
+    s3_client, _, _ = s3.get_s3()
+
+    def get_tags(object_name):
+        try:
+            response = s3_client.get_object_tagging(Bucket=bucket_name,
+                                                    Key=object_name)
+        except s3_client.exceptions.NoSuchKey:
+            return None
+        return {item["Key"]: item["Value"] for item in response["TagSet"]}
+
+    # The boto3 client is thread-safe; `map` preserves the order.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_jobs) as pool:
+        for obj, tags in zip(objects,
+                             pool.map(get_tags,
+                                      [obj["object"] for obj in objects])):
+            obj["exists"] = tags is not None
+            # As mentioned in the s3 submodule, we define public
+            # access by the presence of the "public=true" tag for
+            # an object.
+            obj["public"] = tags is not None and tags.get("public") == "true"
+            obj["tags"] = tags or {}
+
+    if output_format == "json":
+        click.echo(json.dumps(objects, indent=2))
+        return
+
+    for obj in objects:
+        if not obj["exists"]:
+            color = "red"
+            message = "not found"
+        else:
+            tags = [f"{key}={value}" for key, value in obj["tags"].items()]
+            if obj["public"]:
+                color = "green"
+            else:
+                color = "blue"
+                tags.append("PRIVATE")
+            message = " ".join(tags)
+        click.secho(f"{obj['bucket']}:{obj['object']} ({message})", fg=color)
 
 
 @click.command()
@@ -109,128 +196,322 @@ def dcor_list_s3_objects_for_dataset(dataset_id):
 @click.option("--verify-existence", is_flag=True,
               help="Verify that resources exist in S3")
 @click.option("--verify-checksum", is_flag=True,
-              help="Verify the checksum of the file in S3; this option "
-                   "implies --verify-existence")
+              help="Verify the checksum of the file in S3 (using the "
+                   "checksum stored with the object if available); this "
+                   "option implies --verify-existence")
+@click.option("--jobs", "num_jobs", default=1, type=click.IntRange(min=1),
+              help="Number of artifacts to migrate concurrently")
+@click.option("--flush-size", default=100, type=click.IntRange(min=1),
+              help="Maximum number of resource metadata updates that are "
+                   "combined in one `package_revise` call")
+@click.option("--use-inventory", is_flag=True,
+              help="Check the existence of objects using a (cached) "
+                   "listing of each bucket instead of one request "
+                   "per object")
+@click.option("--resume", is_flag=True,
+              help="Skip resources and artifacts that were already "
+                   "processed according to the checkpoint journal of "
+                   "a previous (interrupted) run")
+@click.option("--timings", is_flag=True,
+              help="Print the time spent in each phase (database, "
+                   "hashing, S3, CKAN) at the end")
 def dcor_migrate_resources_to_object_store(modified_days=-1,
                                            delete_after_migration=False,
                                            verify_existence=False,
                                            verify_checksum=False,
+                                           num_jobs=1,
+                                           flush_size=100,
+                                           use_inventory=False,
+                                           resume=False,
+                                           timings=False,
                                            ):
     """Migrate resources on block storage to an S3-compatible object store
 
     This also happens for draft datasets.
+
+    With `--jobs N`, up to N artifacts (resources, previews, condensed
+    files) are hashed and uploaded concurrently. The output is still
+    printed in order for each dataset and metadata updates are done
+    sequentially in the main thread. The metadata updates are applied
+    with one `package_revise` call per dataset (or per `--flush-size`
+    resources).
+
+    With `--use-inventory`, the objects in each bucket are listed
+    once (see :mod:`.inventory`) and existence checks are answered
+    from this listing.
+
+    Completed uploads, verifications, and deletions are written to
+    a checkpoint journal in `ckanext.dcor_depot.tmp_dir` (one journal
+    per combination of options). Pass `--resume` to continue an
+    interrupted migration with the same options. Without `--resume`,
+    the command refuses to start if the previous run with the same
+    options did not finish.
+
+    With `--timings`, the time spent in the individual phases
+    (database queries, hashing, S3 requests, CKAN updates) is
+    printed at the end (see :mod:`.metrics`).
     """
+    if timings:
+        metrics.enable()
     # verify_checksum implies verify_existence [sic]
     verify_existence = verify_existence or verify_checksum
     # go through all datasets
-    datasets = model.Session.query(model.Package)
-
-    if modified_days >= 0:
-        # Search only the last `days` days.
-        past = datetime.date.today() - datetime.timedelta(days=modified_days)
-        past_str = time.strftime("%Y-%m-%d", past.timetuple())
-        datasets = datasets.filter(model.Package.metadata_modified >= past_str)
-
+    dataset_ids = query.get_dataset_ids(modified_days=modified_days)
+
+    # Journal actions that count as "done" in the current mode
+    if verify_checksum:
+        done_actions = ["verified"]
+    else:
+        done_actions = ["uploaded", "checked", "verified"]
+    journal_path = get_journal_path(
+        get_tmp_dir(),
+        "migrate_resources_journal",
+        modified_days=modified_days,
+        delete_after_migration=delete_after_migration,
+        verify_existence=verify_existence,
+        verify_checksum=verify_checksum)
+    try:
+        journal = MigrationJournal(journal_path, resume=resume)
+    except FileExistsError as e:
+        raise click.ClickException(f"{e} Pass --resume to continue "
+                                   f"the interrupted migration.")
+    if resume:
+        click.echo(f"Resuming with journal {journal.path}")
+
+    num_datasets = len(dataset_ids)
+    stats = collections.Counter()
+    # Datasets for which artifacts are currently being processed, in
+    # the order in which they were submitted. We keep a few datasets
+    # in flight, so that the workers don't idle while we print results.
+    pending = collections.deque()
+    max_pending = 2 * num_jobs
     nl = False
-    for dataset in datasets:
-        nl = False
-        click.echo(f"Migrating dataset {dataset.id}\r", nl=False)
-        for resource in dataset.resources:
-            rid = resource.id
-            ds_dict, res_dict = get_resource_info(rid)
-            rid = res_dict["id"]
-            res_loc = str(jobs.get_resource_path(rid))
-            for artifact, suffix, obj_sha in [
-                ("resource", "", res_dict.get("sha256")),
-                ("preview", "_preview.jpg", None),
-                    ("condensed", "_condensed.rtdc", None)]:
-                if not res_dict.get("s3_available", False) or verify_existence:
-                    local_path = res_loc + suffix
-                    # Only continue if the local file exists
-                    if pathlib.Path(local_path).exists():
-                        # compute sha256sum if not available
-                        obj_sha = obj_sha or sha256sum(local_path)
-                        override = False  # no override by default
-
-                        if verify_checksum and s3cc.artifact_exists(
-                                rid, artifact=artifact):
-                            s3_sha256 = s3cc.compute_checksum(
-                                rid, artifact=artifact)
-                            if s3_sha256 != obj_sha:
-                                # Override only if the user requested it and
-                                # only if the SHA256 sum did not match.
-                                override = True
-                        try:
-                            s3_url = s3cc.upload_artifact(
+    batcher = migrate.ResourcePatchBatcher(flush_size=flush_size)
+    inventories = set()
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=num_jobs)
+    try:
+        # The metadata of all resources are fetched in batches
+        for ii, (ds_dict, res_dicts) in enumerate(
+                query.iter_dataset_resources(dataset_ids)):
+            bucket_name = get_s3_bucket_name(ds_dict["owner_org"])
+            if use_inventory:
+                inventory = get_inventory(bucket_name)
+                inventories.add(inventory)
+            else:
+                inventory = None
+            resources = []
+            for res_dict in res_dicts:
+                rid = res_dict["id"]
+                if journal.is_done(rid, "*", done_actions):
+                    stats["skipped"] += 1
+                    continue
+                res_loc = str(jobs.get_resource_path(rid))
+                futures = []
+                for artifact, suffix, obj_sha in [
+                    ("resource", "", res_dict.get("sha256")),
+                    ("preview", "_preview.jpg", None),
+                        ("condensed", "_condensed.rtdc", None)]:
+                    if (not query.is_s3_available(res_dict)
+                            or verify_existence):
+                        if (journal.is_done(rid, artifact, done_actions)
+                            and (not delete_after_migration
+                                 or journal.is_done(rid, artifact,
+                                                    ["deleted"]))):
+                            continue
+                        local_path = res_loc + suffix
+                        # Only continue if the local file exists
+                        if pathlib.Path(local_path).exists():
+                            # create the bucket before fanning out
+                            s3_util.require_bucket(bucket_name)
+                            futures.append(pool.submit(
+                                migrate.migrate_artifact,
                                 resource_id=rid,
-                                path_artifact=local_path,
                                 artifact=artifact,
+                                local_path=local_path,
+                                bucket_name=bucket_name,
                                 sha256=obj_sha,
                                 private=ds_dict["private"],
-                                override=override,
-                            )
-                            if verify_checksum:
-                                click_echo(f"Verified {artifact} {rid}", nl)
-                            elif verify_existence:
-                                click_echo(f"Checked {artifact} {rid}", nl)
-                            else:
-                                click_echo(f"Uploaded {artifact} {rid}", nl)
-                            nl = True
-                        except FileNotFoundError:
-                            click_echo(f"Missing file {local_path}", nl)
-                            nl = True
-                        else:
-                            # Only ever delete when upload succeeds
-                            if delete_after_migration:
-                                path_res = pathlib.Path(local_path).resolve()
-                                pathlib.Path(local_path).unlink()
-                                if path_res.exists():
-                                    path_res.unlink()
-
-                            # Check if the s3 URLs have been set
-                            if (artifact == "resource"
-                                and ("s3_available" not in res_dict
-                                     or "s3_url" not in res_dict)):
-                                try:
-                                    # Update the resource dictionary
-                                    logic.get_action("resource_patch")(
-                                        context={
-                                            # https://github.com/ckan/
-                                            # ckan/issues/7787
-                                            "user": ds_dict["creator_user_id"],
-                                            "ignore_auth": True},
-                                        data_dict={"id": rid,
-                                                   "s3_available": True,
-                                                   "s3_url": s3_url})
-                                except BaseException:
-                                    click_echo(
-                                        f"Failed resource {resource.name}", nl)
-                                    nl = True
-                                    click_echo(tb.format_exc(), nl)
+                                verify_existence=verify_existence,
+                                verify_checksum=verify_checksum,
+                                delete_after_migration=delete_after_migration,
+                                inventory=inventory,
+                            ))
+                resources.append((ds_dict, res_dict, futures))
+            pending.append((f"{ds_dict['id']} ({ii + 1}/{num_datasets})",
+                            resources))
+            while len(pending) > max_pending:
+                nl = _migrate_report_dataset(*pending.popleft(),
+                                             stats=stats,
+                                             journal=journal,
+                                             done_action=done_actions[0],
+                                             batcher=batcher)
+        while pending:
+            nl = _migrate_report_dataset(*pending.popleft(),
+                                         stats=stats,
+                                         journal=journal,
+                                         done_action=done_actions[0],
+                                         batcher=batcher)
+    except BaseException:
+        pool.shutdown(wait=True, cancel_futures=True)
+        raise
+    else:
+        pool.shutdown(wait=True)
+        journal.finish()
+    finally:
+        journal.close()
+        # remember the uploaded objects for the next run
+        for inventory in inventories:
+            inventory.save()
 
     if not nl:
         click.echo("")
+    click.echo(f"Processed {num_datasets} datasets: "
+               + ", ".join(f"{stats[key]} {key}" for key in [
+                   "uploaded", "checked", "verified", "missing", "failed",
+                   "skipped"]))
+    report_timings(timings)
     click.echo("Done!")
 
 
+def _migrate_report_dataset(dataset_label, resources, stats, journal,
+                            done_action, batcher):
+    """Wait for the artifacts of one dataset and report on their migration
+
+    Helper function for :func:`dcor_migrate_resources_to_object_store`.
+    The resource metadata and the checkpoint journal are updated here
+    (in the main thread), so that there are no concurrent writes to
+    the CKAN database. The metadata updates are collected in `batcher`
+    and applied at once for the entire dataset.
+
+    Returns whether the cursor is on a new line.
+    """
+    click.echo(f"Migrating dataset {dataset_label}\r", nl=False)
+    nl = False
+    for ds_dict, res_dict, futures in resources:
+        resource_ok = True
+        # journal entries that are written once the resource is patched
+        records = []
+        patch = None
+        for future in futures:
+            try:
+                with metrics.timer("wait_for_workers"):
+                    result = future.result()
+            except concurrent.futures.CancelledError:
+                raise
+            except BaseException:
+                result = {"resource_id": res_dict["id"],
+                          "artifact": "unknown",
+                          "status": "failed",
+                          "error": tb.format_exc()}
+            rid = result["resource_id"]
+            artifact = result["artifact"]
+            status = result["status"]
+            stats[status] += 1
+            if status == "missing":
+                click_echo(f"Missing file {result['path']}", nl)
+            elif status == "failed":
+                resource_ok = False
+                click_echo(f"Failed {artifact} {rid}", nl)
+                click_echo(result["error"], True)
+            else:
+                click_echo(f"{status.capitalize()} {artifact} {rid}", nl)
+            nl = True
+
+            if status in ["missing", "failed"]:
+                continue
+
+            records.append((artifact, status))
+            if result.get("deleted"):
+                records.append((artifact, "deleted"))
+
+            # Check if the s3 URLs have been set
+            if (artifact == "resource"
+                and (not query.is_s3_available(res_dict)
+                     or "s3_url" not in res_dict)):
+                patch = {"s3_available": True,
+                         "s3_url": result["s3_url"]}
+
+        def finalize(rid, error, records=records, resource_ok=resource_ok,
+                     res_dict=res_dict):
+            if error is not None:
+                stats["failed"] += 1
+                click_echo(f"Failed resource {res_dict['name']}", True)
+                click_echo(error, True)
+                return
+            for artifact, action in records:
+                journal.record(rid, artifact, action)
+            if resource_ok:
+                journal.record(rid, "*", done_action)
+
+        if patch is None:
+            finalize(res_dict["id"], None)
+        else:
+            batcher.add(package_id=ds_dict["id"],
+                        resource_id=res_dict["id"],
+                        data_dict=patch,
+                        user=ds_dict["creator_user_id"],
+                        callback=finalize)
+    if resources:
+        batcher.flush(resources[0][0]["id"])
+    return nl
+
+
 @click.option('--initiated-before-days', default=5,
               help='Only prune multipart uploads that were initiated '
                    + 'before a given number of days (set to -1 to prune all)')
 @click.option('--dry-run', is_flag=True,
               help='Do not prune, only print what would happen')
+@click.option("--bucket-prefix", "bucket_prefixes", multiple=True,
+              help="Only prune buckets whose name starts with this prefix "
+                   "(may be given multiple times, e.g. to split the work "
+                   "between several hosts)")
+@click.option("--organization", "organizations", multiple=True,
+              help="Only prune the bucket of this organization (name or "
+                   "ID, may be given multiple times)")
+@click.option("--jobs", "num_jobs", default=8, type=click.IntRange(min=1),
+              help="Number of buckets to process concurrently")
+@click.option("--abort-jobs", "num_abort_jobs", default=16,
+              type=click.IntRange(min=1),
+              help="Maximum number of concurrent abort requests")
 @click.command()
-def dcor_prune_stale_multipart_uploads(initiated_before_days=5, dry_run=False):
+def dcor_prune_stale_multipart_uploads(initiated_before_days=5, dry_run=False,
+                                       bucket_prefixes=(), organizations=(),
+                                       num_jobs=8, num_abort_jobs=16):
     """Prune stale multipart uploads
 
     When users upload data to DCOR and the upload is aborted unexpectedly,
     then stale multipart uploads might still be around. These multipart
     uploads normally count against the storage quota and can incur costs.
     Pruning them is a sensible task that should be done regularly.
+
+    The buckets are processed concurrently (`--jobs`). With
+    `--bucket-prefix` and `--organization`, only a subset of the
+    buckets is processed.
     """
-    prune_info = s3.prune_multipart_uploads(
+    bucket_names = None
+    if bucket_prefixes or organizations:
+        bucket_names = []
+        if bucket_prefixes:
+            bucket_names += [
+                bn for bn in s3.iter_buckets(for_circles_only=False)
+                if bn.startswith(tuple(bucket_prefixes))]
+        for organization in organizations:
+            group = model.Group.get(organization)
+            if group is None:
+                raise click.BadParameter(
+                    f"Organization '{organization}' not found",
+                    param_hint="organization")
+            bucket_name = get_s3_bucket_name(group.id)
+            if bucket_name not in bucket_names:
+                bucket_names.append(bucket_name)
+    prune_info = s3_util.prune_multipart_uploads(
         initiated_before_days=initiated_before_days,
         dry_run=dry_run,
         print_progress=True,
+        bucket_names=bucket_names,
+        num_jobs=num_jobs,
+        num_abort_jobs=num_abort_jobs,
     )
     # assemble and print stats
     num_buckets = 0
@@ -249,12 +530,77 @@ def dcor_prune_stale_multipart_uploads(initiated_before_days=5, dry_run=False):
 
 
 @click.command()
-def list_all_resources():
-    """List all (public and private) resource IDs"""
-    datasets = model.Session.query(model.Package)
-    for dataset in datasets:
-        for resource in dataset.resources:
-            click.echo(resource.id)
+@click.option("--skip-local", is_flag=True,
+              help="Do not scan the resources directory on block storage")
+def dcor_reconcile_storage(skip_local=False):
+    """Report drift between the database, S3, and block storage
+
+    For every finding (e.g. resources marked as available on S3 whose
+    objects are missing, orphaned S3 objects, or leftover files on
+    block storage), one JSON object is printed per line. The last line
+    contains the number of findings in each category.
+    """
+    stats = collections.Counter()
+    for finding in reconcile.iter_storage_drift(check_local=not skip_local):
+        stats[finding["category"]] += 1
+        click.echo(json.dumps(finding))
+    click.echo(json.dumps({"category": "summary", **stats}))
+
+
+@click.command()
+@click.option("--modified-days", default=-1,
+              help="Only list resources of datasets modified within this "
+                   "number of days in the past (-1 lists all resources)")
+@click.option("--state", "states", multiple=True,
+              type=click.Choice(["active", "draft", "deleted"]),
+              help="Only list resources of datasets in this state "
+                   "(may be given multiple times)")
+@click.option("--organization",
+              help="Only list resources of this organization (name or ID)")
+@click.option("--mimetype",
+              help="Only list resources with this mimetype")
+@click.option("--s3-available/--no-s3-available", default=None,
+              help="Only list resources that are (not) available on S3")
+@click.option("--format", "output_format", default="ids",
+              type=click.Choice(["ids", "csv", "jsonl"]),
+              help="Print only the resource IDs (default), or CSV or "
+                   "JSON lines including size and SHA256 sum")
+def list_all_resources(modified_days=-1, states=(), organization=None,
+                       mimetype=None, s3_available=None,
+                       output_format="ids"):
+    """List all (public and private) resources
+
+    The resources are fetched with a streaming database query that
+    only selects the required columns (see
+    :func:`.query.iter_resources`), so this works with any number
+    of resources.
+    """
+    organization_id = None
+    if organization is not None:
+        group = model.Group.get(organization)
+        if group is None:
+            raise click.BadParameter(f"Organization '{organization}' "
+                                     f"not found", param_hint="organization")
+        organization_id = group.id
+
+    resources = query.iter_resources(modified_days=modified_days,
+                                     dataset_states=states,
+                                     organization_id=organization_id,
+                                     mimetype=mimetype,
+                                     s3_available=s3_available)
+    out = click.get_text_stream("stdout")
+    if output_format == "csv":
+        writer = csv.DictWriter(out, fieldnames=query.RESOURCE_KEYS,
+                                lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(resources)
+    elif output_format == "jsonl":
+        for res_dict in resources:
+            out.write(json.dumps(res_dict) + "\n")
+    else:
+        for res_dict in resources:
+            out.write(res_dict["id"] + "\n")
+    out.flush()
 
 
 # TODO: Remove this method (it should not be used in current workflows)
@@ -306,6 +652,7 @@ def get_commands():
             dcor_list_s3_objects_for_dataset,
             dcor_migrate_resources_to_object_store,
             dcor_prune_stale_multipart_uploads,
+            dcor_reconcile_storage,
             list_all_resources,
             run_jobs_dcor_depot,
             ]
@@ -0,0 +1,295 @@
+"""Resumable downloads of (large) files via HTTP"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import pathlib
+import threading
+import time
+
+import requests
+import requests.adapters
+import urllib3
+
+from . import metrics
+from .util import hash_file
+
+
+#: Number of times an interrupted download is resumed
+DOWNLOAD_RETRIES = 5
+#: Timeout in seconds for connecting and for receiving data
+DOWNLOAD_TIMEOUT = 60
+#: Minimum size of a segment for segmented downloads
+MIN_SEGMENT_SIZE = 64 * 1024**2
+#: Maximum number of keep-alive connections per host in the shared session
+POOL_MAXSIZE = 32
+
+#: Exceptions after which a download is resumed
+RETRY_EXCEPTIONS = (requests.RequestException,
+                    urllib3.exceptions.HTTPError,
+                    ConnectionError,
+                    )
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def check_content_length(response, size):
+    """Raise a ValueError if a response announces a size other than `size`
+
+    Nothing is checked if `size` is None or if the server does not
+    send the Content-Length header for the decoded data.
+    """
+    length = response.headers.get("Content-Length")
+    if (size is not None and length is not None
+            and "Content-Encoding" not in response.headers
+            and int(length) != size):
+        raise ValueError(f"Size mismatch for {response.url}: expected "
+                         f"{size} bytes, server announced {length}!")
+
+
+def download_file(url, path, ret_sha256=False, md5=None, size=None,
+                  retries=DOWNLOAD_RETRIES, segments=1):
+    """Download (large) file without big memory footprint
+
+    The data are written to "<path>.part" and hashed on the fly, so
+    the file does not have to be read again for verification. If the
+    connection drops, the download is resumed with an HTTP Range
+    request (up to `retries` times with exponential backoff). A
+    ".part" file left over from a previous call is resumed as well;
+    its content is hashed once to restore the hash state. When the
+    download is complete, the ".part" file is renamed to `path`.
+
+    If `md5` is given, the MD5 sum of the download is compared to it.
+    If `size` is given, the transfer is aborted as soon as the server
+    announces or sends a different number of bytes. If verification
+    fails, the partial file is removed and a ValueError is raised.
+
+    If `segments` is larger than one and the server supports range
+    requests, files larger than `segments` times :const:`MIN_SEGMENT_SIZE`
+    are downloaded with `segments` parallel range requests. Since
+    hashing is sequential, the file is hashed after such a download.
+    """
+    algorithms = []
+    if ret_sha256:
+        algorithms.append("sha256")
+    if md5:
+        algorithms.append("md5")
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path_part = path.with_name(path.name + ".part")
+    path_segments = path.with_name(path.name + ".segments")
+    try:
+        if (segments > 1
+                and size is not None
+                and size >= segments * MIN_SEGMENT_SIZE
+                and supports_range_requests(url)):
+            with metrics.timer("download"):
+                download_segments(url, path_part, size=size,
+                                  segments=segments, retries=retries)
+            with metrics.timer("hash"):
+                hashers, received = hash_file(path_part, algorithms)
+        else:
+            with metrics.timer("download"):
+                hashers, received = download_resume(url, path_part,
+                                                    size=size,
+                                                    algorithms=algorithms,
+                                                    retries=retries)
+        metrics.add_bytes("downloaded", received)
+        if size is not None and received != size:
+            raise ValueError(f"Size mismatch for {url}: expected {size} "
+                             f"bytes, received {received}!")
+        if md5 and hashers["md5"].hexdigest() != md5:
+            raise ValueError(f"MD5 sum mismatch for {path}!")
+    except ValueError:
+        # The data are corrupt, resuming does not make sense.
+        path_part.unlink(missing_ok=True)
+        path_segments.unlink(missing_ok=True)
+        raise
+
+    path_part.replace(path)
+    path_segments.unlink(missing_ok=True)
+
+    if ret_sha256:
+        return hashers["sha256"].hexdigest()
+    else:
+        return None
+
+
+def download_resume(url, path, size=None, algorithms=(),
+                    retries=DOWNLOAD_RETRIES):
+    """Download `url` to `path`, resuming existing and interrupted downloads
+
+    Returns
+    -------
+    hashers: dict
+        Dictionary with the names in `algorithms` as keys and the
+        corresponding :mod:`hashlib` objects of the data as values
+    received: int
+        Size of `path` in bytes
+    """
+    path = pathlib.Path(path)
+    if path.exists() and size is not None and path.stat().st_size > size:
+        path.unlink()
+    if path.exists():
+        # restore the hash state from the partial download
+        hashers, offset = hash_file(path, algorithms)
+    else:
+        hashers, offset = {name: hashlib.new(name) for name in algorithms}, 0
+
+    attempt = 0
+    with path.open("ab") as fd:
+        while True:
+            headers = {"Accept-Encoding": "identity"}
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+            try:
+                with get_session().get(url,
+                                       stream=True,
+                                       headers=headers,
+                                       timeout=DOWNLOAD_TIMEOUT) as r:
+                    if offset and r.status_code == 416:
+                        # range not satisfiable; nothing left to download
+                        break
+                    r.raise_for_status()
+                    if offset and not r.headers.get(
+                            "Content-Range", "").startswith(
+                            f"bytes {offset}-"):
+                        # The server ignored the range request.
+                        fd.truncate(0)
+                        hashers = {name: hashlib.new(name)
+                                   for name in algorithms}
+                        offset = 0
+                    if not offset:
+                        check_content_length(r, size)
+                    for chunk in r.iter_content(chunk_size=2**20):
+                        if size is not None and offset + len(chunk) > size:
+                            raise ValueError(
+                                f"Size mismatch for {url}: received more "
+                                f"than {size} bytes!")
+                        fd.write(chunk)
+                        offset += len(chunk)
+                        for hasher in hashers.values():
+                            hasher.update(chunk)
+                break
+            except RETRY_EXCEPTIONS as e:
+                fd.flush()
+                attempt += 1
+                wait_before_retry(url, e, attempt, retries, offset)
+    return hashers, offset
+
+
+def download_segments(url, path, size, segments, retries=DOWNLOAD_RETRIES):
+    """Download `url` to `path` with parallel range requests
+
+    The finished segments are recorded in a ".segments" file next to
+    `path` (without a ".part" suffix), so that an interrupted download
+    can be resumed by calling this function again with the same
+    arguments.
+    """
+    path = pathlib.Path(path)
+    path_segments = path.with_name(path.name.rsplit(".part", 1)[0]
+                                   + ".segments")
+    bounds = [(ii * size // segments, (ii + 1) * size // segments)
+              for ii in range(segments)]
+
+    done = set()
+    if (path.exists() and path.stat().st_size == size
+            and path_segments.exists()):
+        done = set(path_segments.read_text().split())
+    else:
+        path_segments.unlink(missing_ok=True)
+        with path.open("wb") as fd:
+            fd.truncate(size)
+
+    lock = threading.Lock()
+
+    def fetch(start, stop):
+        pos = start
+        attempt = 0
+        while True:
+            headers = {"Accept-Encoding": "identity",
+                       "Range": f"bytes={pos}-{stop - 1}"}
+            try:
+                with get_session().get(url,
+                                       stream=True,
+                                       headers=headers,
+                                       timeout=DOWNLOAD_TIMEOUT) as r:
+                    r.raise_for_status()
+                    if not r.headers.get("Content-Range", "").startswith(
+                            f"bytes {pos}-"):
+                        raise ValueError(
+                            f"Unexpected response to range request for "
+                            f"{url}: {r.headers.get('Content-Range')}!")
+                    for chunk in r.iter_content(chunk_size=2**20):
+                        if pos + len(chunk) > stop:
+                            raise ValueError(
+                                f"Size mismatch for {url}: received more "
+                                f"than {stop - start} bytes for segment "
+                                f"{start}-{stop}!")
+                        os.pwrite(fileno, chunk, pos)
+                        pos += len(chunk)
+                if pos != stop:
+                    raise ConnectionError(f"Segment {start}-{stop} of {url} "
+                                          f"ended at {pos}")
+                break
+            except RETRY_EXCEPTIONS as e:
+                attempt += 1
+                wait_before_retry(url, e, attempt, retries, pos)
+        with lock:
+            fd_segments.write(f"{start}-{stop}\n")
+            fd_segments.flush()
+
+    with path.open("r+b") as fd, path_segments.open("a") as fd_segments:
+        fileno = fd.fileno()
+        with ThreadPoolExecutor(max_workers=segments) as pool:
+            futures = [pool.submit(fetch, start, stop)
+                       for start, stop in bounds
+                       if f"{start}-{stop}" not in done]
+            for future in futures:
+                # raises the exception of the worker thread
+                future.result()
+
+
+def get_session():
+    """Return a :class:`requests.Session` shared by all threads
+
+    The session keeps up to :const:`POOL_MAXSIZE` connections per host
+    alive, so that subsequent downloads from the same host do not have
+    to establish new (TLS) connections.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=4, pool_maxsize=POOL_MAXSIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
+
+
+def supports_range_requests(url):
+    """Return True if the server announces support for range requests"""
+    try:
+        r = get_session().head(url,
+                               allow_redirects=True,
+                               timeout=DOWNLOAD_TIMEOUT)
+    except RETRY_EXCEPTIONS:
+        return False
+    return r.ok and r.headers.get("Accept-Ranges", "").lower() == "bytes"
+
+
+def wait_before_retry(url, error, attempt, retries, offset):
+    """Wait with exponential backoff or re-raise `error`
+
+    Client errors (HTTP status 4xx) are not retried.
+    """
+    response = getattr(error, "response", None)
+    if (attempt > retries
+            or (response is not None and 400 <= response.status_code < 500)):
+        raise error
+    delay = min(2**attempt, 60)
+    print(f"Download of {url} interrupted at byte {offset} ({error}), "
+          f"retrying in {delay}s (attempt {attempt}/{retries})")
+    time.sleep(delay)
@@ -1,24 +1,190 @@
 """Import predefined datasets from figshare.com"""
-import hashlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import http.client
 import json
-import urllib.request
+import os
 import pathlib
 import pkg_resources
-import tempfile
+import threading
+import traceback
+import urllib.parse
 
-from ckan import common, logic
+from ckan import logic
 
 from dcor_shared import s3
 from html2text import html2text
 import requests
+import urllib3
 
-from .app_res import admin_context, append_ckan_resource_to_active_dataset
-from .util import check_md5, make_id
+from .app_res import (
+    admin_context, append_ckan_resources_to_active_dataset)
+from .download import check_content_length, download_file, get_session
+from .inventory import get_inventory
+from . import metrics
+from . import query
+from . import s3_util
+from .util import (
+    ByteBudget, get_s3_bucket_name, get_s3_object_name, get_tmp_dir, make_id)
 
 
 FIGSHARE_BASE = "https://api.figshare.com/v2"
 FIGSHARE_ORG = "figshare-import"
 
+#: Headers for requests to the figshare API; requests made with the
+#: `requests` library did not work due to scraping detection on figshare.
+FIGSHARE_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; "
+                  "rv:146.0) Gecko/20100101 Firefox/146.0",
+    "Accept": "text/html,application/xhtml+xml,application/xml;"
+              "q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.5",
+    "DNT": "1",
+    "Connection": "keep-alive",
+    "Upgrade-Insecure-Requests": "1",
+    "Sec-Fetch-Dest": "document",
+    "Sec-Fetch-Mode": "navigate",
+    "Sec-Fetch-Site": "same-origin",
+    "Priority": "u=0, i",
+    "Pragma": "no-cache",
+    "Cache-Control": "no-cache",
+    "TE": "trailers",
+}
+
+
+class FigshareClient:
+    """Fetch figshare article metadata via persistent connections
+
+    Each thread keeps one keep-alive connection to the figshare API.
+    The article JSON is cached in `cache_dir` (defaults to
+    "figshare_metadata" in :func:`.util.get_tmp_dir`) together with
+    the ETag and Last-Modified headers of the response, and cached
+    articles are revalidated with conditional requests. The cache
+    also records whether an article has been imported completely
+    (see :func:`mark_imported`).
+    """
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = get_tmp_dir() / "figshare_metadata"
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.base = urllib.parse.urlsplit(FIGSHARE_BASE)
+        self._local = threading.local()
+
+    def close(self):
+        """Close the connection of the current thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def get_article(self, doi):
+        """Return the metadata of the figshare article of a DOI
+
+        Returns
+        -------
+        figshare_dict: dict
+            The article metadata
+        unchanged: bool
+            Whether the metadata are the same as in the cache
+        imported: bool
+            Whether the article has been imported completely
+            with these metadata
+        """
+        uid, ver = parse_doi(doi)
+        path = f"{self.base.path}/articles/{uid}/versions/{ver}"
+        cache_path = self.get_cache_path(doi)
+        cached = self._load(cache_path)
+
+        headers = dict(FIGSHARE_HEADERS)
+        if cached is not None:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+        resp, data = self._request(path, headers)
+
+        if resp.status == 304 and cached is not None:
+            return cached["article"], True, cached.get("imported", False)
+        elif resp.status != 200:
+            raise ConnectionError(f"Error accessing {FIGSHARE_BASE}"
+                                  f"/articles/{uid}/versions/{ver}: "
+                                  f"{resp.reason}")
+
+        figshare_dict = json.loads(data.decode("utf-8"))
+        # Some servers do not support conditional requests.
+        unchanged = cached is not None and cached["article"] == figshare_dict
+        imported = unchanged and cached.get("imported", False)
+        self._save(cache_path, {"etag": resp.getheader("ETag"),
+                                "last_modified": resp.getheader(
+                                    "Last-Modified"),
+                                "article": figshare_dict,
+                                "imported": imported,
+                                })
+        return figshare_dict, unchanged, imported
+
+    def get_cached_article(self, doi):
+        """Return the cached metadata of `doi` (None if not cached)"""
+        cached = self._load(self.get_cache_path(doi))
+        if cached is not None:
+            return cached["article"]
+        return None
+
+    def get_cache_path(self, doi):
+        uid, ver = parse_doi(doi)
+        return self.cache_dir / f"{uid}_v{ver}.json"
+
+    def mark_imported(self, doi, imported=True):
+        """Remember that the cached article of `doi` has been imported"""
+        cache_path = self.get_cache_path(doi)
+        cached = self._load(cache_path)
+        if cached is not None and cached.get("imported") != imported:
+            cached["imported"] = imported
+            self._save(cache_path, cached)
+
+    def _get_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self.base.scheme == "https":
+                conn = http.client.HTTPSConnection(self.base.netloc,
+                                                   timeout=60)
+            else:
+                conn = http.client.HTTPConnection(self.base.netloc,
+                                                  timeout=60)
+            self._local.conn = conn
+        return conn
+
+    def _request(self, path, headers):
+        for attempt in range(2):
+            conn = self._get_connection()
+            try:
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.HTTPException, OSError):
+                # The server might have closed the keep-alive connection.
+                self.close()
+                if attempt:
+                    raise
+            else:
+                return resp, data
+
+    @staticmethod
+    def _load(path):
+        try:
+            with path.open("r", encoding="utf-8") as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _save(path, data):
+        path_tmp = path.with_name(path.name + ".tmp")
+        with path_tmp.open("w", encoding="utf-8") as fd:
+            json.dump(data, fd)
+        os.replace(path_tmp, path)
+
 
 def create_figshare_org():
     """Creates a CKAN organization (home of all linked figshare data)"""
@@ -42,31 +208,29 @@ def create_figshare_org():
     return org_dict
 
 
-def download_file(url, path, ret_sha256=False):
-    """Download (large) file without big memory footprint"""
-    if ret_sha256:
-        hasher = hashlib.sha256()
-    else:
-        hasher = None
-    path = pathlib.Path(path)
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with path.open('wb') as fd:
-            for chunk in r.iter_content(chunk_size=2**20):
-                fd.write(chunk)
-                if ret_sha256:
-                    hasher.update(chunk)
-    if ret_sha256:
-        return hasher.hexdigest()
-    else:
-        return None
+def figshare(limit=0, num_jobs=1, max_inflight_bytes=0,
+             stage_on_disk=False, download_segments=1, incremental=False):
+    """Import all datasets in figshare_links.txt
 
+    The files are downloaded, verified, and uploaded to S3 in a pool
+    of `num_jobs` threads, so that the next file is already being
+    downloaded while the previous file is uploaded. If
+    `max_inflight_bytes` is nonzero, the total size of the files being
+    processed at any time is limited to that number (which bounds the
+    memory and disk space used). All CKAN actions are performed in
+    the calling thread.
 
-def figshare(limit=0):
-    """Import all datasets in figshare_links.txt"""
+    By default, the files are streamed from figshare directly to S3.
+    If `stage_on_disk` is set, the files are downloaded to the
+    temporary directory first (see :func:`import_file`), with
+    `download_segments` parallel range requests for large files.
+
+    If `incremental` is set, the datasets that are already complete
+    (see :func:`find_complete_datasets`) are skipped without any
+    requests to figshare or CKAN actions.
+    """
     # prerequisites
-    create_figshare_org()
+    org_dict = create_figshare_org()
     # use pkg_resources to get list of figshare DOIs
     doifile = pkg_resources.resource_filename("ckanext.dcor_depot",
                                               "figshare_dois.txt")
@@ -77,48 +241,281 @@ def figshare(limit=0):
     if limit != 0:
         dois = dois[:limit]
 
+    # List the objects in the bucket of the figshare organization once
+    # instead of checking the existence of every object individually.
+    inventory = get_inventory(get_s3_bucket_name(org_dict["id"]))
+    budget = ByteBudget(max_inflight_bytes)
+    client = FigshareClient()
+
+    if incremental:
+        complete = find_complete_datasets(dois,
+                                          organization_id=org_dict["id"],
+                                          inventory=inventory,
+                                          client=client)
+        print(f"Skipping {len(complete)} of {len(dois)} complete datasets")
+        dois = [doi for doi in dois if doi not in complete]
+        for doi in dois:
+            # The database is authoritative; make sure incomplete
+            # datasets are not skipped in `submit_dataset`.
+            client.mark_imported(doi, imported=False)
+
+    # datasets whose files are being processed
+    pending = collections.deque()
+    failed = []
+
+    def finish_next():
+        doi, ds_dict, tasks = pending.popleft()
+        if ds_dict is None:
+            # nothing to do
+            return
+        try:
+            finish_dataset(ds_dict, tasks)
+            client.mark_imported(doi)
+        except KeyboardInterrupt:
+            raise
+        except BaseException:
+            print(f"Failed to import {doi}:\n{traceback.format_exc()}")
+            failed.append(doi)
+
+    try:
+        with ThreadPoolExecutor(max_workers=num_jobs) as pool:
+            for doi in dois:
+                try:
+                    pending.append(submit_dataset(
+                        doi,
+                        pool=pool,
+                        inventory=inventory,
+                        budget=budget,
+                        stage_on_disk=stage_on_disk,
+                        download_segments=download_segments,
+                        client=client))
+                except KeyboardInterrupt:
+                    raise
+                except BaseException:
+                    print(f"Failed to import {doi}:\n"
+                          f"{traceback.format_exc()}")
+                    failed.append(doi)
+                # Finish all datasets whose files have been processed
+                # and keep the number of pending datasets bounded.
+                while pending and (
+                        len(pending) > num_jobs
+                        or all(fut is None or fut.done()
+                               for _, fut in pending[0][2])):
+                    finish_next()
+            while pending:
+                finish_next()
+    finally:
+        inventory.save()
+        client.close()
+        metrics.flush()
+
+    if failed:
+        raise RuntimeError(f"Failed to import {len(failed)} figshare "
+                           f"dataset(s): {', '.join(failed)}")
+
+
+def find_complete_datasets(dois, organization_id, inventory, client):
+    """Return the set of DOIs whose datasets are complete
+
+    A dataset is complete if it is active and if all files in the
+    cached figshare metadata (see :class:`FigshareClient`) are
+    resources of the dataset that are available on S3. The state of
+    all datasets is determined with bulk database queries for the
+    datasets of the organization `organization_id` and with the
+    :class:`.inventory.BucketInventory` of its bucket. DOIs without
+    cached metadata are never complete.
+    """
+    # resource IDs marked as available on S3 for each active dataset
+    datasets = {}
+    for ds_dict, res_dicts in query.iter_dataset_resources(
+            query.get_dataset_ids(organization_id=organization_id)):
+        if ds_dict["state"] == "active":
+            datasets[ds_dict["id"]] = {res_dict["id"] for res_dict
+                                       in res_dicts
+                                       if query.is_s3_available(res_dict)}
+
+    complete = set()
     for doi in dois:
-        import_dataset(doi)
+        figshare_dict = client.get_cached_article(doi)
+        if figshare_dict is None:
+            continue
+        ds_id = get_dataset_id(figshare_dict)
+        if ds_id not in datasets:
+            continue
+        for res in figshare_dict["files"]:
+            if res["is_link_only"]:
+                continue
+            rid = make_id([ds_id, res["supplied_md5"]])
+            object_name = get_s3_object_name(rid)
+            if rid not in datasets[ds_id] or object_name not in inventory:
+                break
+        else:
+            complete.add(doi)
+    return complete
 
 
-def import_dataset(doi):
-    # Convert DOI to url
-    uid = doi.split(".")[-2]
-    ver = doi.split(".")[-1].strip("v ")
-    url = f"{FIGSHARE_BASE}/articles/{uid}/versions/{ver}"
-    # Get the JSON representation of the metadata
-    headers = {
-        "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; "
-                      "rv:146.0) Gecko/20100101 Firefox/146.0",
-        "Accept": "text/html,application/xhtml+xml,application/xml;"
-                  "q=0.9,*/*;q=0.8",
-        "Accept-Language": "en-US,en;q=0.5",
-        "DNT": "1",
-        "Connection": "keep-alive",
-        "Upgrade-Insecure-Requests": "1",
-        "Sec-Fetch-Dest": "document",
-        "Sec-Fetch-Mode": "navigate",
-        "Sec-Fetch-Site": "same-origin",
-        "Priority": "u=0, i",
-        "Pragma": "no-cache",
-        "Cache-Control": "no-cache",
-        "TE": "trailers",
-    }
-    # This did not work due to scraping detection on figshare
-    # req = requests.get(url, headers=headers)
-    # if not req.ok:
-    #     raise ConnectionError(f"Error accessing {url}: {req.reason}")
-    # figshare_dict = req.json()
-
-    req = urllib.request.Request(url)
-    for k, v in headers.items():
-        req.add_header(k, v)
-    r = urllib.request.urlopen(req)
-    if not r.status == 200:
-        raise ConnectionError(f"Error accessing {url}: {r.reason}")
-    data = r.read().decode("utf-8")
-
-    figshare_dict = json.loads(data)
+def finish_dataset(ds_dict, tasks):
+    """Add the resources to a dataset created by `submit_dataset`
+
+    This waits for all files of the dataset to be uploaded to S3,
+    appends the resources to the dataset in one go, and activates
+    the dataset.
+    """
+    res_dicts = []
+    for res_dict, future in tasks:
+        if future is not None:
+            # raises the exception of the worker thread
+            with metrics.timer("wait_for_workers"):
+                future.result()
+        res_dicts.append(res_dict)
+
+    # Make sure the resources are in the CKAN database
+    append_ckan_resources_to_active_dataset(dataset_id=ds_dict["id"],
+                                            res_dicts=res_dicts)
+
+    # activate the dataset
+    if ds_dict.get("state") != "active":
+        package_patch = logic.get_action("package_patch")
+        with metrics.timer("ckan_revise"):
+            package_patch(context=admin_context(),
+                          data_dict={"id": ds_dict["id"],
+                                     "state": "active"})
+    print(f"Done importing {ds_dict['name']}.")
+
+
+def import_dataset(doi, inventory=None):
+    """Import a figshare dataset
+
+    If an :class:`.inventory.BucketInventory` of the figshare
+    organization bucket is passed as `inventory`, it is used to check
+    whether a resource has already been uploaded to S3.
+    """
+    client = FigshareClient()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        _, ds_dict, tasks = submit_dataset(doi,
+                                           pool=pool,
+                                           inventory=inventory,
+                                           client=client)
+        if ds_dict is not None:
+            finish_dataset(ds_dict, tasks)
+            client.mark_imported(doi)
+    client.close()
+
+
+def import_file(res, path, bucket_name, object_name, private,
+                inventory=None, stage_on_disk=False, download_segments=1):
+    """Import a figshare file to S3
+
+    By default, the file is streamed from figshare to S3 (see
+    :func:`stream_file_to_s3`). If that fails due to a connection
+    error or if `stage_on_disk` is set, the file is downloaded to
+    `path` (resumable, see :func:`.download.download_file`), verified,
+    uploaded to S3, and removed from `path`.
+
+    This function does not access the CKAN database and is run
+    in a worker thread.
+    """
+    kwargs = {"bucket_name": bucket_name,
+              "object_name": object_name,
+              "private": private,
+              }
+    if not stage_on_disk:
+        print(f"Streaming {res['name']} to S3...")
+        try:
+            stream_file_to_s3(url=res["download_url"],
+                              md5=res["supplied_md5"],
+                              size=res.get("size"),
+                              **kwargs)
+        except (requests.RequestException,
+                urllib3.exceptions.HTTPError,
+                ConnectionError) as e:
+            print(f"Streaming {res['name']} failed ({e}), retrying via disk")
+            stage_on_disk = True
+
+    if stage_on_disk:
+        # download to and verify on disk
+        print(f"Downloading {res['name']}...")
+        sha256 = download_file(res["download_url"], path,
+                               ret_sha256=True,
+                               md5=res["supplied_md5"],
+                               size=res.get("size"),
+                               segments=download_segments)
+
+        # upload the resource to S3
+        print(f"Uploading to S3 {res['name']}...")
+        s3_util.upload_file(path=path, sha256=sha256, **kwargs)
+        # clean up
+        path.unlink()
+        try:
+            path.parent.rmdir()
+        except OSError:
+            # directory not empty
+            pass
+
+    if inventory is not None:
+        inventory.add(object_name, res.get("size"))
+
+
+def stream_file_to_s3(url, bucket_name, object_name, md5=None, size=None,
+                      private=True):
+    """Upload a file from a URL to S3 without staging it on disk
+
+    The HTTP response is read in parts that are hashed and uploaded
+    in a multipart upload (see :func:`.s3_util.upload_stream`), so
+    only one part is held in memory. If the MD5 sum `md5` or the
+    size `size` do not match, a ValueError is raised and the upload
+    is aborted.
+
+    Returns the SHA256 sum of the data.
+    """
+    with get_session().get(url, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        check_content_length(r, size)
+        # Let urllib3 decode gzip/deflate transfer encodings.
+        r.raw.decode_content = True
+        _, sha256 = s3_util.upload_stream(bucket_name=bucket_name,
+                                          object_name=object_name,
+                                          fd=r.raw,
+                                          private=private,
+                                          md5=md5,
+                                          size=size)
+    return sha256
+
+
+def submit_dataset(doi, pool, inventory=None, budget=None,
+                   stage_on_disk=False, download_segments=1, client=None):
+    """Create a figshare dataset and submit its files for import
+
+    The dataset is created as a draft in the calling thread and the
+    files that are not yet on S3 are submitted to the executor `pool`
+    via :func:`import_file` (with `stage_on_disk` and
+    `download_segments`). If a :class:`.util.ByteBudget` is given,
+    this function blocks until the size of each file fits into the
+    budget.
+
+    The metadata are fetched with the :class:`FigshareClient`
+    `client`. If the metadata did not change since the dataset was
+    imported completely, nothing is done.
+
+    Returns
+    -------
+    doi: str
+        The DOI
+    ds_dict: dict
+        The CKAN dataset dictionary (None if nothing is done)
+    tasks: list
+        List of tuples `(res_dict, future)`, where `res_dict` is
+        the resource dictionary to append to the dataset and
+        `future` is None if the file is already on S3
+    """
+    if client is None:
+        client = FigshareClient()
+    with metrics.timer("figshare_metadata"):
+        figshare_dict, unchanged, imported = client.get_article(doi)
+    if unchanged and imported:
+        print(f"Skipping {doi} (unchanged since last import)")
+        return doi, None, []
+
     # Convert the dictionary to DCOR and create draft
     ds_dict_figshare = map_figshare_to_dcor(figshare_dict)
 
@@ -126,76 +523,78 @@ def import_dataset(doi):
     package_create = logic.get_action("package_create")
 
     try:
-        ds_dict = package_show(context=admin_context(),
-                               data_dict={"id": ds_dict_figshare["name"]})
+        with metrics.timer("ckan_show"):
+            ds_dict = package_show(
+                context=admin_context(),
+                data_dict={"id": ds_dict_figshare["name"]})
     except logic.NotFound:
-        ds_dict = package_create(context=admin_context(),
-                                 data_dict=ds_dict_figshare)
+        with metrics.timer("ckan_create"):
+            ds_dict = package_create(context=admin_context(),
+                                     data_dict=ds_dict_figshare)
         assert ds_dict["id"] == ds_dict_figshare["id"]
     else:
         print(f"Skipping creation of {ds_dict['name']} (exists)")
 
     # Operate in a cache location
-    cache_loc = common.config.get("ckanext.dcor_depot.tmp_dir")
-    if not cache_loc:
-        cache_loc = None
-    else:
-        # Make sure the directory exists and don't panic when we cannot
-        # create it.
-        try:
-            pathlib.Path(cache_loc).mkdir(parents=True, exist_ok=True)
-        except BaseException:
-            cache_loc = None
-
-    if cache_loc is None:
-        cache_loc = tempfile.mkdtemp(prefix="ckanext-dcor_depot_")
+    cache_loc = get_tmp_dir()
+    bucket_name = get_s3_bucket_name(ds_dict["organization"]["id"])
 
     # Download/Import the resources
+    tasks = []
     for res in figshare_dict["files"]:
         if not res["is_link_only"]:
             rid = make_id([ds_dict["id"], res["supplied_md5"]])
+            res_dict = {"id": rid,
+                        "name": res["name"],
+                        "s3_available": True,
+                        }
 
             # Make sure the resource is on S3
-            bucket_name = common.config[
-                "dcor_object_store.bucket_name"].format(
-                organization_id=ds_dict["organization"]["id"])
-            object_name = f"resource/{rid[:3]}/{rid[3:6]}/{rid[6:]}"
-            if s3.object_exists(bucket_name=bucket_name,
-                                object_name=object_name):
+            object_name = get_s3_object_name(rid)
+            if inventory is not None:
+                obj_exists = object_name in inventory
+            else:
+                with metrics.timer("s3_exists"):
+                    obj_exists = s3.object_exists(bucket_name=bucket_name,
+                                                  object_name=object_name)
+            if obj_exists:
                 print(f"Resource {res['name']} already on S3")
+                future = None
             else:
-                # download to and/or verify on disk
-                print(f"Downloading {res['name']}...")
-                dlpath = pathlib.Path(cache_loc) / doi / res["name"]
-                sha256 = download_file(res["download_url"], dlpath,
-                                       ret_sha256=True)
-                check_md5(dlpath, res["supplied_md5"])
-
-                # upload the resource to S3
-                print(f"Uploading to S3 {res['name']}...")
-                s3.upload_file(
-                    bucket_name=bucket_name,
-                    object_name=object_name,
-                    path=dlpath,
-                    sha256=sha256,
-                    private=ds_dict["private"],
-                )
-
-            # Make sure the resource is in the CKAN database
-            append_ckan_resource_to_active_dataset(
-                dataset_id=ds_dict["id"],
-                res_dict={"id": rid,
-                          "name": res["name"],
-                          "s3_available": True,
-                          }
-            )
+                with metrics.timer("wait_for_budget"):
+                    reserved = (budget.acquire(res.get("size", 0))
+                                if budget is not None else 0)
+                future = pool.submit(import_file,
+                                     res=res,
+                                     path=cache_loc / doi / res["name"],
+                                     bucket_name=bucket_name,
+                                     object_name=object_name,
+                                     private=ds_dict["private"],
+                                     inventory=inventory,
+                                     stage_on_disk=stage_on_disk,
+                                     download_segments=download_segments)
+                if budget is not None:
+                    future.add_done_callback(
+                        lambda _, num=reserved: budget.release(num))
+            tasks.append((res_dict, future))
+    return doi, ds_dict, tasks
 
-    # activate the dataset
-    package_patch = logic.get_action("package_patch")
-    package_patch(context=admin_context(),
-                  data_dict={"id": ds_dict["id"],
-                             "state": "active"})
-    print("Done.")
+
+def parse_doi(doi):
+    """Return the figshare article ID and version of a figshare DOI"""
+    uid = doi.split(".")[-2]
+    ver = doi.split(".")[-1].strip("v ")
+    return uid, ver
+
+
+def get_dataset_id(figs):
+    """Return the CKAN dataset ID for figshare metadata"""
+    return make_id([figs["doi"], get_dataset_name(figs)])
+
+
+def get_dataset_name(figs):
+    """Return the CKAN dataset name for figshare metadata"""
+    return f"figshare-{figs['id']}-v{figs['version']}"
 
 
 def map_figshare_to_dcor(figs):
@@ -221,10 +620,10 @@ def map_figshare_to_dcor(figs):
         author_list.append(item["full_name"])
     dcor["authors"] = ", ".join(author_list)
     dcor["doi"] = figs["doi"]
-    dcor["name"] = f"figshare-{figs['id']}-v{figs['version']}"
+    dcor["name"] = get_dataset_name(figs)
     dcor["organization"] = {"id": FIGSHARE_ORG}
     # markdownify and remove escapes "\_" with "_" (figshare-7771184-v2)
     dcor["notes"] = html2text(figs["description"]).replace(r"\_",
                                                            r"_")
-    dcor["id"] = make_id([dcor["doi"], dcor["name"]])
+    dcor["id"] = get_dataset_id(figs)
     return dcor
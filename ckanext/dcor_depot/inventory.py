@@ -0,0 +1,181 @@
+"""Local index of the objects in the S3 buckets of DCOR
+
+Checking the existence of many objects with one HEAD request each
+is slow. A :class:`BucketInventory` is built from a paginated listing
+of the bucket (1000 objects per request) and cached on disk, so that
+depot commands can answer "is this artifact present?" from memory.
+"""
+import gzip
+import json
+import os
+import pathlib
+import threading
+import time
+
+from dcor_shared import s3
+
+from .util import get_tmp_dir
+
+
+#: Default time in seconds after which an inventory is considered stale
+INVENTORY_TTL = 3600
+
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+
+class BucketInventory:
+    """Index of the objects in an S3 bucket
+
+    For every object, the size, the ETag and the last modification
+    time (seconds since epoch) are stored. The index is persisted in
+    `cache_dir` (defaults to :func:`.util.get_tmp_dir`) and considered
+    stale after `ttl` seconds.
+    """
+
+    def __init__(self, bucket_name, cache_dir=None, ttl=INVENTORY_TTL):
+        self.bucket_name = bucket_name
+        self.ttl = ttl
+        if cache_dir is None:
+            cache_dir = get_tmp_dir() / "inventory"
+        self.path = pathlib.Path(cache_dir) / f"{bucket_name}.json.gz"
+        #: dictionary with object names as keys and tuples
+        #: (size, etag, last_modified) as values
+        self.objects = {}
+        #: time of the last full refresh
+        self.timestamp = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, object_name):
+        return object_name in self.objects
+
+    def __len__(self):
+        return len(self.objects)
+
+    @property
+    def is_fresh(self):
+        return time.time() - self.timestamp < self.ttl
+
+    def add(self, object_name, size, etag=None, last_modified=None):
+        """Add an object (e.g. after uploading it)"""
+        if last_modified is None:
+            last_modified = time.time()
+        self.objects[object_name] = (size, etag, last_modified)
+
+    def discard(self, object_name):
+        """Remove an object (e.g. after deleting it)"""
+        self.objects.pop(object_name, None)
+
+    def exists(self, object_name, size=None):
+        """Return True if the object is in the inventory
+
+        If `size` is given, the size of the object must match as well.
+        """
+        entry = self.objects.get(object_name)
+        if entry is None:
+            return False
+        return size is None or entry[0] == size
+
+    def get(self, object_name):
+        """Return a dictionary with "size", "etag", and "last_modified"
+
+        Returns None if the object is not in the inventory.
+        """
+        entry = self.objects.get(object_name)
+        if entry is None:
+            return None
+        return dict(zip(["size", "etag", "last_modified"], entry))
+
+    def iter_objects(self, prefix=""):
+        """Iterate over the names of the objects starting with `prefix`"""
+        for object_name in list(self.objects.keys()):
+            if object_name.startswith(prefix):
+                yield object_name
+
+    def load(self):
+        """Load the inventory from disk; returns True on success"""
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as fd:
+                data = json.load(fd)
+            objects = {key: tuple(val) for key, val in data["objects"].items()}
+            timestamp = data["timestamp"]
+        except (OSError, ValueError, KeyError, TypeError, EOFError):
+            return False
+        with self._lock:
+            self.objects = objects
+            self.timestamp = timestamp
+        return True
+
+    def refresh(self, prefix=""):
+        """Refresh the inventory from a paginated bucket listing
+
+        If `prefix` is given, only the objects starting with `prefix`
+        are refreshed (e.g. "resource/" or "condensed/ab1/"). Otherwise,
+        the entire inventory is rebuilt. The inventory is saved to disk
+        afterward.
+        """
+        listed = {}
+        for obj in iter_bucket_listing(self.bucket_name, prefix=prefix):
+            listed[obj["Key"]] = (obj["Size"],
+                                  obj.get("ETag", "").strip('"') or None,
+                                  obj["LastModified"].timestamp())
+        with self._lock:
+            if prefix:
+                for object_name in list(self.iter_objects(prefix)):
+                    self.objects.pop(object_name)
+                self.objects.update(listed)
+            else:
+                self.objects = listed
+                self.timestamp = time.time()
+        self.save()
+
+    def save(self):
+        """Write the inventory to disk"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        path_tmp = self.path.with_name(self.path.name + ".tmp")
+        with self._lock:
+            data = {"bucket": self.bucket_name,
+                    "timestamp": self.timestamp,
+                    "objects": dict(self.objects),
+                    }
+        with gzip.open(path_tmp, "wt", encoding="utf-8") as fd:
+            json.dump(data, fd)
+        # atomic replacement, so other processes never see partial files
+        os.replace(path_tmp, self.path)
+
+
+def get_inventory(bucket_name, ttl=INVENTORY_TTL):
+    """Return an up-to-date :class:`BucketInventory` for a bucket
+
+    Inventories are cached in memory and on disk. A full bucket
+    listing is only performed if the inventory is older than `ttl`
+    seconds.
+    """
+    with _inventories_lock:
+        inv = _inventories.get(bucket_name)
+        if inv is None:
+            inv = BucketInventory(bucket_name, ttl=ttl)
+            inv.load()
+            _inventories[bucket_name] = inv
+        inv.ttl = ttl
+        if not inv.is_fresh:
+            inv.refresh()
+    return inv
+
+
+def iter_bucket_listing(bucket_name, prefix=""):
+    """Iterate over all objects in a bucket using `list_objects_v2`
+
+    Yields the dictionaries returned by S3 (with the keys "Key",
+    "Size", "ETag", and "LastModified"). If the bucket does not
+    exist, nothing is yielded.
+    """
+    s3_client, _, _ = s3.get_s3()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    try:
+        for page in paginator.paginate(Bucket=bucket_name,
+                                       Prefix=prefix,
+                                       PaginationConfig={"PageSize": 1000}):
+            yield from page.get("Contents", [])
+    except s3_client.exceptions.NoSuchBucket:
+        return
@@ -1,18 +1,53 @@
+import datetime
 import logging
 import os
 import pathlib
+import time
 import warnings
 
-from ckan import logic
+from ckan import logic, model
+import ckan.lib.jobs as ckan_jobs
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins import toolkit
 from dcor_shared import (
-    get_ckan_storage_path, rqjob_register, s3, s3cc, sha256sum,
-    wait_for_resource,
+    get_ckan_config_option, get_ckan_storage_path, is_resource_private,
+    s3, s3cc, wait_for_resource,
 )
-from dcor_shared import RQJob  # noqa: F401
+import rq
+
+from .checksum_cache import get_checksum_cache
+from . import metrics
+from . import s3_util
+from .util import get_s3_bucket_name, get_s3_object_name
 
 
 log = logging.getLogger(__name__)
 
+#: Default queue for migrating small files to S3 (see
+#: :func:`get_migration_queue`)
+MIGRATION_QUEUE_SMALL = "dcor-short"
+#: Default queue for migrating large files to S3
+MIGRATION_QUEUE_BULK = "dcor-normal"
+#: Default size threshold in bytes for routing migrations to the bulk queue
+MIGRATION_SIZE_THRESHOLD = 100 * 1024**2
+#: Expiration time in seconds of the redis keys for coalescing migrations
+MIGRATION_KEY_TTL = 24 * 3600
+#: Redis key for the set of resource IDs of a dataset pending migration
+MIGRATION_PENDING_KEY = \
+    "ckanext-dcor_depot:migrate:{package_id}:{queue}:pending"
+#: Redis key that is set while a migration job is queued for a dataset
+MIGRATION_QUEUED_KEY = \
+    "ckanext-dcor_depot:migrate:{package_id}:{queue}:queued"
+#: Number of times the migration of resources that are not ready is deferred
+MIGRATION_MAX_ATTEMPTS = 10
+#: Initial delay in seconds before migrating resources that were not ready
+MIGRATION_RETRY_DELAY = 10
+#: Maximum delay in seconds before migrating resources that were not ready
+MIGRATION_MAX_DELAY = 300
+#: Maximum time in seconds a worker is blocked by a deferred job that
+#: was started too early (only if no RQ scheduler is used)
+MIGRATION_MAX_BLOCK = 2
+
 
 class NoSHA256Available(UserWarning):
     """Used for missing SHA256 sums"""
@@ -31,10 +66,9 @@ def get_resource_path(resource_id, create_dirs=False):
     warnings.warn("`get_resource_path` should not be used since DCOR moved "
                   "to storing data solely on S3",
                   DeprecationWarning)
-    rid = resource_id
-    resources_path = get_ckan_storage_path() / "resources"
-    pdir = resources_path / rid[:3] / rid[3:6]
-    path = pdir / rid[6:]
+    path = get_depot_path(resource_id)
+    pdir = path.parent
+    resources_path = pdir.parent.parent
     if create_dirs:
         try:
             pdir.mkdir(parents=True, exist_ok=True)
@@ -47,20 +81,356 @@ def get_resource_path(resource_id, create_dirs=False):
     return pathlib.Path(path)
 
 
+def get_depot_path(resource_id):
+    """Return the path of a resource on block storage (may not exist)"""
+    rid = resource_id
+    resources_path = get_ckan_storage_path() / "resources"
+    return resources_path / rid[:3] / rid[3:6] / rid[6:]
+
+
+def enqueue_migration(resource):
+    """Enqueue the migration of a resource to S3
+
+    Nothing is enqueued if there is no file for the resource on block
+    storage. Otherwise, the resource ID is added to the set of pending
+    resources of its dataset in redis (which deduplicates resource IDs)
+    and a :func:`job_migrate_dataset_resources_to_s3` job is enqueued,
+    unless such a job is already queued for that dataset. Thus, many
+    resources created in a short period of time are migrated by a
+    single job. The queue depends on the file size (see
+    :func:`get_migration_queue`).
+
+    Returns True if a new job was enqueued.
+    """
+    rid = resource["id"]
+    package_id = resource["package_id"]
+    try:
+        size = get_depot_path(rid).stat().st_size
+    except FileNotFoundError:
+        return False
+    queue = get_migration_queue(size)
+
+    pending_key = MIGRATION_PENDING_KEY.format(package_id=package_id,
+                                               queue=queue)
+    queued_key = MIGRATION_QUEUED_KEY.format(package_id=package_id,
+                                             queue=queue)
+    redis_conn = connect_to_redis()
+    pipe = redis_conn.pipeline()
+    pipe.sadd(pending_key, rid)
+    pipe.expire(pending_key, MIGRATION_KEY_TTL)
+    pipe.set(queued_key, "1", nx=True, ex=MIGRATION_KEY_TTL)
+    enqueue = bool(pipe.execute()[-1])
+    if enqueue:
+        try:
+            enqueue_migration_job(package_id=package_id, queue=queue)
+        except BaseException:
+            redis_conn.delete(queued_key)
+            raise
+    return enqueue
+
+
+def enqueue_migration_job(package_id, queue, attempt=0, first_enqueued=None,
+                          not_before=None):
+    """Enqueue a :func:`job_migrate_dataset_resources_to_s3` job
+
+    If `not_before` (UNIX time) is given, the job should not start
+    before that time. If `ckanext.dcor_depot.rq_scheduler` is set (an
+    RQ scheduler is running for the migration queues, e.g.
+    `rq worker --with-scheduler`), the job is scheduled with
+    `enqueue_at`. Otherwise, it is enqueued right away and `not_before`
+    is passed to the job (and stored in the job metadata); a job that
+    is started too early enqueues itself again.
+    """
+    kwargs = {"queue": queue}
+    if attempt:
+        kwargs["attempt"] = attempt
+        kwargs["first_enqueued"] = first_enqueued
+    title = "Migrate dataset resources to S3"
+    if not_before is not None and toolkit.asbool(
+            get_ckan_config_option("ckanext.dcor_depot.rq_scheduler")
+            or False):
+        ckan_jobs.get_queue(queue).enqueue_at(
+            datetime.datetime.fromtimestamp(not_before,
+                                            tz=datetime.timezone.utc),
+            job_migrate_dataset_resources_to_s3,
+            args=[package_id],
+            kwargs=kwargs,
+            job_timeout=3600,
+            meta={"title": title})
+    else:
+        rq_kwargs = {"timeout": 3600}
+        if not_before is not None:
+            kwargs["not_before"] = not_before
+            rq_kwargs["meta"] = {"dcor_depot": {"not_before": not_before}}
+        toolkit.enqueue_job(job_migrate_dataset_resources_to_s3,
+                            [package_id],
+                            kwargs,
+                            title=title,
+                            queue=queue,
+                            rq_kwargs=rq_kwargs)
+
+
+def defer_migration(package_id, resource_ids, queue, attempt,
+                    first_enqueued):
+    """Migrate resources that are not yet ready in a later job
+
+    The resource IDs are put back into the set of pending resources
+    and, unless a job is already queued for the dataset, a new job
+    is enqueued that does not start before an exponentially increasing
+    delay has passed (see :func:`enqueue_migration_job`). Workers are
+    not blocked while waiting.
+
+    After :const:`MIGRATION_MAX_ATTEMPTS` attempts (about half an
+    hour), no new job is enqueued and an error is logged. The resources
+    are not dropped; they remain in the set of pending resources and
+    are migrated by the next migration job of the dataset (or by
+    `ckan dcor-migrate-resources-to-object-store`). Returns True if
+    the migration was deferred.
+    """
+    pending_key = MIGRATION_PENDING_KEY.format(package_id=package_id,
+                                               queue=queue)
+    queued_key = MIGRATION_QUEUED_KEY.format(package_id=package_id,
+                                             queue=queue)
+    redis_conn = connect_to_redis()
+    pipe = redis_conn.pipeline()
+    pipe.sadd(pending_key, *resource_ids)
+    pipe.expire(pending_key, MIGRATION_KEY_TTL)
+    if attempt > MIGRATION_MAX_ATTEMPTS:
+        pipe.execute()
+        log.error(f"Resources {resource_ids} of dataset {package_id} not "
+                  f"ready after {MIGRATION_MAX_ATTEMPTS} attempts, keeping "
+                  f"them pending for the next migration job")
+        return False
+    pipe.set(queued_key, "1", nx=True, ex=MIGRATION_KEY_TTL)
+    if not pipe.execute()[-1]:
+        # The job that is already queued takes care of these resources.
+        return True
+
+    delay = min(MIGRATION_RETRY_DELAY * 2**(attempt - 1),
+                MIGRATION_MAX_DELAY)
+    try:
+        enqueue_migration_job(package_id=package_id,
+                              queue=queue,
+                              attempt=attempt,
+                              first_enqueued=first_enqueued,
+                              not_before=time.time() + delay)
+    except BaseException:
+        redis_conn.delete(queued_key)
+        raise
+    log.info(f"Deferred migration of {len(resource_ids)} resources of "
+             f"dataset {package_id} by {delay} s (attempt {attempt})")
+    return True
+
+
+def get_migration_queue(size):
+    """Return the name of the queue for migrating a file of `size` bytes
+
+    Files smaller than `ckanext.dcor_depot.queue_size_threshold` are
+    migrated in the queue `ckanext.dcor_depot.queue_small`, larger
+    files in `ckanext.dcor_depot.queue_bulk`.
+    """
+    threshold = int(get_ckan_config_option(
+        "ckanext.dcor_depot.queue_size_threshold")
+        or MIGRATION_SIZE_THRESHOLD)
+    if size < threshold:
+        queue = (get_ckan_config_option("ckanext.dcor_depot.queue_small")
+                 or MIGRATION_QUEUE_SMALL)
+    else:
+        queue = (get_ckan_config_option("ckanext.dcor_depot.queue_bulk")
+                 or MIGRATION_QUEUE_BULK)
+    return queue
+
+
+def get_resource_state(resource_id):
+    """Return the state of a resource in the database
+
+    Returns None if the resource is not (yet) in the database, e.g.
+    because the transaction that creates it has not been committed.
+    This is a non-blocking alternative to
+    :func:`dcor_shared.wait_for_resource`.
+    """
+    with metrics.timer("db_query"):
+        resource = model.Resource.get(resource_id)
+    if resource is None:
+        return None
+    return resource.state
+
+
+def job_migrate_dataset_resources_to_s3(package_id,
+                                        queue=MIGRATION_QUEUE_BULK,
+                                        attempt=0, first_enqueued=None,
+                                        not_before=None):
+    """Migrate the pending resources of a dataset to the S3 object store
+
+    The resource IDs are taken from the set of pending resources
+    populated by :func:`enqueue_migration`. All resources are patched
+    with one `package_revise` call. Resources that are not yet in the
+    database are handled by a later job (see :func:`defer_migration`)
+    instead of blocking the worker. The time spent waiting and working
+    is logged and stored in the job metadata (see
+    :func:`record_job_timing`). Returns the number of uploads
+    performed.
+
+    If the migration of a resource fails, the other resources are
+    migrated and patched nonetheless. The resources that were not
+    migrated are put back into the set of pending resources (see
+    :func:`restore_pending_migration`) and the job fails, so that
+    requeueing it retries them.
+
+    A deferred job that is started before `not_before` (UNIX time)
+    waits at most :const:`MIGRATION_MAX_BLOCK` seconds and then
+    enqueues itself again (see :func:`enqueue_migration_job`).
+    """
+    t0 = time.time()
+    if not s3.is_available():
+        log.info("S3 not available, not migrating resources")
+        return 0
+
+    if not_before is not None and not_before > t0:
+        time.sleep(min(not_before - t0, MIGRATION_MAX_BLOCK))
+        if not_before > time.time():
+            try:
+                enqueue_migration_job(package_id=package_id,
+                                      queue=queue,
+                                      attempt=attempt,
+                                      first_enqueued=first_enqueued,
+                                      not_before=not_before)
+            except BaseException:
+                # Allow the next new resource to enqueue a job.
+                connect_to_redis().delete(MIGRATION_QUEUED_KEY.format(
+                    package_id=package_id, queue=queue))
+                raise
+            return 0
+        t0 = time.time()
+
+    pending_key = MIGRATION_PENDING_KEY.format(package_id=package_id,
+                                               queue=queue)
+    queued_key = MIGRATION_QUEUED_KEY.format(package_id=package_id,
+                                             queue=queue)
+    redis_conn = connect_to_redis()
+    # Resources that are added from now on will be handled by a new job.
+    redis_conn.delete(queued_key)
+    pipe = redis_conn.pipeline(transaction=True)
+    pipe.smembers(pending_key)
+    pipe.delete(pending_key)
+    members = pipe.execute()[0]
+    rids = sorted(m.decode("utf-8") if isinstance(m, bytes) else m
+                  for m in members)
+
+    # Resource IDs that are put back into the pending set if this job
+    # fails, so that requeueing the job retries them.
+    unfinished = set(rids)
+    ready = []
+    not_ready = []
+    failed = []
+    num_uploads = 0
+    try:
+        for rid in rids:
+            state = get_resource_state(rid)
+            if state is None:
+                not_ready.append(rid)
+            elif state != "deleted":
+                ready.append(rid)
+            else:
+                unfinished.discard(rid)
+        if not_ready:
+            defer_migration(package_id=package_id,
+                            resource_ids=not_ready,
+                            queue=queue,
+                            attempt=attempt + 1,
+                            first_enqueued=first_enqueued or t0)
+            unfinished.difference_update(not_ready)
+
+        if ready:
+            package_show = logic.get_action("package_show")
+            with metrics.timer("ckan_show"):
+                ds_dict = package_show(context=admin_context(),
+                                       data_dict={"id": package_id})
+            resources = {res_dict["id"]: res_dict
+                         for res_dict in ds_dict["resources"]}
+            bucket_name = get_s3_bucket_name(ds_dict["owner_org"])
+
+            patches = {}
+            for rid in ready:
+                path = get_depot_path(rid)
+                if rid not in resources or not path.exists():
+                    unfinished.discard(rid)
+                    continue
+                try:
+                    s3_url, performed_upload = upload_depot_file(
+                        resource_id=rid,
+                        path=path,
+                        bucket_name=bucket_name,
+                        sha256=resources[rid].get("sha256"),
+                        private=ds_dict["private"])
+                except KeyboardInterrupt:
+                    raise
+                except BaseException:
+                    # Migrate the other resources anyway.
+                    log.exception(f"Failed to migrate resource {rid} to S3")
+                    failed.append(rid)
+                    continue
+                num_uploads += performed_upload
+                patches[rid] = {"s3_available": True, "s3_url": s3_url}
+
+            patch_resources_noauth(package_id=package_id,
+                                   resource_patches=patches)
+            unfinished.difference_update(patches)
+
+        if failed:
+            raise RuntimeError(f"Failed to migrate resources {failed} of "
+                               f"dataset {package_id} to S3")
+    except BaseException:
+        restore_pending_migration(package_id=package_id,
+                                  resource_ids=unfinished,
+                                  queue=queue)
+        raise
+    finally:
+        record_job_timing(package_id=package_id,
+                          ready_wait_time=(t0 - first_enqueued
+                                           if first_enqueued else 0.),
+                          work_time=time.time() - t0,
+                          attempt=attempt,
+                          num_ready=len(ready),
+                          num_deferred=len(not_ready),
+                          num_failed=len(failed),
+                          num_uploads=num_uploads)
+        metrics.flush()
+    return num_uploads
+
+
 def patch_resource_noauth(package_id, resource_id, data_dict):
     """Patch a resource using package_revise"""
+    patch_resources_noauth(package_id=package_id,
+                           resource_patches={resource_id: data_dict})
+
+
+def patch_resources_noauth(package_id, resource_patches, context=None):
+    """Patch multiple resources of a dataset with one package_revise call
+
+    `resource_patches` is a dictionary with resource IDs as keys and
+    the data dictionaries to patch the resources with as values.
+    Since the dataset is validated and indexed only once, this is
+    much faster than patching the resources one by one.
+    """
+    if not resource_patches:
+        return
     package_revise = logic.get_action("package_revise")
-    revise_dict = {"match": {"id": package_id},
-                   f"update__resources__{resource_id}": data_dict}
-    package_revise(context=admin_context(), data_dict=revise_dict)
+    revise_dict = {"match": {"id": package_id}}
+    for resource_id, data_dict in resource_patches.items():
+        revise_dict[f"update__resources__{resource_id}"] = data_dict
+    with metrics.timer("ckan_revise"):
+        package_revise(context=context or admin_context(),
+                       data_dict=revise_dict)
 
 
-@rqjob_register(ckanext="dcor_depot",
-                queue="dcor-normal",
-                timeout=3600,
-                )
 def job_migrate_resource_to_s3(resource):
-    """Migrate a resource to the S3 object store"""
+    """Migrate a resource to the S3 object store
+
+    This is not registered as a background job anymore (new resources
+    are migrated by :func:`job_migrate_dataset_resources_to_s3`), but
+    it is still used by the `run-jobs-dcor-depot` command.
+    """
     if not s3.is_available():
         log.info("S3 not available, not migrating resource")
         return False
@@ -68,32 +438,27 @@ def job_migrate_resource_to_s3(resource):
     performed_upload = False
     rid = resource["id"]
     # Make sure the resource is available for processing
-    wait_for_resource(rid)
+    if rq.get_current_job() is None:
+        # not running in a worker (e.g. `ckan run-jobs-dcor-depot`)
+        with metrics.timer("wait_for_resource"):
+            wait_for_resource(rid)
+    elif get_resource_state(rid) is None:
+        # Don't block the worker; the dataset migration job defers
+        # the migration until the resource is ready.
+        enqueue_migration(resource)
+        return False
     path = get_resource_path(rid)
 
     # Only attempt to upload if the file has been uploaded to block storage.
     if path.exists():
-        sha256 = resource.get("sha256")
-        if sha256 is None:
-            warnings.warn(f"Resource {rid} has no SHA256 sum yet and I will "
-                          f"compute it now. This should not happen unless you "
-                          f"are running pytest with synchronous jobs!",
-                          NoSHA256Available)
-            sha256 = sha256sum(path)
-
-        # Tell whether we have to perform an upload.
-        if not s3cc.artifact_exists(rid, "resource"):
-            performed_upload = True
-
-        # Perform the upload (if necessary), returning the URL
-        s3_url = s3cc.upload_artifact(
+        bucket_name, _ = s3cc.get_s3_bucket_object_for_artifact(
+            rid, artifact="resource")
+        s3_url, performed_upload = upload_depot_file(
             resource_id=rid,
-            path_artifact=path,
-            artifact="resource",
-            # avoid an empty SHA256 string being passed to the method
-            sha256=sha256,
-            override=False,
-        )
+            path=path,
+            bucket_name=bucket_name,
+            sha256=resource.get("sha256"),
+            private=is_resource_private(rid))
 
         # Set the S3 URL in the resource metadata
         patch_resource_noauth(
@@ -103,4 +468,89 @@ def job_migrate_resource_to_s3(resource):
                 "s3_available": True,
                 "s3_url": s3_url})
 
+    metrics.flush()
     return performed_upload
+
+
+def record_job_timing(**kwargs):
+    """Log timing information and store it in the metadata of the RQ job
+
+    The keyword arguments are stored in the "dcor_depot" entry of the
+    job metadata together with the time the job waited in the queue
+    ("queue_wait_time").
+    """
+    job = rq.get_current_job()
+    if job is not None and job.enqueued_at and job.started_at:
+        kwargs["queue_wait_time"] = (job.started_at
+                                     - job.enqueued_at).total_seconds()
+    log.info("Migration job timing: " + ", ".join(
+        f"{key}={val:.3f}" if isinstance(val, float) else f"{key}={val}"
+        for key, val in kwargs.items()))
+    if job is not None:
+        job.meta.setdefault("dcor_depot", {}).update(kwargs)
+        job.save_meta()
+
+
+def restore_pending_migration(package_id, resource_ids, queue):
+    """Put resource IDs back into the set of pending resources
+
+    The resources are migrated by the next
+    :func:`job_migrate_dataset_resources_to_s3` job for the dataset
+    (e.g. when the failed job is requeued).
+    """
+    if not resource_ids:
+        return
+    pending_key = MIGRATION_PENDING_KEY.format(package_id=package_id,
+                                               queue=queue)
+    redis_conn = connect_to_redis()
+    pipe = redis_conn.pipeline()
+    pipe.sadd(pending_key, *resource_ids)
+    pipe.expire(pending_key, MIGRATION_KEY_TTL)
+    pipe.execute()
+
+
+def upload_depot_file(resource_id, path, bucket_name, sha256=None,
+                      private=True):
+    """Upload a resource file from block storage to S3
+
+    The upload is skipped if the object already exists.
+
+    Returns
+    -------
+    s3_url: str
+        URL of the S3 object
+    performed_upload: bool
+        Whether the file was uploaded
+    """
+    rid = resource_id
+    cache = get_checksum_cache()
+    stat = os.stat(path)
+    sha256 = sha256 or cache.get(path, stat=stat)
+    if sha256 is None:
+        warnings.warn(f"Resource {rid} has no SHA256 sum yet and I will "
+                      f"compute it during the upload. This should not "
+                      f"happen unless you are running pytest with "
+                      f"synchronous jobs!",
+                      NoSHA256Available)
+
+    object_name = get_s3_object_name(rid)
+    # Tell whether we have to perform an upload.
+    with metrics.timer("s3_exists"):
+        exists = s3.object_exists(bucket_name=bucket_name,
+                                  object_name=object_name)
+    if exists:
+        return s3_util.get_s3_url(bucket_name, object_name), False
+
+    # Hash and upload the resource in one pass
+    s3_url, sha256_upload = s3_util.upload_file(
+        bucket_name=bucket_name,
+        object_name=object_name,
+        path=path,
+        # avoid an empty SHA256 string being passed to the method
+        sha256=sha256 or None,
+        private=private,
+        override=True,
+    )
+    if not sha256:
+        cache.set(path, sha256_upload, stat=stat)
+    return s3_url, True
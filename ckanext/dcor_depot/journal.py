@@ -0,0 +1,125 @@
+"""Checkpoint journal for resumable resource migration"""
+import hashlib
+import json
+import os
+import pathlib
+import threading
+import time
+
+
+class MigrationJournal:
+    """Append-only checkpoint journal
+
+    Every completed action (e.g. "uploaded", "verified", "deleted")
+    for an artifact of a resource is written as one JSON line to
+    `path`. When `resume` is True, the existing journal is loaded
+    and :func:`is_done` can be used to skip finished items. When
+    `resume` is False, an existing journal is discarded if the run
+    that wrote it completed (see :func:`finish`); otherwise a
+    FileExistsError is raised, so that an interrupted run is not
+    lost by accident.
+
+    Lines that cannot be parsed (e.g. a line that was only partially
+    written when the process was killed) are ignored.
+    """
+
+    def __init__(self, path: str | pathlib.Path, resume: bool = False):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        #: dictionary with (resource_id, artifact) tuples as keys and
+        #: sets of completed actions as values
+        self.done = {}
+        #: whether the run that wrote the journal completed
+        self.finished = False
+        self._lock = threading.Lock()
+        if self.path.exists() and not resume:
+            self._load()
+            if self.done and not self.finished:
+                raise FileExistsError(
+                    f"Found the journal {self.path} of an unfinished run; "
+                    f"resume it or delete the journal!")
+            self.done.clear()
+        if resume and self.path.exists():
+            self._load()
+            # Make sure a partially written line from a previous run
+            # does not swallow the first new entry.
+            with self.path.open("rb") as fd:
+                fd.seek(0, os.SEEK_END)
+                if fd.tell():
+                    fd.seek(-1, os.SEEK_END)
+                    needs_newline = fd.read(1) != b"\n"
+                else:
+                    needs_newline = False
+            self._fd = self.path.open("a", encoding="utf-8")
+            if needs_newline:
+                self._fd.write("\n")
+        else:
+            self._fd = self.path.open("w", encoding="utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _load(self):
+        with self.path.open("r", encoding="utf-8", errors="replace") as fd:
+            for line in fd:
+                try:
+                    entry = json.loads(line)
+                    key = (entry["rid"], entry["artifact"])
+                    action = entry["action"]
+                except (ValueError, KeyError, TypeError):
+                    # partially written or otherwise broken line
+                    continue
+                self.done.setdefault(key, set()).add(action)
+                # only the last entry counts
+                self.finished = action == "finished"
+
+    def close(self):
+        with self._lock:
+            if not self._fd.closed:
+                self._fd.close()
+
+    def finish(self):
+        """Mark the run as completed
+
+        A finished journal may be overwritten by a new run
+        (with `resume` set to False).
+        """
+        self.record("*", "*", "finished")
+
+    def is_done(self, resource_id: str, artifact: str, actions):
+        """Return True if any of `actions` was recorded for an artifact"""
+        recorded = self.done.get((resource_id, artifact))
+        return bool(recorded) and not recorded.isdisjoint(actions)
+
+    def record(self, resource_id: str, artifact: str, action: str):
+        """Record a completed action for an artifact of a resource
+
+        Use the artifact "*" to mark a resource as completely processed.
+        The entry is flushed to disk immediately.
+        """
+        entry = {"rid": resource_id,
+                 "artifact": artifact,
+                 "action": action,
+                 "time": time.time(),
+                 }
+        with self._lock:
+            self._fd.write(json.dumps(entry) + "\n")
+            self._fd.flush()
+            os.fsync(self._fd.fileno())
+            self.done.setdefault((resource_id, artifact), set()).add(action)
+            self.finished = action == "finished"
+
+
+def get_journal_path(directory, name, **params):
+    """Return the path of a journal for a command with parameters
+
+    Runs with different `params` (e.g. filters or verification
+    options) get different journals, so they can be resumed
+    independently.
+    """
+    digest = hashlib.md5(
+        json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+    return pathlib.Path(directory) / f"{name}_{digest[:12]}.jsonl"
@@ -0,0 +1,228 @@
+"""Timing and byte-count instrumentation of depot operations
+
+The time spent in the phases of an operation (database queries,
+hashing, S3 existence checks, uploads, CKAN updates, ...) is
+accumulated with :func:`timer` and the amount of data processed
+with :func:`add_bytes`::
+
+    with metrics.timer("s3_upload"):
+        ...
+    metrics.add_bytes("uploaded", size)
+
+Instrumentation is disabled by default. In that case, :func:`timer`
+returns a shared no-op context manager and :func:`add_bytes` returns
+immediately. It is enabled by the configuration options
+`ckanext.dcor_depot.metrics_textfile` (path of a file that is written
+in the Prometheus text format, e.g. for the textfile collector of the
+node exporter; "{pid}" is replaced by the process ID) and
+`ckanext.dcor_depot.metrics_statsd` ("host:port" of a StatsD server),
+or by calling :func:`enable` (e.g. for the `--timings` flag of the
+CLI commands).
+
+Note that the times of phases which run in worker threads are
+summed over all threads, so they may exceed the wall time.
+"""
+import collections
+import contextlib
+import os
+import pathlib
+import socket
+import threading
+import time
+
+from dcor_shared import get_ckan_config_option
+
+
+#: Prefix of the exported metrics
+METRICS_PREFIX = "dcor_depot"
+
+_NULL_TIMER = contextlib.nullcontext()
+_metrics = None
+_configured = False
+_lock = threading.Lock()
+
+
+class Metrics:
+    """Thread-safe accumulator for phase timings and byte counters
+
+    Parameters
+    ----------
+    textfile: str or pathlib.Path
+        Path to which :func:`flush` writes the metrics in the
+        Prometheus text format
+    statsd: str
+        "host:port" of a StatsD server to which every measurement
+        is sent via UDP
+    """
+
+    def __init__(self, textfile=None, statsd=None):
+        self.textfile = None
+        if textfile:
+            self.textfile = pathlib.Path(
+                str(textfile).format(pid=os.getpid()))
+        self.statsd = None
+        if statsd:
+            host, port = statsd.rsplit(":", 1)
+            self.statsd = (host, int(port))
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        #: number of calls for each phase
+        self.calls = collections.Counter()
+        #: total time in seconds for each phase
+        self.seconds = collections.Counter()
+        #: number of bytes for each counter
+        self.bytes = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add_bytes(self, name, num_bytes):
+        with self._lock:
+            self.bytes[name] += num_bytes
+        self._send_statsd(f"bytes.{name}:{num_bytes}|c")
+
+    def add_time(self, phase, seconds):
+        with self._lock:
+            self.calls[phase] += 1
+            self.seconds[phase] += seconds
+        self._send_statsd(f"{phase}:{seconds * 1000:.3f}|ms")
+
+    def flush(self):
+        """Write the Prometheus text file (if configured)"""
+        if self.textfile is None:
+            return
+        self.textfile.parent.mkdir(parents=True, exist_ok=True)
+        path_tmp = self.textfile.with_name(self.textfile.name + ".tmp")
+        path_tmp.write_text(self.to_prometheus())
+        # atomic, so the collector never reads a partial file
+        path_tmp.replace(self.textfile)
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.seconds.clear()
+            self.bytes.clear()
+
+    def summary(self):
+        """Return a human-readable table of the phases and counters"""
+        with self._lock:
+            lines = [f"{'phase':<24} {'calls':>8} {'seconds':>10}"]
+            for phase in sorted(self.seconds, key=self.seconds.get,
+                                reverse=True):
+                lines.append(f"{phase:<24} {self.calls[phase]:>8} "
+                             f"{self.seconds[phase]:>10.3f}")
+            for name in sorted(self.bytes):
+                lines.append(f"{name + ' bytes':<24} "
+                             f"{self.bytes[name]:>19}")
+        return "\n".join(lines)
+
+    def timer(self, phase):
+        return _Timer(self, phase)
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text format"""
+        pid = os.getpid()
+        pre = METRICS_PREFIX
+        with self._lock:
+            lines = [
+                f"# HELP {pre}_phase_seconds_total Time spent per phase",
+                f"# TYPE {pre}_phase_seconds_total counter"]
+            lines += [f'{pre}_phase_seconds_total{{phase="{phase}",'
+                      f'pid="{pid}"}} {self.seconds[phase]:.6f}'
+                      for phase in sorted(self.seconds)]
+            lines += [
+                f"# HELP {pre}_phase_calls_total Number of calls per phase",
+                f"# TYPE {pre}_phase_calls_total counter"]
+            lines += [f'{pre}_phase_calls_total{{phase="{phase}",'
+                      f'pid="{pid}"}} {self.calls[phase]}'
+                      for phase in sorted(self.calls)]
+            lines += [
+                f"# HELP {pre}_bytes_total Number of bytes processed",
+                f"# TYPE {pre}_bytes_total counter"]
+            lines += [f'{pre}_bytes_total{{counter="{name}",'
+                      f'pid="{pid}"}} {self.bytes[name]}'
+                      for name in sorted(self.bytes)]
+        return "\n".join(lines) + "\n"
+
+    def _send_statsd(self, message):
+        if self.statsd is None:
+            return
+        try:
+            self._socket.sendto(f"{METRICS_PREFIX}.{message}".encode(),
+                                self.statsd)
+        except OSError:
+            # metrics must never break the actual operation
+            pass
+
+
+class _Timer:
+    __slots__ = ("metrics", "phase", "t0")
+
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.add_time(self.phase, time.perf_counter() - self.t0)
+
+
+def add_bytes(name, num_bytes):
+    """Add `num_bytes` to the byte counter `name`"""
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.add_bytes(name, num_bytes)
+
+
+def enable(textfile=None, statsd=None):
+    """Enable instrumentation for this process
+
+    Options that are not passed are taken from the CKAN configuration.
+    Returns the :class:`Metrics` instance.
+    """
+    global _metrics, _configured
+    with _lock:
+        if _metrics is None:
+            _metrics = Metrics(
+                textfile=textfile or get_ckan_config_option(
+                    "ckanext.dcor_depot.metrics_textfile"),
+                statsd=statsd or get_ckan_config_option(
+                    "ckanext.dcor_depot.metrics_statsd"))
+        _configured = True
+    return _metrics
+
+
+def flush():
+    """Export the metrics (if instrumentation is enabled)"""
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.flush()
+
+
+def get_metrics():
+    """Return the :class:`Metrics` of this process or None if disabled"""
+    global _metrics, _configured
+    if not _configured:
+        with _lock:
+            if not _configured:
+                try:
+                    textfile = get_ckan_config_option(
+                        "ckanext.dcor_depot.metrics_textfile")
+                    statsd = get_ckan_config_option(
+                        "ckanext.dcor_depot.metrics_statsd")
+                except Exception:
+                    # Don't break anything when there is no CKAN
+                    # configuration (e.g. when used as a library).
+                    textfile = statsd = None
+                if textfile or statsd:
+                    _metrics = Metrics(textfile=textfile, statsd=statsd)
+                _configured = True
+    return _metrics
+
+
+def timer(phase):
+    """Return a context manager that adds its run time to `phase`"""
+    metrics = get_metrics()
+    if metrics is None:
+        return _NULL_TIMER
+    return metrics.timer(phase)
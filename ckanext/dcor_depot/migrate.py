@@ -0,0 +1,218 @@
+"""Migration of resources from block storage to S3 object storage"""
+import pathlib
+import traceback
+
+from .checksum_cache import get_checksum_cache
+from .jobs import patch_resources_noauth
+from . import metrics
+from . import s3_util
+from .util import get_s3_object_name
+
+
+class ResourcePatchBatcher:
+    """Collect resource metadata updates and apply them per dataset
+
+    Patching resources one by one with `resource_patch` means that
+    the whole dataset is validated and indexed for every resource.
+    This class collects the updates for each dataset and applies
+    them with a single `package_revise` call when :func:`flush` is
+    called or when `flush_size` updates have been collected for a
+    dataset.
+    """
+
+    def __init__(self, flush_size: int = 100):
+        self.flush_size = flush_size
+        #: dictionary with dataset IDs as keys and dictionaries with
+        #: resource IDs as keys and (data_dict, callback) as values
+        self.pending = {}
+        #: dataset IDs with the user to perform the updates with
+        self.users = {}
+
+    def add(self, package_id, resource_id, data_dict, user=None,
+            callback=None):
+        """Add an update for a resource
+
+        Parameters
+        ----------
+        package_id: str
+            ID of the dataset the resource belongs to
+        resource_id: str
+            ID of the resource
+        data_dict: dict
+            Metadata to update
+        user: str
+            Name or ID of the user performing the update
+            (defaults to the site user)
+        callback: callable
+            Method called with the arguments `resource_id` and `error`
+            (None on success, formatted traceback otherwise) after the
+            update was applied
+        """
+        self.pending.setdefault(package_id, {})[resource_id] = (data_dict,
+                                                                callback)
+        if user is not None:
+            self.users[package_id] = user
+        if len(self.pending[package_id]) >= self.flush_size:
+            self.flush(package_id)
+
+    def flush(self, package_id=None):
+        """Apply the updates for one (`package_id`) or all datasets"""
+        if package_id is None:
+            package_ids = list(self.pending.keys())
+        else:
+            package_ids = [package_id]
+        for pid in package_ids:
+            patches = self.pending.pop(pid, {})
+            if not patches:
+                continue
+            context = {"ignore_auth": True}
+            if pid in self.users:
+                # https://github.com/ckan/ckan/issues/7787
+                context["user"] = self.users[pid]
+            else:
+                context["user"] = "default"
+            try:
+                patch_resources_noauth(
+                    package_id=pid,
+                    resource_patches={rid: dd for rid, (dd, _)
+                                      in patches.items()},
+                    context=context)
+            except KeyboardInterrupt:
+                raise
+            except BaseException:
+                error = traceback.format_exc()
+            else:
+                error = None
+            for rid, (_, callback) in patches.items():
+                if callback is not None:
+                    callback(rid, error)
+
+
+def migrate_artifact(resource_id: str,
+                     artifact: str,
+                     local_path: str | pathlib.Path,
+                     bucket_name: str,
+                     sha256: str | None = None,
+                     private: bool = True,
+                     verify_existence: bool = False,
+                     verify_checksum: bool = False,
+                     delete_after_migration: bool = False,
+                     inventory=None,
+                     ):
+    """Migrate a single resource artifact from block storage to S3
+
+    This function is designed to be run in a worker thread. It does
+    not access the CKAN database; everything it needs (bucket name,
+    SHA256 sum, private flag) must be passed by the caller. Exceptions
+    are not raised, but reported in the returned dictionary, so that
+    one failing artifact does not abort the migration of the others.
+
+    If an :class:`.inventory.BucketInventory` of `bucket_name` is
+    passed as `inventory`, objects listed in the inventory (with
+    the correct size) are not checked again on S3.
+
+    The local file is only deleted (`delete_after_migration`) after
+    a live check that the object exists on S3 with the correct size
+    and SHA256 sum (see :func:`.s3_util.verify_checksum`). Cached
+    information, such as the inventory, is never trusted for that.
+
+    SHA256 sums are looked up in and stored to the persistent
+    :class:`.checksum_cache.ChecksumCache`, so that unchanged files
+    are hashed only once.
+
+    Returns
+    -------
+    result: dict
+        Dictionary with the keys "resource_id", "artifact", "path",
+        "status" (one of "uploaded", "checked", "verified", "missing",
+        or "failed"), "s3_url" (only set when the upload succeeded),
+        "error" (formatted traceback, only set for "failed"), and
+        "deleted" (whether the local file was deleted).
+    """
+    rid = resource_id
+    object_name = get_s3_object_name(rid, artifact)
+    result = {"resource_id": rid,
+              "artifact": artifact,
+              "path": str(local_path),
+              "s3_url": None,
+              "error": None,
+              "deleted": False,
+              }
+    try:
+        override = False  # no override by default
+        upload = True
+        stat = pathlib.Path(local_path).stat()
+        size = stat.st_size
+        cache = get_checksum_cache()
+        sha256 = sha256 or cache.get(local_path, stat=stat)
+
+        if verify_checksum:
+            # compute sha256sum if not available
+            sha256 = sha256 or cache.sha256sum(local_path)
+            # Override only if the user requested it and only if the
+            # object does not exist or the SHA256 sum did not match.
+            # This only downloads the object if there is no SHA256 sum
+            # stored with it on S3.
+            with metrics.timer("s3_verify"):
+                override = not s3_util.verify_checksum(
+                    bucket_name=bucket_name,
+                    object_name=object_name,
+                    sha256=sha256,
+                    size=size)
+        elif inventory is not None and inventory.exists(object_name, size):
+            # The object exists and we don't have to verify the checksum.
+            upload = False
+
+        if upload:
+            # The SHA256 sum (if not available) is computed during the
+            # upload.
+            result["s3_url"], sha256_upload = s3_util.upload_file(
+                bucket_name=bucket_name,
+                object_name=object_name,
+                path=local_path,
+                sha256=sha256,
+                private=private,
+                override=override,
+            )
+            if sha256_upload and not sha256:
+                cache.set(local_path, sha256_upload, stat=stat)
+                sha256 = sha256_upload
+            if inventory is not None:
+                inventory.add(object_name, size)
+        else:
+            result["s3_url"] = s3_util.get_s3_url(bucket_name, object_name)
+
+        if delete_after_migration:
+            # Make sure the data are really on S3 before deleting them.
+            sha256 = sha256 or cache.sha256sum(local_path)
+            with metrics.timer("s3_verify"):
+                on_s3 = s3_util.verify_checksum(bucket_name=bucket_name,
+                                                object_name=object_name,
+                                                sha256=sha256,
+                                                size=size)
+            if not on_s3:
+                raise ValueError(
+                    f"Object {bucket_name}:{object_name} is missing or "
+                    f"does not match {local_path}, not deleting it!")
+    except FileNotFoundError:
+        result["status"] = "missing"
+    except KeyboardInterrupt:
+        raise
+    except BaseException:
+        result["status"] = "failed"
+        result["error"] = traceback.format_exc()
+    else:
+        if verify_checksum:
+            result["status"] = "verified"
+        elif verify_existence:
+            result["status"] = "checked"
+        else:
+            result["status"] = "uploaded"
+        # Only ever delete when upload succeeds
+        if delete_after_migration:
+            path_res = pathlib.Path(local_path).resolve()
+            pathlib.Path(local_path).unlink()
+            if path_res.exists():
+                path_res.unlink()
+            result["deleted"] = True
+    return result
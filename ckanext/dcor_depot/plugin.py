@@ -28,8 +28,54 @@ class DCORDepotPlugin(plugins.SingletonPlugin):
             "temporary directory for importing resource files"
         )
 
+        declaration.declare(dcor_depot_group.queue_small,
+                            jobs.MIGRATION_QUEUE_SMALL).set_description(
+            "background job queue for migrating small files to S3"
+        )
+
+        declaration.declare(dcor_depot_group.queue_bulk,
+                            jobs.MIGRATION_QUEUE_BULK).set_description(
+            "background job queue for migrating large files to S3"
+        )
+
+        declaration.declare_int(dcor_depot_group.queue_size_threshold,
+                                104857600).set_description(
+            "file size in bytes from which on files are migrated to S3 "
+            "in the bulk queue"
+        )
+
+        declaration.declare_bool(dcor_depot_group.rq_scheduler,
+                                 False).set_description(
+            "whether an RQ scheduler is running for the migration queues "
+            "(rq worker --with-scheduler); deferred migrations are then "
+            "scheduled with enqueue_at instead of being requeued"
+        )
+
+        declaration.declare_int(dcor_depot_group.s3_rate_limit_bytes,
+                                0).set_description(
+            "maximum number of bytes per second uploaded to S3 by all "
+            "depot workers and commands combined (0 means no limit)"
+        )
+
+        declaration.declare_int(dcor_depot_group.s3_rate_limit_requests,
+                                0).set_description(
+            "maximum number of S3 upload requests per second by all "
+            "depot workers and commands combined (0 means no limit)"
+        )
+
+        declaration.declare(dcor_depot_group.metrics_textfile).set_description(
+            "path of a file to which timings and byte counters of depot "
+            "operations are written in the Prometheus text format; "
+            "'{pid}' is replaced by the process ID"
+        )
+
+        declaration.declare(dcor_depot_group.metrics_statsd).set_description(
+            "'host:port' of a StatsD server to which timings and byte "
+            "counters of depot operations are sent"
+        )
+
     # IResourceController
     def after_resource_create(self, context, resource):
         if not context.get("is_background_job") and s3.is_available():
-            # All jobs are defined via decorators in jobs.py
-            jobs.RQJob.enqueue_all_jobs(resource, ckanext="dcor_depot")
+            # Migration jobs are deduplicated and coalesced per dataset.
+            jobs.enqueue_migration(resource)
@@ -0,0 +1,196 @@
+"""Bulk database queries for depot maintenance commands
+
+The functions in this module bypass the CKAN logic layer (`package_show`,
+`resource_show`) and only select the columns that are required, which
+is a lot faster when iterating over all resources of a DCOR instance.
+"""
+import datetime
+import itertools
+
+import ckan.model as model
+
+from . import metrics
+
+
+#: Keys of the dictionaries yielded by :func:`iter_resources`
+RESOURCE_KEYS = ("id", "package_id", "organization_id", "dataset_state",
+                 "name", "mimetype", "size", "sha256", "s3_available",
+                 "url_type")
+
+
+def get_dataset_ids(modified_days=-1, chunk_size=5000,
+                    organization_id=None):
+    """Return the IDs of all datasets (including drafts), sorted by ID
+
+    If `modified_days` is not negative, only return the datasets
+    modified within this number of days in the past. If
+    `organization_id` is given, only return the datasets of that
+    organization.
+    """
+    query = model.Session.query(model.Package.id)
+    if organization_id is not None:
+        query = query.filter(model.Package.owner_org == organization_id)
+    if modified_days >= 0:
+        # Search only the last `days` days.
+        past = datetime.date.today() - datetime.timedelta(days=modified_days)
+        query = query.filter(
+            model.Package.metadata_modified >= past.strftime("%Y-%m-%d"))
+    query = query.order_by(model.Package.id).yield_per(chunk_size)
+    with metrics.timer("db_query"):
+        return [row[0] for row in query]
+
+
+def is_s3_available(res_dict):
+    """Return whether a resource is marked as available on S3
+
+    `res_dict` is a resource dictionary or the resource extras. Since
+    the extras are stored as strings, "false" is interpreted as False.
+    """
+    s3_available = res_dict.get("s3_available", False)
+    if isinstance(s3_available, str):
+        s3_available = s3_available.lower() == "true"
+    return bool(s3_available)
+
+
+def iter_dataset_resources(dataset_ids, batch_size=500):
+    """Iterate over datasets and their resources in batched queries
+
+    For every dataset in `dataset_ids`, yield a tuple `(ds_dict, res_dicts)`
+    in the order given by `dataset_ids`. `ds_dict` is a dictionary
+    with the keys "id", "owner_org", "private", "creator_user_id",
+    and "state". `res_dicts` is the list of non-deleted resources of
+    that dataset (sorted by position), each resource being a dictionary
+    with the keys "id", "package_id", "name", "mimetype", "size",
+    "url_type", "state", and all keys in the resource extras
+    (e.g. "sha256", "s3_available", "s3_url").
+
+    The rows for `batch_size` datasets are fetched at once, so the
+    database session may be committed while iterating (e.g. when
+    patching resources).
+    """
+    dataset_ids = list(dataset_ids)
+    for ii in range(0, len(dataset_ids), batch_size):
+        batch = dataset_ids[ii:ii + batch_size]
+        with metrics.timer("db_query"):
+            rows = model.Session.query(
+                model.Package.id,
+                model.Package.owner_org,
+                model.Package.private,
+                model.Package.creator_user_id,
+                model.Package.state,
+                model.Resource.id,
+                model.Resource.name,
+                model.Resource.mimetype,
+                model.Resource.size,
+                model.Resource.url_type,
+                model.Resource.state,
+                model.Resource.extras,
+            ).outerjoin(
+                model.Resource,
+                (model.Resource.package_id == model.Package.id)
+                & (model.Resource.state != "deleted")
+            ).filter(
+                model.Package.id.in_(batch)
+            ).order_by(
+                model.Package.id,
+                model.Resource.position,
+            ).all()
+
+        datasets = {}
+        for ds_id, ds_rows in itertools.groupby(rows, key=lambda r: r[0]):
+            ds_rows = list(ds_rows)
+            _, owner_org, private, creator_user_id, ds_state = ds_rows[0][:5]
+            ds_dict = {"id": ds_id,
+                       "owner_org": owner_org,
+                       "private": private,
+                       "creator_user_id": creator_user_id,
+                       "state": ds_state,
+                       }
+            res_dicts = []
+            for row in ds_rows:
+                (rid, name, mimetype, size, url_type, res_state,
+                 extras) = row[5:]
+                if rid is None:
+                    # dataset without resources (outer join)
+                    continue
+                res_dict = dict(extras or {})
+                res_dict.update({"id": rid,
+                                 "package_id": ds_id,
+                                 "name": name,
+                                 "mimetype": mimetype,
+                                 "size": size,
+                                 "url_type": url_type,
+                                 "state": res_state,
+                                 })
+                res_dicts.append(res_dict)
+            datasets[ds_id] = (ds_dict, res_dicts)
+
+        for ds_id in batch:
+            if ds_id in datasets:
+                yield datasets[ds_id]
+
+
+def iter_resources(modified_days=-1, dataset_states=None,
+                   organization_id=None, mimetype=None, s3_available=None,
+                   chunk_size=5000):
+    """Iterate over all non-deleted resources with a streaming query
+
+    Only the required columns are selected and the rows are fetched
+    in chunks of `chunk_size` (with a server-side cursor where the
+    database supports it), so the memory usage does not depend on
+    the number of resources.
+
+    The resources can be filtered by the modification time of their
+    dataset (`modified_days`, see :func:`get_dataset_ids`), the states
+    of their dataset (`dataset_states`, e.g. `["active"]`), the
+    organization (`organization_id`), the `mimetype`, and by whether
+    they are available on S3 (`s3_available`, True or False; the
+    resource extras are evaluated in Python).
+
+    Yields dictionaries with the keys in :const:`RESOURCE_KEYS`.
+    """
+    query = model.Session.query(
+        model.Resource.id,
+        model.Resource.package_id,
+        model.Package.owner_org,
+        model.Package.state,
+        model.Resource.name,
+        model.Resource.mimetype,
+        model.Resource.size,
+        model.Resource.url_type,
+        model.Resource.extras,
+    ).join(
+        model.Package,
+        model.Resource.package_id == model.Package.id
+    ).filter(
+        model.Resource.state != "deleted"
+    )
+    if dataset_states:
+        query = query.filter(model.Package.state.in_(dataset_states))
+    if organization_id is not None:
+        query = query.filter(model.Package.owner_org == organization_id)
+    if mimetype is not None:
+        query = query.filter(model.Resource.mimetype == mimetype)
+    if modified_days >= 0:
+        past = datetime.date.today() - datetime.timedelta(days=modified_days)
+        query = query.filter(
+            model.Package.metadata_modified >= past.strftime("%Y-%m-%d"))
+    query = query.order_by(model.Resource.id).yield_per(chunk_size)
+
+    for (rid, package_id, owner_org, ds_state, name, res_mimetype, size,
+         url_type, extras) in query:
+        extras = extras or {}
+        res_s3_available = is_s3_available(extras)
+        if s3_available is not None and res_s3_available != s3_available:
+            continue
+        yield {"id": rid,
+               "package_id": package_id,
+               "organization_id": owner_org,
+               "dataset_state": ds_state,
+               "name": name,
+               "mimetype": res_mimetype,
+               "size": size,
+               "sha256": extras.get("sha256"),
+               "s3_available": res_s3_available,
+               "url_type": url_type,
+               }
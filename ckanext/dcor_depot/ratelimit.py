@@ -0,0 +1,106 @@
+"""Rate limiting of S3 transfers shared between processes via redis
+
+The limits are configured with `ckanext.dcor_depot.s3_rate_limit_bytes`
+(bytes per second) and `ckanext.dcor_depot.s3_rate_limit_requests`
+(requests per second). Since the token buckets are stored in redis,
+the limits apply to all workers and CLI commands of a DCOR instance
+combined.
+"""
+import functools
+import time
+
+from dcor_shared import get_ckan_config_option
+
+
+#: Atomically refill the bucket and take the requested tokens. The
+#: bucket may go into debt; the returned value is the time in seconds
+#: the caller has to wait until the tokens are actually available.
+#: Script effects replication is required for writing after calling
+#: the non-deterministic TIME command on redis < 5 (it is the default
+#: and the function is a no-op or missing on newer versions).
+TOKEN_BUCKET_SCRIPT = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate) - requested
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate - tokens / rate) + 60)
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+
+class TokenBucket:
+    """Token bucket with `rate` tokens per second stored in redis
+
+    The bucket holds at most `capacity` tokens (defaults to `rate`,
+    i.e. bursts of one second).
+    """
+
+    def __init__(self, name, rate, capacity=None, redis_conn=None):
+        if redis_conn is None:
+            from ckan.lib.redis import connect_to_redis
+            redis_conn = connect_to_redis()
+        self.key = f"ckanext-dcor_depot:ratelimit:{name}"
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._script = redis_conn.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def acquire(self, tokens=1):
+        """Take `tokens` from the bucket, sleeping if necessary
+
+        Returns the time in seconds spent waiting.
+        """
+        wait = float(self._script(keys=[self.key],
+                                  args=[self.rate, self.capacity, tokens]))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class S3RateLimiter:
+    """Limit the bandwidth and request rate of S3 transfers
+
+    If a limit is zero, it is not enforced (and redis is not used).
+    """
+
+    def __init__(self, bytes_per_second=0, requests_per_second=0,
+                 redis_conn=None):
+        self.bytes_bucket = None
+        self.requests_bucket = None
+        if bytes_per_second:
+            self.bytes_bucket = TokenBucket("s3-bytes",
+                                            rate=bytes_per_second,
+                                            redis_conn=redis_conn)
+        if requests_per_second:
+            self.requests_bucket = TokenBucket("s3-requests",
+                                               rate=requests_per_second,
+                                               redis_conn=redis_conn)
+
+    def acquire(self, num_bytes=0, num_requests=1):
+        """Wait until `num_bytes` may be sent in `num_requests` requests"""
+        if self.requests_bucket is not None and num_requests:
+            self.requests_bucket.acquire(num_requests)
+        if self.bytes_bucket is not None and num_bytes:
+            self.bytes_bucket.acquire(num_bytes)
+
+
+@functools.lru_cache()
+def get_s3_rate_limiter():
+    """Return the :class:`S3RateLimiter` configured in CKAN"""
+    return S3RateLimiter(
+        bytes_per_second=int(get_ckan_config_option(
+            "ckanext.dcor_depot.s3_rate_limit_bytes") or 0),
+        requests_per_second=float(get_ckan_config_option(
+            "ckanext.dcor_depot.s3_rate_limit_requests") or 0),
+    )
@@ -0,0 +1,137 @@
+"""Find drift between the CKAN database, S3, and local block storage"""
+import os
+import re
+
+from dcor_shared import get_ckan_storage_path, s3
+
+from .inventory import iter_bucket_listing
+from . import query
+from .util import get_s3_bucket_name, get_s3_object_name
+
+
+#: Regular expression for S3 object names of resource artifacts
+OBJECT_REGEX = re.compile(
+    r"^(?P<artifact>resource|condensed|preview)/"
+    r"(?P<r1>[0-9a-f]{3})/(?P<r2>[0-9a-f]{3})/(?P<r3>[0-9a-f-]{30})$")
+
+#: File name suffixes of the artifacts on block storage
+LOCAL_SUFFIXES = {"_condensed.rtdc": "condensed",
+                  "_preview.jpg": "preview",
+                  }
+
+
+def iter_storage_drift(check_local=True):
+    """Compare the database with S3 and block storage
+
+    This performs one bulk database scan, one paginated listing of
+    each bucket, and (if `check_local` is True) one scan of the local
+    resources directory. The bucket listings are processed as a stream.
+    The memory usage is proportional to the number of resources in the
+    database (their IDs and the artifacts of these resources found in
+    S3 are kept in memory), but not to the number of orphaned objects.
+
+    Yields dictionaries with the key "category" and additional
+    information for each finding. The categories are:
+
+    - "missing_object": resource is marked `s3_available` in the
+      database, but there is no object in S3
+    - "orphaned_object": object in S3 that does not belong to any
+      resource in the database
+    - "local_leftover": file on block storage whose artifact
+      (resource, condensed, or preview) is already on S3 (can be
+      deleted)
+    - "local_only": file on block storage whose artifact is not
+      on S3 (must be migrated)
+    - "orphaned_local": file on block storage that does not belong
+      to any resource in the database
+    """
+    # Resource IDs (and whether they are marked as being on S3) for
+    # every bucket.
+    db_buckets = {}
+    for ds_dict, res_dicts in query.iter_dataset_resources(
+            query.get_dataset_ids()):
+        if not res_dicts:
+            continue
+        bucket_name = get_s3_bucket_name(ds_dict["owner_org"])
+        resources = db_buckets.setdefault(bucket_name, {})
+        for res_dict in res_dicts:
+            resources[res_dict["id"]] = query.is_s3_available(res_dict)
+
+    # Tuples `(artifact, resource_id)` of the artifacts on S3
+    on_s3 = set()
+    bucket_names = sorted(set(s3.iter_buckets()) | set(db_buckets))
+    for bucket_name in bucket_names:
+        resources = db_buckets.get(bucket_name, {})
+        for obj in iter_bucket_listing(bucket_name):
+            match = OBJECT_REGEX.match(obj["Key"])
+            if match is None:
+                # not a resource artifact
+                continue
+            rid = match.group("r1") + match.group("r2") + match.group("r3")
+            if rid not in resources:
+                yield {"category": "orphaned_object",
+                       "bucket": bucket_name,
+                       "object": obj["Key"],
+                       "resource_id": rid,
+                       "size": obj["Size"],
+                       }
+            else:
+                on_s3.add((match.group("artifact"), rid))
+        for rid, s3_available in resources.items():
+            if s3_available and ("resource", rid) not in on_s3:
+                yield {"category": "missing_object",
+                       "bucket": bucket_name,
+                       "object": get_s3_object_name(rid),
+                       "resource_id": rid,
+                       }
+
+    if check_local:
+        known = set()
+        for resources in db_buckets.values():
+            known.update(resources.keys())
+        for path, rid, artifact in iter_local_artifacts():
+            if rid not in known:
+                category = "orphaned_local"
+            elif (artifact, rid) in on_s3:
+                category = "local_leftover"
+            else:
+                category = "local_only"
+            yield {"category": category,
+                   "path": path,
+                   "resource_id": rid,
+                   "artifact": artifact,
+                   "size": os.stat(path, follow_symlinks=False).st_size,
+                   }
+
+
+def iter_local_artifacts():
+    """Iterate over all resource artifacts on local block storage
+
+    Yields tuples `(path, resource_id, artifact)` for all files in the
+    "resources" directory of `ckan.storage_path`.
+    """
+    resources_path = get_ckan_storage_path() / "resources"
+    if not resources_path.is_dir():
+        return
+    for d1 in _scandir_sorted(resources_path):
+        if not d1.is_dir(follow_symlinks=False) or len(d1.name) != 3:
+            continue
+        for d2 in _scandir_sorted(d1.path):
+            if not d2.is_dir(follow_symlinks=False) or len(d2.name) != 3:
+                continue
+            for entry in _scandir_sorted(d2.path):
+                if entry.is_dir(follow_symlinks=False):
+                    continue
+                name = entry.name
+                artifact = "resource"
+                for suffix, art in LOCAL_SUFFIXES.items():
+                    if name.endswith(suffix):
+                        name = name[:-len(suffix)]
+                        artifact = art
+                        break
+                yield entry.path, d1.name + d2.name + name, artifact
+
+
+def _scandir_sorted(path):
+    with os.scandir(path) as it:
+        return sorted(it, key=lambda e: e.name)
@@ -0,0 +1,504 @@
+"""S3 functionalities complementing :mod:`dcor_shared.s3`"""
+import base64
+import binascii
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import hashlib
+import pathlib
+import threading
+import urllib.parse
+
+import botocore.exceptions
+
+from dcor_shared import get_ckan_config_option, s3
+
+from . import metrics
+from .ratelimit import get_s3_rate_limiter
+
+
+#: Part size for multipart uploads; This is also the size of the buffer
+#: that is used for reading data.
+PART_SIZE = 64 * 1024**2
+
+#: Buckets that were created or found by :func:`require_bucket`
+_required_buckets = set()
+_required_buckets_lock = threading.Lock()
+
+
+def get_s3_url(bucket_name, object_name):
+    """Return the S3 URL of an object"""
+    endpoint_url = get_ckan_config_option("dcor_object_store.endpoint_url")
+    return f"{endpoint_url}/{bucket_name}/{object_name}"
+
+
+def get_upload_tags(private=True, sha256=None):
+    """Return the object tags for an upload as a dictionary
+
+    Non-private objects are tagged with "public=true" (see
+    :func:`dcor_shared.s3.require_bucket`). If `sha256` is given,
+    it is stored in the "sha256" tag.
+    """
+    tags = {}
+    if not private:
+        tags["public"] = "true"
+    if sha256:
+        tags["sha256"] = sha256
+    return tags
+
+
+def get_object_sha256(bucket_name, object_name, head=None):
+    """Return the SHA256 sum stored for an object without downloading it
+
+    The SHA256 sum is taken from (in this order) the "sha256" entry in the
+    object metadata, the S3 additional checksum (only for objects that
+    were not uploaded in multiple parts), or the "sha256" object tag.
+    Returns None if no SHA256 sum is stored.
+
+    If you already performed a HEAD request (with `ChecksumMode="ENABLED"`),
+    you may pass the response as `head`.
+    """
+    s3_client, _, _ = s3.get_s3()
+    if head is None:
+        head = s3_client.head_object(Bucket=bucket_name,
+                                     Key=object_name,
+                                     ChecksumMode="ENABLED")
+    sha256 = head.get("Metadata", {}).get("sha256")
+    if not sha256:
+        checksum = head.get("ChecksumSHA256")
+        # Checksums of multipart uploads are checksums of the checksums
+        # of the parts (e.g. "HASH-5"); we cannot use those.
+        if checksum and "-" not in checksum:
+            try:
+                sha256 = base64.b64decode(checksum).hex()
+            except (binascii.Error, ValueError):
+                pass
+    if not sha256:
+        resp = s3_client.get_object_tagging(Bucket=bucket_name,
+                                            Key=object_name)
+        for item in resp["TagSet"]:
+            if item["Key"] == "sha256":
+                sha256 = item["Value"]
+                break
+    return sha256 or None
+
+
+def verify_checksum(bucket_name, object_name, sha256, size=None, md5=None):
+    """Verify the SHA256 sum of an S3 object, avoiding a download
+
+    The SHA256 sum stored with the object (see :func:`get_object_sha256`)
+    or the ETag (if `md5` is given and the object was not uploaded in
+    multiple parts) is compared with the expected value. Only if none
+    of these are available or if they do not match, the object is
+    downloaded and hashed with :func:`dcor_shared.s3.compute_checksum`.
+    If a download was necessary and the checksum matches, the SHA256 sum
+    is stored as an object tag, so that the next verification is cheap.
+
+    Parameters
+    ----------
+    bucket_name: str
+        Name of the bucket
+    object_name: str
+        Path/name to the object in the bucket
+    sha256: str
+        Expected SHA256 sum of the object
+    size: int
+        Expected size of the object in bytes
+    md5: str
+        Expected MD5 sum of the object
+
+    Returns
+    -------
+    valid: bool
+        False if the object does not exist or if the checksums
+        do not match, True otherwise
+    """
+    s3_client, _, _ = s3.get_s3()
+    try:
+        head = s3_client.head_object(Bucket=bucket_name,
+                                     Key=object_name,
+                                     ChecksumMode="ENABLED")
+    except (s3_client.exceptions.NoSuchKey,
+            botocore.exceptions.ClientError):
+        return False
+
+    if size is not None and head["ContentLength"] != size:
+        return False
+
+    etag = head.get("ETag", "").strip('"')
+    if md5 and etag and "-" not in etag and etag == md5:
+        return True
+
+    stored_sha256 = get_object_sha256(bucket_name, object_name, head=head)
+    if stored_sha256 == sha256:
+        return True
+
+    # Fall back to downloading the object
+    s3_sha256 = s3.compute_checksum(bucket_name=bucket_name,
+                                    object_name=object_name,
+                                    max_size=head["ContentLength"])
+    if s3_sha256 != sha256:
+        return False
+
+    if stored_sha256 is None:
+        # Remember the SHA256 sum for the next time
+        tags = s3_client.get_object_tagging(Bucket=bucket_name,
+                                            Key=object_name)["TagSet"]
+        tags = [it for it in tags if it["Key"] != "sha256"]
+        tags.append({"Key": "sha256", "Value": sha256})
+        s3_client.put_object_tagging(Bucket=bucket_name,
+                                     Key=object_name,
+                                     Tagging={"TagSet": tags})
+    return True
+
+
+def prune_multipart_uploads(initiated_before_days=5, dry_run=False,
+                            print_progress=False, bucket_names=None,
+                            num_jobs=8, num_abort_jobs=16):
+    """Prune stale multipart uploads in multiple buckets concurrently
+
+    This is a parallel version of
+    :func:`dcor_shared.s3.prune_multipart_uploads` which returns the
+    same dictionary. Up to `num_jobs` buckets are
+    searched concurrently and up to `num_abort_jobs` stale multipart
+    uploads (of all buckets combined) are aborted concurrently.
+
+    Parameters
+    ----------
+    initiated_before_days: int
+        Only prune multipart uploads that were initiated before a
+        given number of days (set to -1 to prune all)
+    dry_run: bool
+        Don't actually prune
+    print_progress: bool
+        Print one line per bucket with stale or recent uploads
+    bucket_names: list of str
+        Names of the buckets to search; defaults to all buckets of the
+        DCOR instance (see :func:`dcor_shared.s3.iter_buckets`). Pass
+        a subset to split the work between several hosts.
+    num_jobs: int
+        Number of buckets searched concurrently
+    num_abort_jobs: int
+        Maximum number of concurrent abort requests
+
+    Returns
+    -------
+    prune_info: dict
+        Dictionary with bucket_names as keys containing dictionaries
+        with the number of multipart uploads with the keys
+        "found" and "ignored".
+    """
+    s3_client, _, _ = s3.get_s3()
+    initiated_before_days = max(-1, initiated_before_days)
+    if bucket_names is None:
+        bucket_names = list(s3.iter_buckets(for_circles_only=False))
+    print_lock = threading.Lock()
+
+    if print_progress and dry_run:
+        print("Starting dry run for pruning multipart uploads")
+
+    def prune_bucket(bucket_name):
+        bdict = {"found": 0,
+                 "ignored": 0
+                 }
+        futures = []
+        paginator = s3_client.get_paginator("list_multipart_uploads")
+        try:
+            pages = list(paginator.paginate(Bucket=bucket_name))
+        except s3_client.exceptions.NoSuchBucket:
+            # e.g. organization without any uploads
+            return bdict
+        for page in pages:
+            for item in page.get("Uploads", []):
+                # list parts and check whether the bucket matches
+                try:
+                    part_info = s3_client.list_parts(
+                        Bucket=bucket_name,
+                        Key=item["Key"],
+                        UploadId=item["UploadId"],
+                        MaxParts=1,
+                    )
+                except BaseException:
+                    # ignore non-existent (bucket not matching) upload
+                    continue
+                if part_info["Bucket"] != bucket_name:
+                    continue
+                date = item["Initiated"]
+                date_boundary = (
+                    datetime.datetime.now(date.tzinfo)
+                    - datetime.timedelta(days=initiated_before_days))
+                if date < date_boundary:
+                    bdict["found"] += 1
+                    if not dry_run:
+                        futures.append(abort_pool.submit(
+                            s3_client.abort_multipart_upload,
+                            Bucket=bucket_name,
+                            Key=item["Key"],
+                            UploadId=item["UploadId"]))
+                else:
+                    bdict["ignored"] += 1
+        for future in futures:
+            # raises the exception of the abort request
+            future.result()
+        if print_progress and (bdict["found"] or bdict["ignored"]):
+            with print_lock:
+                print(f"Bucket {bucket_name}: {bdict['found']} stale, "
+                      f"{bdict['ignored']} recent", flush=True)
+        return bdict
+
+    with ThreadPoolExecutor(max_workers=num_abort_jobs) as abort_pool, \
+            ThreadPoolExecutor(max_workers=num_jobs) as pool:
+        return dict(zip(bucket_names, pool.map(prune_bucket, bucket_names)))
+
+
+def require_bucket(bucket_name):
+    """Make sure that a bucket exists (thread-safe)
+
+    This calls :func:`dcor_shared.s3.require_bucket` only once per
+    bucket and process. Call this function before uploading to a
+    bucket from multiple threads, so that the bucket is not created
+    concurrently.
+    """
+    with _required_buckets_lock:
+        if bucket_name not in _required_buckets:
+            s3.require_bucket(bucket_name)
+            _required_buckets.add(bucket_name)
+
+
+def upload_file(bucket_name, object_name, path, sha256=None, private=True,
+                override=False, part_size=PART_SIZE):
+    """Upload a file to a bucket, computing the SHA256 sum on the fly
+
+    This is a single-pass alternative to :func:`dcor_shared.s3.upload_file`
+    which reads `path` only once; see :func:`upload_stream`.
+
+    Returns
+    -------
+    s3_url: str
+        URL to the S3 object
+    sha256: str
+        SHA256 sum of the uploaded file; if no upload was performed,
+        because the object already exists, this is the `sha256`
+        that was passed.
+    """
+    with pathlib.Path(path).open("rb") as fd:
+        return upload_stream(bucket_name=bucket_name,
+                             object_name=object_name,
+                             fd=fd,
+                             sha256=sha256,
+                             private=private,
+                             override=override,
+                             part_size=part_size)
+
+
+def upload_stream(bucket_name, object_name, fd, sha256=None, private=True,
+                  override=False, part_size=PART_SIZE, md5=None,
+                  size=None):
+    """Upload data from a file object to a bucket in a single pass
+
+    The data are read from `fd` in parts of size `part_size` into a
+    reusable buffer. Every part is fed to a SHA256 hasher and
+    uploaded in a multipart upload. The integrity of each part is
+    verified by S3 via the Content-MD5 header, so there is no need
+    to download the object again after the upload. Uploads are
+    subject to the rate limits configured for the depot (see
+    :mod:`.ratelimit`). The time spent reading, hashing, and uploading
+    is recorded in the phases "read", "hash", and "s3_upload" (see
+    :mod:`.metrics`).
+
+    Parameters
+    ----------
+    bucket_name: str
+        Name of the bucket
+    object_name: str
+        Path/name to the object in the bucket
+    fd: file-like object
+        Binary file object supporting `readinto` or `read`
+    sha256: str
+        Expected SHA256 sum of the data. If given, it is stored in the
+        object metadata and the upload is aborted (without creating
+        the object) if the data do not match.
+    private: bool
+        Whether the object should remain private
+    override: bool
+        Whether to override existing objects in S3
+    part_size: int
+        Size of the parts in bytes for multipart uploads;
+        must be at least 5 MiB
+    md5: str
+        Expected MD5 sum of the data; if given, the upload is aborted
+        if the data do not match (like for `sha256`)
+    size: int
+        Expected size of the data in bytes; if given, the upload is
+        aborted if a different number of bytes is read from `fd`
+
+    Returns
+    -------
+    s3_url: str
+        URL to the S3 object
+    sha256: str
+        SHA256 sum of the uploaded data (see :func:`upload_file`)
+
+    Notes
+    -----
+    The SHA256 sum is stored as the "sha256" entry in the object
+    metadata if it is known before the upload and as the "sha256" tag
+    otherwise.
+    """
+    s3_client, _, _ = s3.get_s3()
+    require_bucket(bucket_name)
+    s3_url = get_s3_url(bucket_name, object_name)
+
+    if not override:
+        with metrics.timer("s3_exists"):
+            exists = s3.object_exists(bucket_name=bucket_name,
+                                      object_name=object_name)
+        if exists:
+            return s3_url, sha256
+
+    limiter = get_s3_rate_limiter()
+    hasher = hashlib.sha256()
+    hasher_md5 = hashlib.md5() if md5 else None
+    buffer = bytearray(part_size)
+    view = memoryview(buffer)
+    with metrics.timer("read"):
+        num_bytes = _readinto_full(fd, view)
+
+    if num_bytes < part_size:
+        # The whole file fits into one part; upload it with one request.
+        data = bytes(view[:num_bytes])
+        with metrics.timer("hash"):
+            hasher.update(data)
+            if md5:
+                hasher_md5.update(data)
+        sha256 = _check_sha256(hasher, sha256, bucket_name, object_name)
+        if md5:
+            _check_md5(hasher_md5, md5, bucket_name, object_name)
+        _check_size(num_bytes, size, bucket_name, object_name)
+        limiter.acquire(num_bytes=num_bytes)
+        with metrics.timer("s3_upload"):
+            s3_client.put_object(
+                Bucket=bucket_name,
+                Key=object_name,
+                Body=data,
+                ContentMD5=_md5_b64(data),
+                Metadata={"sha256": sha256},
+                Tagging=urllib.parse.urlencode(
+                    get_upload_tags(private=private, sha256=sha256)),
+            )
+        metrics.add_bytes("uploaded", num_bytes)
+        return s3_url, sha256
+
+    kwargs = {"Bucket": bucket_name, "Key": object_name}
+    create_kwargs = {}
+    if sha256:
+        create_kwargs["Metadata"] = {"sha256": sha256}
+    tags = get_upload_tags(private=private, sha256=sha256)
+    if tags:
+        create_kwargs["Tagging"] = urllib.parse.urlencode(tags)
+    upload_id = s3_client.create_multipart_upload(
+        **kwargs, **create_kwargs)["UploadId"]
+    try:
+        parts = []
+        received = 0
+        while num_bytes:
+            received += num_bytes
+            if size is not None and received > size:
+                # no need to upload the rest
+                _check_size(received, size, bucket_name, object_name)
+            if num_bytes == part_size:
+                body = buffer
+            else:
+                # last part
+                body = bytes(view[:num_bytes])
+            with metrics.timer("hash"):
+                hasher.update(view[:num_bytes])
+                if md5:
+                    hasher_md5.update(view[:num_bytes])
+            limiter.acquire(num_bytes=num_bytes)
+            with metrics.timer("s3_upload"):
+                resp = s3_client.upload_part(
+                    **kwargs,
+                    UploadId=upload_id,
+                    PartNumber=len(parts) + 1,
+                    Body=body,
+                    ContentMD5=_md5_b64(view[:num_bytes]),
+                )
+            metrics.add_bytes("uploaded", num_bytes)
+            parts.append({"ETag": resp["ETag"], "PartNumber": len(parts) + 1})
+            with metrics.timer("read"):
+                num_bytes = _readinto_full(fd, view)
+        # Only complete the upload if the checksum and size match.
+        sha256_known = bool(sha256)
+        sha256 = _check_sha256(hasher, sha256, bucket_name, object_name)
+        if md5:
+            _check_md5(hasher_md5, md5, bucket_name, object_name)
+        _check_size(received, size, bucket_name, object_name)
+        with metrics.timer("s3_upload"):
+            s3_client.complete_multipart_upload(
+                **kwargs,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+    except BaseException:
+        s3_client.abort_multipart_upload(**kwargs, UploadId=upload_id)
+        raise
+
+    if not sha256_known:
+        # We know the SHA256 sum only now; store it as a tag.
+        s3_client.put_object_tagging(
+            **kwargs,
+            Tagging={"TagSet": [
+                {"Key": key, "Value": value} for key, value in
+                get_upload_tags(private=private, sha256=sha256).items()]},
+        )
+    return s3_url, sha256
+
+
+def _check_md5(hasher, md5, bucket_name, object_name):
+    """Raise a ValueError if the hexdigest of `hasher` is not `md5`"""
+    if hasher.hexdigest() != md5:
+        raise ValueError(
+            f"MD5 sum mismatch for {bucket_name}:{object_name}!")
+
+
+def _check_size(received, size, bucket_name, object_name):
+    """Raise a ValueError if `received` is not the expected `size`"""
+    if size is not None and received != size:
+        raise ValueError(
+            f"Size mismatch for {bucket_name}:{object_name}: expected "
+            f"{size} bytes, received {received}!")
+
+
+def _check_sha256(hasher, sha256, bucket_name, object_name):
+    """Return the hexdigest of `hasher` and raise if it is not `sha256`"""
+    digest = hasher.hexdigest()
+    if sha256 and sha256 != digest:
+        raise ValueError(
+            f"Checksum mismatch for {bucket_name}:{object_name}!")
+    return digest
+
+
+def _md5_b64(data):
+    """Return the base64-encoded MD5 digest (for the Content-MD5 header)"""
+    return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+
+def _readinto_full(fd, view):
+    """Fill `view` with data from `fd`, returning the number of bytes read
+
+    The returned number is only smaller than `len(view)` at the
+    end of the file.
+    """
+    size = 0
+    total = len(view)
+    while size < total:
+        if hasattr(fd, "readinto"):
+            num = fd.readinto(view[size:])
+        else:
+            data = fd.read(total - size)
+            num = len(data)
+            view[size:size + num] = data
+        if not num:
+            break
+        size += num
+    return size
@@ -0,0 +1,83 @@
+"""Throughput of the hashing engine in `util` compared to `sha256sum`
+
+Usage::
+
+    python -m ckanext.dcor_depot.tests.benchmarks.bench_hashing \
+        --files 8 --size-mb 256 --jobs 4
+
+The results are printed as JSON (MB/s and files per second).
+"""
+import argparse
+import json
+import os
+import pathlib
+import tempfile
+import time
+
+from dcor_shared import sha256sum
+
+from ckanext.dcor_depot import util
+
+
+def make_files(directory, num_files, size):
+    paths = []
+    for ii in range(num_files):
+        path = pathlib.Path(directory) / f"file_{ii}.rtdc"
+        with path.open("wb") as fd:
+            for _ in range(0, size, 2**24):
+                fd.write(os.urandom(min(2**24, size)))
+            fd.truncate(size)
+        paths.append(path)
+    return paths
+
+
+def measure(name, func, paths, size):
+    t0 = time.perf_counter()
+    digests = func(paths)
+    duration = time.perf_counter() - t0
+    return digests, {"name": name,
+                     "seconds": round(duration, 4),
+                     "files_per_second": round(len(paths) / duration, 3),
+                     "mb_per_second": round(
+                         len(paths) * size / duration / 1e6, 2),
+                     }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    size = args.size_mb * 10**6
+
+    with tempfile.TemporaryDirectory(prefix="bench_hashing_") as td:
+        paths = make_files(td, args.files, size)
+        # read the files once, so all candidates see a warm page cache
+        [sha256sum(path) for path in paths]
+        results = []
+        reference, result = measure(
+            "dcor_shared.sha256sum",
+            lambda paths: [sha256sum(path) for path in paths],
+            paths, size)
+        results.append(result)
+        for name, func in [
+            ("util.sha256sum",
+             lambda paths: [util.sha256sum(path) for path in paths]),
+            (f"util.hash_files(num_jobs={args.jobs})",
+             lambda paths: util.hash_files(paths, num_jobs=args.jobs)),
+        ]:
+            digests, result = measure(name, func, paths, size)
+            assert digests == reference, f"wrong checksums from {name}"
+            results.append(result)
+
+    print(json.dumps({"benchmark": "hashing",
+                      "files": args.files,
+                      "file_size": size,
+                      "cpu_count": os.cpu_count(),
+                      "results": results,
+                      }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
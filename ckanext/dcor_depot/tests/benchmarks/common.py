@@ -0,0 +1,107 @@
+"""Helpers for the depot benchmarks"""
+import contextlib
+import functools
+import http.server
+import json
+import os
+import pathlib
+import platform
+import threading
+import time
+
+
+#: Environment variable that enables the benchmarks in pytest
+BENCHMARK_ENV = "DCOR_DEPOT_BENCHMARK"
+#: Environment variable with the path of the JSON results file
+BENCHMARK_OUTPUT_ENV = "DCOR_DEPOT_BENCHMARK_OUTPUT"
+#: Default path of the JSON results file (ignored by git)
+BENCHMARK_OUTPUT_DEFAULT = pathlib.Path(__file__).parent \
+    / "benchmark_results.json"
+#: Number of files and file size used by the benchmarks; typical .rtdc
+#: files range from a few MB to several GB
+BENCHMARK_FILES = int(os.environ.get("DCOR_DEPOT_BENCHMARK_FILES", 8))
+BENCHMARK_FILE_SIZE = int(os.environ.get("DCOR_DEPOT_BENCHMARK_FILE_SIZE",
+                                         64 * 1024**2))
+
+
+class BenchmarkResults:
+    """Collect benchmark results and write them to a JSON file"""
+
+    def __init__(self):
+        self.results = []
+
+    @contextlib.contextmanager
+    def measure(self, name, num_files, num_bytes, **params):
+        """Time the `with` block and record files/s and MB/s"""
+        t0 = time.perf_counter()
+        yield
+        duration = time.perf_counter() - t0
+        self.results.append({
+            "name": name,
+            "params": params,
+            "files": num_files,
+            "bytes": num_bytes,
+            "seconds": round(duration, 4),
+            "files_per_second": round(num_files / duration, 3),
+            "mb_per_second": round(num_bytes / duration / 1e6, 2),
+        })
+
+    def save(self, path):
+        from ckanext.dcor_depot import __version__
+        data = {"version": __version__,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "results": self.results,
+                }
+        pathlib.Path(path).write_text(json.dumps(data, indent=2))
+
+
+def make_rtdc_files(directory, num_files=BENCHMARK_FILES,
+                    size=BENCHMARK_FILE_SIZE):
+    """Create `num_files` files of `size` bytes with random content
+
+    The files are not valid .rtdc files; they only have the size of
+    typical measurements. Random data make sure that nothing in the
+    transfer chain can compress them.
+    """
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for ii in range(num_files):
+        path = directory / f"measurement_{ii:03d}.rtdc"
+        with path.open("wb") as fd:
+            remaining = size
+            while remaining:
+                chunk = min(remaining, 2**24)
+                fd.write(os.urandom(chunk))
+                remaining -= chunk
+        paths.append(path)
+    return paths
+
+
+@contextlib.contextmanager
+def serve_directory(directory):
+    """Serve the files in `directory` via HTTP on a local port
+
+    Yields the base URL of the server. The server supports
+    concurrent connections, but no range requests.
+    """
+    handler = functools.partial(QuietHTTPRequestHandler,
+                                directory=str(directory))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class QuietHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,38 @@
+"""Compare two JSON files written by the depot benchmarks
+
+Usage::
+
+    python -m ckanext.dcor_depot.tests.benchmarks.compare old.json new.json
+
+For every benchmark, the throughput in MB/s of both runs and the
+ratio new/old are printed.
+"""
+import json
+import pathlib
+import sys
+
+
+def load(path):
+    data = json.loads(pathlib.Path(path).read_text())
+    return data, {(res["name"], json.dumps(res.get("params", {}),
+                                           sort_keys=True)): res
+                  for res in data["results"]}
+
+
+def main(old_path, new_path):
+    old_data, old = load(old_path)
+    new_data, new = load(new_path)
+    print(f"{'benchmark':<50} {old_data['version']:>12} "
+          f"{new_data['version']:>12} {'ratio':>6}")
+    for key in sorted(set(old) | set(new)):
+        name = key[0] + ("" if key[1] == "{}" else f" {key[1]}")
+        mbs_old = old[key]["mb_per_second"] if key in old else None
+        mbs_new = new[key]["mb_per_second"] if key in new else None
+        ratio = (f"{mbs_new / mbs_old:6.2f}" if mbs_old and mbs_new
+                 else f"{'-':>6}")
+        print(f"{name:<50} {mbs_old or '-':>12} {mbs_new or '-':>12} "
+              f"{ratio}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:3])
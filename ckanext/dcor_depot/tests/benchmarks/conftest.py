@@ -0,0 +1,69 @@
+"""Fixtures for the depot benchmarks
+
+The benchmarks are skipped unless the environment variable
+`DCOR_DEPOT_BENCHMARK` is set. The S3 object store is replaced by a
+local moto server, so the numbers reflect the overhead of the depot
+code rather than the network.
+"""
+import os
+import socket
+
+import pytest
+
+from .common import (
+    BENCHMARK_ENV, BENCHMARK_OUTPUT_DEFAULT, BENCHMARK_OUTPUT_ENV,
+    BenchmarkResults
+)
+
+
+def pytest_collection_modifyitems(config, items):
+    if os.environ.get(BENCHMARK_ENV):
+        return
+    skip = pytest.mark.skip(reason=f"set {BENCHMARK_ENV}=1 to run")
+    for item in items:
+        if "benchmarks" in item.nodeid:
+            item.add_marker(skip)
+
+
+@pytest.fixture(scope="session")
+def benchmark_results():
+    results = BenchmarkResults()
+    yield results
+    if results.results:
+        results.save(os.environ.get(BENCHMARK_OUTPUT_ENV,
+                                    BENCHMARK_OUTPUT_DEFAULT))
+
+
+@pytest.fixture(scope="session")
+def moto_server_url():
+    from moto.server import ThreadedMotoServer
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+    server.start()
+    yield f"http://127.0.0.1:{port}"
+    server.stop()
+
+
+@pytest.fixture
+def s3_standin(moto_server_url, ckan_config, monkeypatch):
+    """Point the depot to the local moto server"""
+    from dcor_shared import s3
+    from ckanext.dcor_depot import ratelimit
+    for key, value in [
+        ("dcor_object_store.endpoint_url", moto_server_url),
+        ("dcor_object_store.access_key_id", "benchmark"),
+        ("dcor_object_store.secret_access_key", "benchmark"),
+        ("dcor_object_store.ssl_verify", False),
+        ("dcor_object_store.bucket_name", "bench-{organization_id}"),
+        ("ckanext.dcor_depot.s3_rate_limit_bytes", 0),
+        ("ckanext.dcor_depot.s3_rate_limit_requests", 0),
+    ]:
+        monkeypatch.setitem(ckan_config, key, value)
+    caches = [s3.get_s3, s3.is_available, ratelimit.get_s3_rate_limiter]
+    for func in caches:
+        func.cache_clear()
+    yield moto_server_url
+    for func in caches:
+        func.cache_clear()
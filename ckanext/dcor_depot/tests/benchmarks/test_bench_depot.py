@@ -0,0 +1,149 @@
+"""Throughput benchmarks for the hot paths of the depot
+
+Run with::
+
+    DCOR_DEPOT_BENCHMARK=1 pytest ckanext/dcor_depot/tests/benchmarks
+
+The results are written to "benchmark_results.json" in this directory
+(or to the path in `DCOR_DEPOT_BENCHMARK_OUTPUT`) and can be compared between
+releases with :mod:`.compare`.
+"""
+import concurrent.futures
+import hashlib
+import shutil
+
+import pytest
+
+from ckan.cli.cli import ckan as ckan_cli
+from ckan.tests import helpers
+
+from dcor_shared import s3
+from dcor_shared.testing import make_dataset_via_s3
+
+from ckanext.dcor_depot import app_res, download, figshare, jobs
+from ckanext.dcor_depot.util import (
+    get_s3_bucket_name, get_s3_object_name, make_id
+)
+
+from .common import make_rtdc_files, serve_directory
+
+
+@pytest.fixture
+def rtdc_files(tmp_path):
+    paths = make_rtdc_files(tmp_path / "files")
+    return paths, sum(path.stat().st_size for path in paths)
+
+
+def make_depot_dataset(rtdc_files, monkeypatch, tmp_path):
+    """Create a dataset whose resources only exist on block storage
+
+    The resources are appended with :func:`app_res.append_resources`,
+    then the files are copied to the depot and removed from S3, so
+    that the migration has to upload them again.
+    """
+    paths, _ = rtdc_files
+    monkeypatch.setattr(jobs, "get_ckan_storage_path",
+                        lambda: tmp_path / "storage")
+    ds_dict = make_dataset_via_s3(activate=False)
+    app_res.append_resources(paths=paths, dataset_id=ds_dict["id"])
+    ds_dict = helpers.call_action("package_show", id=ds_dict["id"])
+    s3_client, _, _ = s3.get_s3()
+    for res_dict in ds_dict["resources"]:
+        rid = res_dict["id"]
+        src = [p for p in paths if p.name == res_dict["name"]][0]
+        shutil.copy2(src, jobs.get_resource_path(rid, create_dirs=True))
+        s3_client.delete_object(
+            Bucket=get_s3_bucket_name(ds_dict["owner_org"]),
+            Key=get_s3_object_name(rid))
+    return ds_dict
+
+
+def test_bench_download_file(rtdc_files, tmp_path, benchmark_results):
+    paths, total = rtdc_files
+    md5s = {p.name: hashlib.md5(p.read_bytes()).hexdigest() for p in paths}
+    with serve_directory(paths[0].parent) as base_url:
+        with benchmark_results.measure("download.download_file",
+                                       len(paths), total):
+            for path in paths:
+                download.download_file(f"{base_url}/{path.name}",
+                                       tmp_path / "dl" / path.name,
+                                       ret_sha256=True,
+                                       md5=md5s[path.name],
+                                       size=path.stat().st_size)
+
+
+@pytest.mark.parametrize("stage_on_disk", [False, True])
+@pytest.mark.parametrize("num_jobs", [1, 4])
+def test_bench_figshare_import_file(s3_standin, rtdc_files, tmp_path,
+                                    benchmark_results, stage_on_disk,
+                                    num_jobs):
+    paths, total = rtdc_files
+    res_list = [{"name": p.name,
+                 "supplied_md5": hashlib.md5(p.read_bytes()).hexdigest(),
+                 "size": p.stat().st_size} for p in paths]
+    with serve_directory(paths[0].parent) as base_url:
+        for res in res_list:
+            res["download_url"] = f"{base_url}/{res['name']}"
+
+        def import_file(res):
+            rid = make_id(["figshare-benchmark", res["name"], num_jobs,
+                           stage_on_disk])
+            figshare.import_file(
+                res=res,
+                path=tmp_path / "staging" / rid / res["name"],
+                bucket_name="bench-figshare",
+                object_name=get_s3_object_name(rid),
+                private=False,
+                stage_on_disk=stage_on_disk)
+
+        with benchmark_results.measure("figshare.import_file",
+                                       len(paths), total,
+                                       num_jobs=num_jobs,
+                                       stage_on_disk=stage_on_disk):
+            with concurrent.futures.ThreadPoolExecutor(num_jobs) as pool:
+                list(pool.map(import_file, res_list))
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_depot dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@pytest.mark.parametrize("num_jobs", [1, 4])
+def test_bench_append_resources(s3_standin, rtdc_files, benchmark_results,
+                                num_jobs):
+    paths, total = rtdc_files
+    ds_dict = make_dataset_via_s3(activate=False)
+    with benchmark_results.measure("app_res.append_resources",
+                                   len(paths), total, num_jobs=num_jobs):
+        app_res.append_resources(paths=paths,
+                                 dataset_id=ds_dict["id"],
+                                 num_jobs=num_jobs)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_depot dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+def test_bench_job_migrate_resource_to_s3(s3_standin, rtdc_files,
+                                          benchmark_results, monkeypatch,
+                                          tmp_path):
+    _, total = rtdc_files
+    ds_dict = make_depot_dataset(rtdc_files, monkeypatch, tmp_path)
+    with benchmark_results.measure("jobs.job_migrate_resource_to_s3",
+                                   len(ds_dict["resources"]), total):
+        for res_dict in ds_dict["resources"]:
+            assert jobs.job_migrate_resource_to_s3(res_dict)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_depot dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@pytest.mark.parametrize("num_jobs", [1, 4])
+def test_bench_cli_migrate(s3_standin, rtdc_files, benchmark_results,
+                           monkeypatch, tmp_path, cli, num_jobs):
+    _, total = rtdc_files
+    ds_dict = make_depot_dataset(rtdc_files, monkeypatch, tmp_path)
+    with benchmark_results.measure("dcor-migrate-resources-to-object-store",
+                                   len(ds_dict["resources"]), total,
+                                   num_jobs=num_jobs):
+        result = cli.invoke(ckan_cli,
+                            ["dcor-migrate-resources-to-object-store",
+                             "--verify-existence",
+                             "--jobs", str(num_jobs)])
+    assert "Done!" in result.output
+    assert f"{len(ds_dict['resources'])} checked" in result.output
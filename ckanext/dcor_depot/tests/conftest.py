@@ -0,0 +1,30 @@
+import boto3
+import pytest
+
+from dcor_shared import s3
+
+from ckanext.dcor_depot import ratelimit, s3_util
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    """S3 client of a mocked (moto) S3 service used by the depot"""
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        monkeypatch.setattr(s3, "get_s3", lambda: (client, None, None))
+        yield client
+
+
+@pytest.fixture
+def upload_bucket(s3_client, monkeypatch):
+    """Bucket for testing uploads without rate limits"""
+    monkeypatch.setattr(s3, "require_bucket",
+                        lambda bucket_name: s3_client.create_bucket(
+                            Bucket=bucket_name))
+    monkeypatch.setattr(s3_util, "_required_buckets", set())
+    monkeypatch.setattr(s3_util, "get_ckan_config_option",
+                        lambda key: "http://s3.example.com")
+    monkeypatch.setattr(s3_util, "get_s3_rate_limiter",
+                        lambda: ratelimit.S3RateLimiter())
+    return "circle-upload"
@@ -0,0 +1,109 @@
+import pytest
+
+from ckanext.dcor_depot import app_res, checksum_cache, s3_util
+
+
+@pytest.fixture
+def ckan_actions(upload_bucket, monkeypatch, tmp_path):
+    """Record the calls of `package_show` and `package_revise`"""
+    calls = []
+    ds_dict = {"id": "dataset-id",
+               "organization": {"id": "org-id"},
+               "private": True,
+               "resources": [],
+               }
+
+    def package_show(context, data_dict):
+        calls.append(("package_show", data_dict))
+        return ds_dict
+
+    def package_revise(context, data_dict):
+        calls.append(("package_revise", data_dict))
+
+    actions = {"package_show": package_show,
+               "package_revise": package_revise}
+    monkeypatch.setattr(app_res.logic, "get_action", actions.__getitem__)
+    monkeypatch.setattr(app_res, "get_s3_bucket_name",
+                        lambda org_id: upload_bucket)
+    cache = checksum_cache.ChecksumCache(tmp_path / "sha256_cache.sqlite3")
+    monkeypatch.setattr(app_res, "get_checksum_cache", lambda: cache)
+    return calls
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    path = tmp_path / "data"
+    path.mkdir()
+    for name in ["a.rtdc", "b.rtdc", "c.txt", ".hidden.rtdc"]:
+        (path / name).write_text(name)
+    (path / "subdir").mkdir()
+    (path / "subdir" / "d.rtdc").write_text("d.rtdc")
+    return path
+
+
+def test_expand_paths_directory(data_dir):
+    assert app_res.expand_paths([data_dir]) == [
+        data_dir / "a.rtdc", data_dir / "b.rtdc", data_dir / "c.txt"]
+
+
+def test_expand_paths_glob(data_dir):
+    assert app_res.expand_paths([str(data_dir / "*.rtdc")]) == [
+        data_dir / "a.rtdc", data_dir / "b.rtdc"]
+    assert app_res.expand_paths([str(data_dir / "*.h5")]) == []
+
+
+def test_expand_paths_deduplicate(data_dir):
+    assert app_res.expand_paths([data_dir / "b.rtdc",
+                                 str(data_dir / "*.rtdc"),
+                                 str(data_dir / "b.rtdc"),
+                                 data_dir / "subdir" / "d.rtdc"]) == [
+        data_dir / "a.rtdc", data_dir / "b.rtdc",
+        data_dir / "subdir" / "d.rtdc"]
+
+
+def test_append_resources(s3_client, upload_bucket, ckan_actions, data_dir):
+    app_res.append_resources(paths=[data_dir, data_dir / "subdir"],
+                             dataset_id="dataset-name",
+                             delete_source=True,
+                             num_jobs=2)
+    # all resources are added with a single package_revise call
+    assert [name for name, _ in ckan_actions] == [
+        "package_show", "package_show", "package_revise"]
+    revise = ckan_actions[-1][1]
+    assert revise["match__id"] == "dataset-id"
+    res_dicts = revise["update__resources__extend"]
+    assert [rd["name"] for rd in res_dicts] == [
+        "a.rtdc", "b.rtdc", "c.txt", "d.rtdc"]
+    for res_dict in res_dicts:
+        assert res_dict["s3_available"]
+        obj = s3_client.get_object(
+            Bucket=upload_bucket,
+            Key=app_res.get_s3_object_name(res_dict["id"]))
+        assert obj["Body"].read() == res_dict["name"].encode()
+    # the sources are deleted, hidden files are ignored
+    assert sorted(pp.name for pp in data_dir.rglob("*") if pp.is_file()) \
+        == [".hidden.rtdc"]
+
+
+def test_append_resources_failed_upload(s3_client, upload_bucket,
+                                        ckan_actions, data_dir, monkeypatch):
+    upload_file = s3_util.upload_file
+
+    def upload_file_fails(path, **kwargs):
+        if path.name == "b.rtdc":
+            raise OSError("connection lost")
+        return upload_file(path=path, **kwargs)
+
+    monkeypatch.setattr(s3_util, "upload_file", upload_file_fails)
+    with pytest.raises(ValueError, match="Failed to upload 1 of 3 files"):
+        app_res.append_resources(paths=[data_dir],
+                                 dataset_id="dataset-id",
+                                 delete_source=True)
+    # the successful uploads are appended, so they are not orphaned
+    revise = ckan_actions[-1][1]
+    assert [rd["name"] for rd in revise["update__resources__extend"]] == [
+        "a.rtdc", "c.txt"]
+    # only the source of the failed upload is kept
+    assert (data_dir / "b.rtdc").exists()
+    assert not (data_dir / "a.rtdc").exists()
+    assert not (data_dir / "c.txt").exists()
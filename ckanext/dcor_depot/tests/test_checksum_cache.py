@@ -0,0 +1,39 @@
+import hashlib
+import os
+from unittest import mock
+
+from ckanext.dcor_depot import checksum_cache
+
+
+def test_checksum_cache_hit_and_invalidation(tmp_path):
+    path = tmp_path / "data.bin"
+    path.write_bytes(b"hello")
+    cache = checksum_cache.ChecksumCache(tmp_path / "cache.sqlite3")
+    assert cache.get(path) is None
+
+    sha256 = hashlib.sha256(b"hello").hexdigest()
+    assert cache.sha256sum(path) == sha256
+    # second call must not read the file
+    with mock.patch.object(checksum_cache, "sha256sum",
+                           side_effect=AssertionError("file read")):
+        assert cache.sha256sum(path) == sha256
+
+    # modifying the file invalidates the entry
+    path.write_bytes(b"hello world")
+    st = path.stat()
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert cache.get(path) is None
+    assert cache.sha256sum(path) == hashlib.sha256(b"hello world").hexdigest()
+    cache.close()
+
+
+def test_checksum_cache_persistent(tmp_path):
+    path = tmp_path / "data.bin"
+    path.write_bytes(b"persistent")
+    cache = checksum_cache.ChecksumCache(tmp_path / "cache.sqlite3")
+    cache.set(path, "a" * 64)
+    cache.close()
+
+    cache2 = checksum_cache.ChecksumCache(tmp_path / "cache.sqlite3")
+    assert cache2.get(path) == "a" * 64
+    cache2.close()
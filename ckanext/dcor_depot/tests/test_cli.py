@@ -1,5 +1,8 @@
+import json
 from unittest import mock
 import pathlib
+import threading
+import time
 
 import pytest
 
@@ -15,6 +18,9 @@ import requests
 from dcor_shared.testing import synchronous_enqueue_job
 from dcor_shared.testing import create_with_upload_no_temp  # noqa: F401
 
+from ckanext.dcor_depot import query
+from ckanext.dcor_depot.util import get_s3_bucket_name, get_s3_object_name
+
 
 data_path = pathlib.Path(__file__).parent / "data"
 
@@ -243,3 +249,152 @@ def test_cli_migrate_to_object_store_with_verify_checksum(
     assert "Done!" in result.output
     assert f"Migrating dataset {dataset['id']}" in result.output
     assert f"Verified resource {res_dict['id'][:3]}" in result.output
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_depot dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+def test_cli_list_all_resources(cli):
+    from dcor_shared.testing import make_dataset_via_s3
+    ds_dict, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+
+    result = cli.invoke(ckan_cli, ["list-all-resources"])
+    assert result.output.split() == [res_dict["id"]]
+
+    result = cli.invoke(ckan_cli, ["list-all-resources",
+                                   "--organization", ds_dict["owner_org"],
+                                   "--state", "active",
+                                   "--format", "jsonl"])
+    entry = json.loads(result.output.strip())
+    assert entry["id"] == res_dict["id"]
+    assert entry["package_id"] == ds_dict["id"]
+    assert entry["size"] == res_dict["size"]
+    assert entry["sha256"] == res_dict.get("sha256")
+
+    result = cli.invoke(ckan_cli, ["list-all-resources", "--state", "draft",
+                                   "--format", "csv"])
+    assert result.output.strip() == ",".join(query.RESOURCE_KEYS)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_depot dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+def test_cli_list_s3_objects_for_dataset_json(cli):
+    from dcor_shared.testing import make_dataset_via_s3
+    ds_dict, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+    bucket_name = get_s3_bucket_name(ds_dict["owner_org"])
+    # remove the preview, so there is at least one missing object
+    s3_client, _, _ = dcor_shared.s3.get_s3()
+    s3_client.delete_object(Bucket=bucket_name,
+                            Key=get_s3_object_name(rid, "preview"))
+
+    result = cli.invoke(ckan_cli, ["dcor-list-s3-objects-for-dataset",
+                                   ds_dict["id"],
+                                   "--format", "json",
+                                   "--jobs", "3"])
+    objects = json.loads(result.output)
+    # one entry per artifact in the order of the artifacts
+    assert [(obj["resource_id"], obj["artifact"]) for obj in objects] == [
+        (rid, "resource"), (rid, "condensed"), (rid, "preview")]
+    for obj in objects:
+        assert obj["bucket"] == bucket_name
+        assert obj["object"] == get_s3_object_name(rid, obj["artifact"])
+    resource, _, preview = objects
+    assert resource["exists"]
+    assert resource["public"]
+    assert resource["tags"]["public"] == "true"
+    assert not preview["exists"]
+    assert not preview["public"]
+    assert preview["tags"] == {}
+
+    # text output
+    result = cli.invoke(ckan_cli, ["dcor-list-s3-objects-for-dataset",
+                                   ds_dict["id"]])
+    lines = result.output.strip().split("\n")
+    assert lines[0].startswith(
+        f"{bucket_name}:{get_s3_object_name(rid)} (")
+    assert lines[2] == \
+        f"{bucket_name}:{get_s3_object_name(rid, 'preview')} (not found)"
+
+
+def test_cli_migrate_jobs_order_and_failure(monkeypatch, tmp_path):
+    """Results are reported in order, a failing worker does not abort"""
+    from click.testing import CliRunner
+    from ckanext.dcor_depot import cli as depot_cli
+    from ckanext.dcor_depot import migrate
+
+    rids = [f"{ii}{ii}{ii}-resource" for ii in range(3)]
+    for rid in rids:
+        (tmp_path / rid).write_text("data")
+    ds_dict = {"id": "dataset-id",
+               "owner_org": "org-id",
+               "private": False,
+               "creator_user_id": "user-id"}
+    res_dicts = [{"id": rid, "name": rid} for rid in rids]
+    calls = []
+
+    def migrate_artifact(resource_id, **kwargs):
+        calls.append(("migrate", resource_id))
+        if resource_id == rids[1]:
+            raise ValueError("worker failed")
+        # the first resource finishes last
+        time.sleep(0.2 if resource_id == rids[0] else 0)
+        return {"resource_id": resource_id,
+                "artifact": "resource",
+                "status": "uploaded",
+                "s3_url": f"https://s3.example.com/{resource_id}"}
+
+    def require_bucket(bucket_name):
+        assert threading.current_thread() is threading.main_thread()
+        calls.append(("bucket", bucket_name))
+
+    patches = []
+    monkeypatch.setattr(depot_cli.query, "get_dataset_ids",
+                        lambda modified_days: [ds_dict["id"]])
+    monkeypatch.setattr(depot_cli.query, "iter_dataset_resources",
+                        lambda dataset_ids: iter([(ds_dict, res_dicts)]))
+    monkeypatch.setattr(depot_cli.jobs, "get_resource_path",
+                        lambda rid: tmp_path / rid)
+    monkeypatch.setattr(depot_cli, "get_s3_bucket_name",
+                        lambda org_id: f"circle-{org_id}")
+    monkeypatch.setattr(depot_cli, "get_tmp_dir", lambda: tmp_path)
+    monkeypatch.setattr(depot_cli.s3_util, "require_bucket", require_bucket)
+    monkeypatch.setattr(migrate, "migrate_artifact", migrate_artifact)
+    monkeypatch.setattr(
+        migrate, "patch_resources_noauth",
+        lambda package_id, resource_patches, context=None:
+        patches.append(resource_patches))
+
+    result = CliRunner().invoke(
+        depot_cli.dcor_migrate_resources_to_object_store, ["--jobs", "3"])
+    assert result.exit_code == 0, result.output
+    # the bucket is created once before the workers are started
+    assert calls[0] == ("bucket", "circle-org-id")
+    assert sorted(rid for (kind, rid) in calls if kind == "migrate") == rids
+    lines = [line.split("\r")[-1] for line in result.output.split("\n")]
+    reported = [line for line in lines
+                if line.startswith(("Uploaded", "Failed"))]
+    assert reported[0] == f"Uploaded resource {rids[0]}"
+    assert reported[1].startswith("Failed")
+    assert reported[-1] == f"Uploaded resource {rids[2]}"
+    assert "ValueError: worker failed" in result.output
+    assert "2 uploaded" in result.output
+    assert "1 failed" in result.output
+    # only the successful resources are patched
+    assert [list(patch) for patch in patches] == [[rids[0], rids[2]]]
+
+    # the journal of the finished run does not block the next run
+    (journal_path,) = tmp_path.glob("migrate_resources_journal_*.jsonl")
+    result = CliRunner().invoke(
+        depot_cli.dcor_migrate_resources_to_object_store, ["--jobs", "3"])
+    assert result.exit_code == 0, result.output
+    # but the journal of an interrupted run does
+    with journal_path.open("a") as fd:
+        fd.write('{"rid": "abc", "artifact": "*", "action": "uploaded"}\n')
+    result = CliRunner().invoke(
+        depot_cli.dcor_migrate_resources_to_object_store, ["--jobs", "3"])
+    assert result.exit_code != 0
+    assert "--resume" in result.output
@@ -0,0 +1,114 @@
+import hashlib
+import http.server
+import os
+import threading
+
+import pytest
+
+from ckanext.dcor_depot import download
+
+
+DATA = os.urandom(3 * 1024**2 + 17)
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serve `DATA` with range support, dropping the first connection"""
+    drop_after = None
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(DATA)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        RangeHandler.requests.append(self.headers.get("Range"))
+        start, stop = 0, len(DATA)
+        if self.headers.get("Range"):
+            rng = self.headers["Range"].split("=")[1]
+            first, last = rng.split("-")
+            start = int(first)
+            stop = int(last) + 1 if last else len(DATA)
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             f"bytes {start}-{stop - 1}/{len(DATA)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(stop - start))
+        self.end_headers()
+        if RangeHandler.drop_after is not None:
+            # simulate a dropped connection
+            self.wfile.write(DATA[start:start + RangeHandler.drop_after])
+            RangeHandler.drop_after = None
+            self.close_connection = True
+            return
+        self.wfile.write(DATA[start:stop])
+
+
+@pytest.fixture
+def url():
+    RangeHandler.requests = []
+    RangeHandler.drop_after = None
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/data.bin"
+    server.shutdown()
+
+
+def test_download_resume_after_drop(url, tmp_path, monkeypatch):
+    monkeypatch.setattr(download.time, "sleep", lambda x: None)
+    RangeHandler.drop_after = 1024**2
+    path = tmp_path / "data.bin"
+    sha256 = download.download_file(url, path,
+                                    ret_sha256=True,
+                                    md5=hashlib.md5(DATA).hexdigest(),
+                                    size=len(DATA))
+    assert sha256 == hashlib.sha256(DATA).hexdigest()
+    assert path.read_bytes() == DATA
+    assert not (tmp_path / "data.bin.part").exists()
+    assert RangeHandler.requests == [None, f"bytes={1024**2}-"]
+
+
+def test_download_resume_existing_part(url, tmp_path):
+    path = tmp_path / "data.bin"
+    (tmp_path / "data.bin.part").write_bytes(DATA[:12345])
+    sha256 = download.download_file(url, path,
+                                    ret_sha256=True,
+                                    size=len(DATA))
+    assert sha256 == hashlib.sha256(DATA).hexdigest()
+    assert RangeHandler.requests == ["bytes=12345-"]
+
+
+def test_download_md5_mismatch_removes_part(url, tmp_path):
+    path = tmp_path / "data.bin"
+    with pytest.raises(ValueError, match="MD5 sum mismatch"):
+        download.download_file(url, path, md5="0" * 32)
+    assert not path.exists()
+    assert not (tmp_path / "data.bin.part").exists()
+
+
+@pytest.mark.parametrize("size", [len(DATA) - 1, len(DATA) + 1])
+def test_download_size_mismatch_removes_part(url, tmp_path, size):
+    path = tmp_path / "data.bin"
+    with pytest.raises(ValueError, match="Size mismatch"):
+        download.download_file(url, path, size=size)
+    assert not path.exists()
+    assert not (tmp_path / "data.bin.part").exists()
+
+
+def test_download_segments(url, tmp_path, monkeypatch):
+    monkeypatch.setattr(download, "MIN_SEGMENT_SIZE", 1024**2)
+    path = tmp_path / "data.bin"
+    sha256 = download.download_file(url, path,
+                                    ret_sha256=True,
+                                    size=len(DATA),
+                                    segments=3)
+    assert sha256 == hashlib.sha256(DATA).hexdigest()
+    assert path.read_bytes() == DATA
+    assert len(RangeHandler.requests) == 3
+    assert not (tmp_path / "data.bin.segments").exists()
@@ -0,0 +1,331 @@
+import functools
+import hashlib
+import http.server
+import json
+import os
+import threading
+
+import pytest
+
+from ckanext.dcor_depot import figshare, s3_util
+from ckanext.dcor_depot.inventory import BucketInventory
+
+
+#: Part size of the multipart uploads in these tests (S3 minimum)
+PART_SIZE = 5 * 1024**2
+DATA = os.urandom(2 * PART_SIZE + 1234)
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    """Serve `DATA`"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(DATA)))
+        self.end_headers()
+        self.wfile.write(DATA)
+
+
+@pytest.fixture
+def file_url():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FileHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/data.rtdc"
+    server.shutdown()
+
+
+@pytest.fixture
+def small_parts(monkeypatch):
+    """Upload in parts of `PART_SIZE`, so that multipart uploads are used"""
+    monkeypatch.setattr(s3_util, "upload_stream",
+                        functools.partial(s3_util.upload_stream,
+                                          part_size=PART_SIZE))
+
+
+DOI = "10.6084/m9.figshare.7771184.v2"
+
+
+class ArticleHandler(http.server.BaseHTTPRequestHandler):
+    """Serve `article` with an ETag, supporting If-None-Match"""
+    protocol_version = "HTTP/1.1"
+    article = {}
+    etag = None
+    #: close the connection after the next response (without telling)
+    drop_keep_alive = False
+    #: tuples of (client port, path, If-None-Match header)
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        ArticleHandler.requests.append((self.client_address[1], self.path,
+                                        self.headers.get("If-None-Match")))
+        if (ArticleHandler.etag
+                and self.headers.get("If-None-Match") == ArticleHandler.etag):
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            data = json.dumps(ArticleHandler.article).encode("utf-8")
+            self.send_response(200)
+            if ArticleHandler.etag:
+                self.send_header("ETag", ArticleHandler.etag)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        if ArticleHandler.drop_keep_alive:
+            ArticleHandler.drop_keep_alive = False
+            self.close_connection = True
+
+
+@pytest.fixture
+def figshare_client(monkeypatch, tmp_path):
+    ArticleHandler.article = {"id": 7771184, "version": 2, "title": "Beads"}
+    ArticleHandler.etag = '"etag-1"'
+    ArticleHandler.drop_keep_alive = False
+    ArticleHandler.requests = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                             ArticleHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(figshare, "FIGSHARE_BASE",
+                        f"http://127.0.0.1:{server.server_port}/v2")
+    client = figshare.FigshareClient(cache_dir=tmp_path / "figshare")
+    yield client
+    client.close()
+    server.shutdown()
+
+
+def assert_no_upload(s3_client, bucket_name):
+    """Make sure that there is no object and no dangling multipart upload"""
+    buckets = s3_client.list_buckets()["Buckets"]
+    if bucket_name not in [bucket["Name"] for bucket in buckets]:
+        # aborted before the bucket was created
+        return
+    assert "Contents" not in s3_client.list_objects_v2(Bucket=bucket_name)
+    assert not s3_client.list_multipart_uploads(
+        Bucket=bucket_name).get("Uploads")
+
+
+def test_stream_file_to_s3(s3_client, upload_bucket, file_url, small_parts):
+    sha256 = figshare.stream_file_to_s3(
+        url=file_url,
+        bucket_name=upload_bucket,
+        object_name="resource/abc",
+        md5=hashlib.md5(DATA).hexdigest(),
+        size=len(DATA),
+        private=False)
+    assert sha256 == hashlib.sha256(DATA).hexdigest()
+    obj = s3_client.get_object(Bucket=upload_bucket, Key="resource/abc")
+    assert obj["Body"].read() == DATA
+    tags = {tag["Key"]: tag["Value"] for tag in s3_client.get_object_tagging(
+        Bucket=upload_bucket, Key="resource/abc")["TagSet"]}
+    assert tags == {"public": "true", "sha256": sha256}
+    assert not s3_client.list_multipart_uploads(
+        Bucket=upload_bucket).get("Uploads")
+
+
+def test_stream_file_to_s3_md5_mismatch(s3_client, upload_bucket, file_url,
+                                        small_parts):
+    with pytest.raises(ValueError, match="MD5 sum mismatch"):
+        figshare.stream_file_to_s3(url=file_url,
+                                   bucket_name=upload_bucket,
+                                   object_name="resource/abc",
+                                   md5="0" * 32,
+                                   size=len(DATA))
+    assert_no_upload(s3_client, upload_bucket)
+
+
+@pytest.mark.parametrize("size", [len(DATA) - 1, len(DATA) + 1,
+                                  PART_SIZE - 1])
+def test_stream_file_to_s3_size_mismatch(s3_client, upload_bucket, file_url,
+                                         small_parts, size):
+    with pytest.raises(ValueError, match="Size mismatch"):
+        figshare.stream_file_to_s3(url=file_url,
+                                   bucket_name=upload_bucket,
+                                   object_name="resource/abc",
+                                   md5=hashlib.md5(DATA).hexdigest(),
+                                   size=size)
+    assert_no_upload(s3_client, upload_bucket)
+
+
+def test_stream_file_to_s3_size_mismatch_no_header(s3_client, upload_bucket,
+                                                   file_url, small_parts,
+                                                   monkeypatch):
+    # only the data are checked if the server announces no size
+    monkeypatch.setattr(figshare, "check_content_length",
+                        lambda response, size: None)
+    with pytest.raises(ValueError, match="Size mismatch"):
+        figshare.stream_file_to_s3(url=file_url,
+                                   bucket_name=upload_bucket,
+                                   object_name="resource/abc",
+                                   size=len(DATA) - PART_SIZE)
+    assert_no_upload(s3_client, upload_bucket)
+
+
+def test_import_file_stage_on_disk_md5_mismatch(s3_client, upload_bucket,
+                                                file_url, tmp_path):
+    path = tmp_path / "figshare" / "data.rtdc"
+    res = {"name": "data.rtdc",
+           "download_url": file_url,
+           "supplied_md5": "0" * 32,
+           "size": len(DATA)}
+    with pytest.raises(ValueError, match="MD5 sum mismatch"):
+        figshare.import_file(res, path,
+                             bucket_name=upload_bucket,
+                             object_name="resource/abc",
+                             private=True,
+                             stage_on_disk=True)
+    assert not path.exists()
+    assert not path.with_name("data.rtdc.part").exists()
+    assert_no_upload(s3_client, upload_bucket)
+
+
+def test_figshare_client_etag(figshare_client):
+    article, unchanged, imported = figshare_client.get_article(DOI)
+    assert article == ArticleHandler.article
+    assert not unchanged
+    assert not imported
+    assert figshare_client.get_cached_article(DOI) == article
+
+    # the cached article is revalidated with its ETag
+    article, unchanged, imported = figshare_client.get_article(DOI)
+    assert article == ArticleHandler.article
+    assert unchanged
+    assert not imported
+    assert [(path, etag) for _, path, etag in ArticleHandler.requests] == [
+        ("/v2/articles/7771184/versions/2", None),
+        ("/v2/articles/7771184/versions/2", '"etag-1"')]
+    # both requests used the same keep-alive connection
+    assert len({port for port, _, _ in ArticleHandler.requests}) == 1
+
+
+def test_figshare_client_imported(figshare_client):
+    figshare_client.get_article(DOI)
+    figshare_client.mark_imported(DOI)
+    # 304 Not Modified
+    assert figshare_client.get_article(DOI)[1:] == (True, True)
+
+    # servers that ignore If-None-Match return the same article
+    ArticleHandler.etag = None
+    assert figshare_client.get_article(DOI)[1:] == (True, True)
+
+    # the imported flag is reset when the article changes
+    ArticleHandler.article = dict(ArticleHandler.article, title="New")
+    article, unchanged, imported = figshare_client.get_article(DOI)
+    assert article["title"] == "New"
+    assert not unchanged
+    assert not imported
+    assert figshare_client.get_article(DOI)[1:] == (True, False)
+
+    figshare_client.mark_imported(DOI)
+    figshare_client.mark_imported(DOI, imported=False)
+    assert figshare_client.get_article(DOI)[1:] == (True, False)
+
+
+def test_figshare_client_retry_dropped_keep_alive(figshare_client):
+    ArticleHandler.drop_keep_alive = True
+    figshare_client.get_article(DOI)
+    # the server closed the connection; the client reconnects once
+    article, unchanged, _ = figshare_client.get_article(DOI)
+    assert article == ArticleHandler.article
+    assert unchanged
+    assert len({port for port, _, _ in ArticleHandler.requests}) == 2
+
+
+def test_figshare_client_error(figshare_client, monkeypatch):
+    monkeypatch.setattr(ArticleHandler, "do_GET",
+                        lambda self: self.send_error(404))
+    with pytest.raises(ConnectionError, match="Not Found"):
+        figshare_client.get_article(DOI)
+
+
+@pytest.fixture
+def figshare_datasets(monkeypatch, tmp_path):
+    """Three figshare articles with datasets in different states
+
+    - the first dataset is complete
+    - the resource of the second dataset is not available on S3
+    - the third dataset is not active
+    """
+    dois = [f"10.6084/m9.figshare.{uid}.v1" for uid in [11, 22, 33]]
+    client = figshare.FigshareClient(cache_dir=tmp_path / "figshare")
+    inventory = BucketInventory("circle-figshare", cache_dir=tmp_path)
+    datasets = []
+    for doi, s3_available, state in zip(dois,
+                                        [True, "false", True],
+                                        ["active", "active", "draft"]):
+        uid, ver = figshare.parse_doi(doi)
+        article = {"doi": doi, "id": int(uid), "version": int(ver),
+                   "files": [{"is_link_only": False,
+                              "supplied_md5": f"{uid:0>32}"},
+                             {"is_link_only": True,
+                              "supplied_md5": "link"}]}
+        client._save(client.get_cache_path(doi),
+                     {"etag": None, "last_modified": None,
+                      "article": article, "imported": True})
+        ds_id = figshare.get_dataset_id(article)
+        rid = figshare.make_id([ds_id, f"{uid:0>32}"])
+        inventory.add(figshare.get_s3_object_name(rid), size=100)
+        datasets.append(({"id": ds_id, "state": state},
+                         [{"id": rid, "s3_available": s3_available}]))
+
+    monkeypatch.setattr(figshare.query, "get_dataset_ids",
+                        lambda organization_id: [ds["id"] for ds, _
+                                                 in datasets])
+    monkeypatch.setattr(figshare.query, "iter_dataset_resources",
+                        lambda dataset_ids: iter(datasets))
+    return dois, client, inventory, datasets
+
+
+def is_imported(client, doi):
+    return client._load(client.get_cache_path(doi))["imported"]
+
+
+def test_find_complete_datasets(figshare_datasets):
+    dois, client, inventory, datasets = figshare_datasets
+    unknown = "10.6084/m9.figshare.44.v1"
+    assert figshare.find_complete_datasets(dois + [unknown],
+                                           organization_id="org-id",
+                                           inventory=inventory,
+                                           client=client) == {dois[0]}
+    # objects missing on S3 make a dataset incomplete
+    inventory.discard(figshare.get_s3_object_name(datasets[0][1][0]["id"]))
+    assert figshare.find_complete_datasets(dois,
+                                           organization_id="org-id",
+                                           inventory=inventory,
+                                           client=client) == set()
+
+
+def test_figshare_incremental(figshare_datasets, monkeypatch, tmp_path):
+    dois, client, inventory, _ = figshare_datasets
+    doifile = tmp_path / "figshare_dois.txt"
+    doifile.write_text("\n".join(dois) + "\n")
+    submitted = []
+
+    def submit_dataset(doi, client, **kwargs):
+        # incomplete datasets must not be skipped because of the cache
+        assert not is_imported(client, doi)
+        submitted.append(doi)
+        return doi, None, []
+
+    monkeypatch.setattr(figshare, "create_figshare_org",
+                        lambda: {"id": "org-id"})
+    monkeypatch.setattr(figshare.pkg_resources, "resource_filename",
+                        lambda *args: str(doifile))
+    monkeypatch.setattr(figshare, "get_s3_bucket_name",
+                        lambda organization_id: inventory.bucket_name)
+    monkeypatch.setattr(figshare, "get_inventory", lambda name: inventory)
+    monkeypatch.setattr(figshare, "FigshareClient", lambda: client)
+    monkeypatch.setattr(figshare, "submit_dataset", submit_dataset)
+
+    figshare.figshare(incremental=True)
+    assert submitted == dois[1:]
+    # complete datasets keep their flag, incomplete ones are reset
+    assert [is_imported(client, doi) for doi in dois] == [True, False, False]
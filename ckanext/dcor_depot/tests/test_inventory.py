@@ -0,0 +1,37 @@
+from ckanext.dcor_depot.inventory import BucketInventory
+
+
+def test_inventory_exists():
+    inv = BucketInventory("circle-test", cache_dir=".", ttl=60)
+    assert not inv.is_fresh
+    inv.add("resource/abc/def/1234", size=42, etag="e1")
+    assert "resource/abc/def/1234" in inv
+    assert inv.exists("resource/abc/def/1234")
+    assert inv.exists("resource/abc/def/1234", size=42)
+    assert not inv.exists("resource/abc/def/1234", size=43)
+    assert not inv.exists("condensed/abc/def/1234")
+    assert inv.get("resource/abc/def/1234")["etag"] == "e1"
+    inv.discard("resource/abc/def/1234")
+    assert "resource/abc/def/1234" not in inv
+
+
+def test_inventory_save_load(tmp_path):
+    inv = BucketInventory("circle-test", cache_dir=tmp_path)
+    inv.add("resource/abc/def/1234", size=42, etag="e1")
+    inv.add("condensed/abc/def/1234", size=12, etag="e2")
+    inv.timestamp = 1000
+    inv.save()
+
+    inv2 = BucketInventory("circle-test", cache_dir=tmp_path)
+    assert inv2.load()
+    assert len(inv2) == 2
+    assert inv2.timestamp == 1000
+    assert not inv2.is_fresh
+    assert inv2.exists("condensed/abc/def/1234", size=12)
+    assert list(inv2.iter_objects("resource/")) == ["resource/abc/def/1234"]
+
+
+def test_inventory_load_missing(tmp_path):
+    inv = BucketInventory("circle-test", cache_dir=tmp_path)
+    assert not inv.load()
+    assert len(inv) == 0
@@ -8,6 +8,7 @@ ckan.plugins.toolkit.enqueue_job function with a mock that executes jobs
 synchronously instead of asynchronously
 """
 import pathlib
+import time
 from unittest import mock
 
 import pytest
@@ -21,6 +22,9 @@ import dcor_shared
 
 from dcor_shared.testing import synchronous_enqueue_job
 
+from ckanext.dcor_depot import jobs
+from ckanext.dcor_depot.plugin import DCORDepotPlugin
+
 
 data_path = pathlib.Path(__file__).parent / "data"
 
@@ -105,3 +109,263 @@ def test_migrate_to_s3_private_dataset(enqueue_job_mock, create_with_upload,
     response = requests.get(s3_url)
     assert not response.ok, "resource is private"
     assert response.status_code == 403, "resource is private"
+
+
+@pytest.fixture
+def redis_conn(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    conn = fakeredis.FakeRedis()
+    monkeypatch.setattr(jobs, "connect_to_redis", lambda: conn)
+    return conn
+
+
+@pytest.fixture
+def migration_env(redis_conn, monkeypatch, tmp_path):
+    """Three ready resources "r1", "r2", "r3" of dataset "pkg" pending"""
+    rids = ["r1", "r2", "r3"]
+    pending_key = jobs.MIGRATION_PENDING_KEY.format(
+        package_id="pkg", queue=jobs.MIGRATION_QUEUE_BULK)
+    redis_conn.sadd(pending_key, *rids)
+    for rid in rids:
+        (tmp_path / rid).write_bytes(b"data")
+    ds_dict = {"id": "pkg",
+               "owner_org": "org",
+               "private": False,
+               "resources": [{"id": rid} for rid in rids]}
+    monkeypatch.setattr(jobs.s3, "is_available", lambda: True)
+    monkeypatch.setattr(jobs, "get_resource_state", lambda rid: "active")
+    monkeypatch.setattr(jobs, "get_depot_path", lambda rid: tmp_path / rid)
+    monkeypatch.setattr(jobs, "get_s3_bucket_name", lambda org: "bucket")
+    monkeypatch.setattr(jobs.logic, "get_action",
+                        lambda name: lambda context, data_dict: ds_dict)
+    return pending_key
+
+
+def test_migrate_dataset_resources_failed_upload(migration_env, redis_conn,
+                                                 monkeypatch):
+    def upload_depot_file(resource_id, **kwargs):
+        if resource_id == "r2":
+            raise ValueError("S3 is down")
+        return f"https://s3/{resource_id}", True
+
+    patched = {}
+    monkeypatch.setattr(jobs, "upload_depot_file", upload_depot_file)
+    monkeypatch.setattr(
+        jobs, "patch_resources_noauth",
+        lambda package_id, resource_patches: patched.update(
+            resource_patches))
+
+    with pytest.raises(RuntimeError, match="r2"):
+        jobs.job_migrate_dataset_resources_to_s3("pkg")
+    # the other resources are migrated and patched
+    assert sorted(patched) == ["r1", "r3"]
+    assert patched["r1"] == {"s3_available": True,
+                             "s3_url": "https://s3/r1"}
+    # the failed resource is pending again, so a requeued job retries it
+    assert redis_conn.smembers(migration_env) == {b"r2"}
+
+    monkeypatch.setattr(jobs, "upload_depot_file",
+                        lambda resource_id, **kwargs: ("url", True))
+    assert jobs.job_migrate_dataset_resources_to_s3("pkg") == 1
+    assert not redis_conn.exists(migration_env)
+
+
+def test_migrate_dataset_resources_failed_patch(migration_env, redis_conn,
+                                                monkeypatch):
+    def patch_resources_noauth(package_id, resource_patches):
+        raise ValueError("Solr is down")
+
+    monkeypatch.setattr(jobs, "upload_depot_file",
+                        lambda resource_id, **kwargs: ("url", True))
+    monkeypatch.setattr(jobs, "patch_resources_noauth",
+                        patch_resources_noauth)
+    with pytest.raises(ValueError, match="Solr is down"):
+        jobs.job_migrate_dataset_resources_to_s3("pkg")
+    assert redis_conn.smembers(migration_env) == {b"r1", b"r2", b"r3"}
+
+
+def test_get_migration_queue(monkeypatch):
+    config = {"ckanext.dcor_depot.queue_size_threshold": "1000",
+              "ckanext.dcor_depot.queue_small": "dcor-small",
+              "ckanext.dcor_depot.queue_bulk": "dcor-bulk"}
+    monkeypatch.setattr(jobs, "get_ckan_config_option", config.get)
+    assert jobs.get_migration_queue(999) == "dcor-small"
+    assert jobs.get_migration_queue(1000) == "dcor-bulk"
+    # defaults
+    config.clear()
+    assert jobs.get_migration_queue(jobs.MIGRATION_SIZE_THRESHOLD - 1) \
+        == jobs.MIGRATION_QUEUE_SMALL
+    assert jobs.get_migration_queue(jobs.MIGRATION_SIZE_THRESHOLD) \
+        == jobs.MIGRATION_QUEUE_BULK
+    assert jobs.MIGRATION_QUEUE_SMALL != jobs.MIGRATION_QUEUE_BULK
+
+
+@pytest.fixture
+def rq_queue(redis_conn, monkeypatch):
+    """Mocked RQ queue; `time.sleep` calls are recorded in `sleeps`"""
+    queue = mock.MagicMock()
+    queue.sleeps = []
+    monkeypatch.setattr(jobs.ckan_jobs, "get_queue", lambda name: queue)
+    monkeypatch.setattr(jobs.time, "sleep", queue.sleeps.append)
+    return queue
+
+
+@mock.patch('ckan.plugins.toolkit.enqueue_job')
+def test_migrate_dataset_resources_not_ready(enqueue_job_mock, migration_env,
+                                             redis_conn, rq_queue,
+                                             monkeypatch):
+    migrated = []
+    monkeypatch.setattr(jobs, "get_resource_state",
+                        lambda rid: None if rid == "r2" else "active")
+    monkeypatch.setattr(jobs, "upload_depot_file",
+                        lambda resource_id, **kwargs: (
+                            migrated.append(resource_id) or ("url", True)))
+    monkeypatch.setattr(jobs, "patch_resources_noauth",
+                        lambda package_id, resource_patches: None)
+    assert jobs.job_migrate_dataset_resources_to_s3("pkg") == 2
+    assert migrated == ["r1", "r3"]
+    # r2 is pending again and handled by the next job
+    assert redis_conn.smembers(migration_env) == {b"r2"}
+    assert enqueue_job_mock.call_count == 1
+    assert enqueue_job_mock.call_args.args[2]["attempt"] == 1
+    # the worker is not blocked
+    assert rq_queue.sleeps == []
+
+
+@mock.patch('ckan.plugins.toolkit.enqueue_job')
+def test_migrate_dataset_resources_too_early(enqueue_job_mock, migration_env,
+                                             redis_conn, rq_queue,
+                                             monkeypatch):
+    migrated = []
+    monkeypatch.setattr(jobs, "upload_depot_file",
+                        lambda resource_id, **kwargs: (
+                            migrated.append(resource_id) or ("url", True)))
+    monkeypatch.setattr(jobs, "patch_resources_noauth",
+                        lambda package_id, resource_patches: None)
+    not_before = time.time() + 100
+    assert jobs.job_migrate_dataset_resources_to_s3(
+        "pkg", attempt=2, first_enqueued=1, not_before=not_before) == 0
+    # the job waited briefly and enqueued itself again
+    assert rq_queue.sleeps == [jobs.MIGRATION_MAX_BLOCK]
+    assert migrated == []
+    assert redis_conn.smembers(migration_env) == {b"r1", b"r2", b"r3"}
+    kwargs = enqueue_job_mock.call_args.args[2]
+    assert kwargs["attempt"] == 2
+    assert kwargs["first_enqueued"] == 1
+    assert kwargs["not_before"] == not_before
+    assert enqueue_job_mock.call_args.kwargs["rq_kwargs"]["meta"] == {
+        "dcor_depot": {"not_before": not_before}}
+
+    # when the time has come, the resources are migrated
+    assert jobs.job_migrate_dataset_resources_to_s3(
+        "pkg", attempt=2, first_enqueued=1,
+        not_before=time.time() - 1) == 3
+    assert migrated == ["r1", "r2", "r3"]
+    assert enqueue_job_mock.call_count == 1
+
+
+@mock.patch('ckan.plugins.toolkit.enqueue_job')
+def test_defer_migration_already_queued(enqueue_job_mock, redis_conn,
+                                        rq_queue):
+    queue = jobs.MIGRATION_QUEUE_BULK
+    redis_conn.set(jobs.MIGRATION_QUEUED_KEY.format(package_id="pkg",
+                                                    queue=queue), "1")
+    for _ in range(2):
+        assert jobs.defer_migration("pkg", ["r1"], queue=queue, attempt=1,
+                                    first_enqueued=0)
+    assert redis_conn.smembers(jobs.MIGRATION_PENDING_KEY.format(
+        package_id="pkg", queue=queue)) == {b"r1"}
+    # the job that is already queued takes care of the resources
+    assert not enqueue_job_mock.called
+    assert not rq_queue.enqueue_at.called
+
+
+@mock.patch('ckan.plugins.toolkit.enqueue_job')
+def test_defer_migration_max_attempts(enqueue_job_mock, redis_conn,
+                                      rq_queue):
+    queue = jobs.MIGRATION_QUEUE_BULK
+    assert not jobs.defer_migration("pkg", ["r1"],
+                                    queue=queue,
+                                    attempt=jobs.MIGRATION_MAX_ATTEMPTS + 1,
+                                    first_enqueued=0)
+    # the resources are not dropped, but no job is enqueued
+    assert redis_conn.smembers(jobs.MIGRATION_PENDING_KEY.format(
+        package_id="pkg", queue=queue)) == {b"r1"}
+    assert not redis_conn.exists(jobs.MIGRATION_QUEUED_KEY.format(
+        package_id="pkg", queue=queue))
+    assert not enqueue_job_mock.called
+    assert not rq_queue.enqueue_at.called
+
+
+@pytest.mark.parametrize("scheduler", [True, False])
+@mock.patch('ckan.plugins.toolkit.enqueue_job')
+def test_defer_migration_scheduler(enqueue_job_mock, redis_conn, rq_queue,
+                                   monkeypatch, scheduler):
+    config = {"ckanext.dcor_depot.rq_scheduler": scheduler}
+    monkeypatch.setattr(jobs, "get_ckan_config_option", config.get)
+    t0 = time.time()
+    assert jobs.defer_migration("pkg", ["r1", "r2"],
+                                queue=jobs.MIGRATION_QUEUE_BULK,
+                                attempt=3,
+                                first_enqueued=0)
+    assert redis_conn.exists(jobs.MIGRATION_QUEUED_KEY.format(
+        package_id="pkg", queue=jobs.MIGRATION_QUEUE_BULK))
+    # the worker is not blocked
+    assert rq_queue.sleeps == []
+    delay = 4 * jobs.MIGRATION_RETRY_DELAY
+    if scheduler:
+        assert not enqueue_job_mock.called
+        at, func = rq_queue.enqueue_at.call_args.args
+        assert at.timestamp() == pytest.approx(t0 + delay, abs=5)
+        assert func is jobs.job_migrate_dataset_resources_to_s3
+        assert rq_queue.enqueue_at.call_args.kwargs["kwargs"]["attempt"] == 3
+    else:
+        assert not rq_queue.enqueue_at.called
+        assert enqueue_job_mock.call_count == 1
+        assert enqueue_job_mock.call_args.args[:2] == (
+            jobs.job_migrate_dataset_resources_to_s3, ["pkg"])
+        kwargs = enqueue_job_mock.call_args.args[2]
+        assert kwargs["attempt"] == 3
+        assert kwargs["not_before"] == pytest.approx(t0 + delay, abs=5)
+
+
+@pytest.fixture
+def depot_files(redis_conn, monkeypatch, tmp_path):
+    """Resources "r1" and "r2" of dataset "pkg" on block storage"""
+    for rid in ["r1", "r2"]:
+        (tmp_path / rid).write_bytes(b"data")
+    monkeypatch.setattr(jobs.s3, "is_available", lambda: True)
+    monkeypatch.setattr(jobs, "get_depot_path", lambda rid: tmp_path / rid)
+    monkeypatch.setattr(jobs, "get_migration_queue",
+                        lambda size: jobs.MIGRATION_QUEUE_BULK)
+    return jobs.MIGRATION_PENDING_KEY.format(package_id="pkg",
+                                             queue=jobs.MIGRATION_QUEUE_BULK)
+
+
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_enqueue_migration_no_depot_file(enqueue_job_mock, depot_files,
+                                         redis_conn):
+    DCORDepotPlugin().after_resource_create(
+        context={}, resource={"id": "r3", "package_id": "pkg"})
+    assert not jobs.enqueue_migration({"id": "r3", "package_id": "pkg"})
+    assert not enqueue_job_mock.called
+    assert not redis_conn.keys()
+
+
+@mock.patch('ckan.plugins.toolkit.enqueue_job')
+def test_enqueue_migration_coalesced(enqueue_job_mock, depot_files,
+                                     redis_conn):
+    plugin = DCORDepotPlugin()
+    for rid in ["r1", "r2", "r1"]:
+        plugin.after_resource_create(context={},
+                                     resource={"id": rid,
+                                               "package_id": "pkg"})
+    # background jobs do not trigger a migration
+    plugin.after_resource_create(context={"is_background_job": True},
+                                 resource={"id": "r3", "package_id": "pkg"})
+    # one job for all resources of the dataset
+    assert enqueue_job_mock.call_count == 1
+    assert enqueue_job_mock.call_args.args[:2] == (
+        jobs.job_migrate_dataset_resources_to_s3, ["pkg"])
+    assert redis_conn.smembers(depot_files) == {b"r1", b"r2"}
@@ -0,0 +1,89 @@
+import pytest
+
+from ckanext.dcor_depot.journal import MigrationJournal, get_journal_path
+
+
+def test_journal_resume(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    with MigrationJournal(path) as jn:
+        jn.record("abc", "resource", "uploaded")
+        jn.record("abc", "*", "uploaded")
+        jn.record("def", "preview", "verified")
+
+    with MigrationJournal(path, resume=True) as jn:
+        assert jn.is_done("abc", "*", ["uploaded", "checked"])
+        assert jn.is_done("abc", "resource", ["uploaded"])
+        assert not jn.is_done("abc", "resource", ["verified"])
+        assert not jn.is_done("abc", "preview", ["uploaded"])
+        assert jn.is_done("def", "preview", ["verified"])
+
+
+def test_journal_partial_write(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    with MigrationJournal(path) as jn:
+        jn.record("abc", "resource", "uploaded")
+    # simulate a process that was killed while writing
+    with path.open("a") as fd:
+        fd.write('{"rid": "def", "artifact": "reso')
+
+    with MigrationJournal(path, resume=True) as jn:
+        assert jn.is_done("abc", "resource", ["uploaded"])
+        assert not jn.is_done("def", "resource", ["uploaded"])
+        jn.record("ghi", "resource", "uploaded")
+
+    with MigrationJournal(path, resume=True) as jn:
+        assert jn.is_done("abc", "resource", ["uploaded"])
+        assert jn.is_done("ghi", "resource", ["uploaded"])
+
+
+def test_journal_no_resume_discards(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    with MigrationJournal(path) as jn:
+        jn.record("abc", "resource", "uploaded")
+        jn.finish()
+    with MigrationJournal(path) as jn:
+        assert not jn.is_done("abc", "resource", ["uploaded"])
+    with MigrationJournal(path, resume=True) as jn:
+        assert not jn.is_done("abc", "resource", ["uploaded"])
+
+
+def test_journal_unfinished_requires_resume(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    with MigrationJournal(path) as jn:
+        jn.record("abc", "resource", "uploaded")
+    with pytest.raises(FileExistsError, match="unfinished"):
+        MigrationJournal(path)
+    # the journal is still there
+    with MigrationJournal(path, resume=True) as jn:
+        assert jn.is_done("abc", "resource", ["uploaded"])
+        jn.finish()
+    # a finished journal is discarded
+    with MigrationJournal(path) as jn:
+        assert not jn.is_done("abc", "resource", ["uploaded"])
+        jn.record("def", "resource", "uploaded")
+    with pytest.raises(FileExistsError):
+        MigrationJournal(path)
+
+
+def test_journal_resume_finished(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    with MigrationJournal(path) as jn:
+        jn.finish()
+    with MigrationJournal(path, resume=True) as jn:
+        assert jn.finished
+        jn.record("abc", "resource", "uploaded")
+        assert not jn.finished
+    with pytest.raises(FileExistsError):
+        MigrationJournal(path)
+
+
+def test_get_journal_path(tmp_path):
+    path = get_journal_path(tmp_path, "migrate", modified_days=2,
+                            verify_checksum=True)
+    assert path.parent == tmp_path
+    assert path.name.startswith("migrate_")
+    assert path.suffix == ".jsonl"
+    assert path == get_journal_path(tmp_path, "migrate",
+                                    verify_checksum=True, modified_days=2)
+    assert path != get_journal_path(tmp_path, "migrate", modified_days=3,
+                                    verify_checksum=True)
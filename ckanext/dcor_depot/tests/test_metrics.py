@@ -0,0 +1,41 @@
+import socket
+
+from ckanext.dcor_depot import metrics
+
+
+def test_metrics_disabled(monkeypatch):
+    monkeypatch.setattr(metrics, "_metrics", None)
+    monkeypatch.setattr(metrics, "_configured", True)
+    assert metrics.timer("hash") is metrics.timer("s3_upload")
+    metrics.add_bytes("uploaded", 100)
+    metrics.flush()
+    assert metrics.get_metrics() is None
+
+
+def test_metrics_prometheus_and_statsd(monkeypatch, tmp_path):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(5)
+    monkeypatch.setattr(metrics, "_metrics", None)
+    monkeypatch.setattr(metrics, "_configured", False)
+    mets = metrics.enable(
+        textfile=tmp_path / "depot_{pid}.prom",
+        statsd=f"127.0.0.1:{sock.getsockname()[1]}")
+    with metrics.timer("hash"):
+        pass
+    with metrics.timer("hash"):
+        pass
+    metrics.add_bytes("uploaded", 1234)
+    assert mets.calls["hash"] == 2
+    assert "hash" in mets.summary()
+
+    metrics.flush()
+    text = mets.textfile.read_text()
+    assert 'dcor_depot_phase_calls_total{phase="hash",' in text
+    assert 'dcor_depot_bytes_total{counter="uploaded",' in text
+    assert text.rstrip().endswith(" 1234")
+
+    assert sock.recv(1024).startswith(b"dcor_depot.hash:")
+    sock.recv(1024)
+    assert sock.recv(1024) == b"dcor_depot.bytes.uploaded:1234|c"
+    sock.close()
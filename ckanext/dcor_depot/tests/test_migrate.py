@@ -0,0 +1,130 @@
+import pytest
+
+from ckanext.dcor_depot import checksum_cache, migrate
+from ckanext.dcor_depot.inventory import BucketInventory
+from ckanext.dcor_depot.util import get_s3_object_name
+
+
+RID = "0123456789abcdef-0123456789abcdef0123"
+
+
+@pytest.fixture
+def patch_calls(monkeypatch):
+    """Record the calls of `patch_resources_noauth`"""
+    calls = []
+
+    def patch_resources_noauth(package_id, resource_patches, context=None):
+        calls.append((package_id, resource_patches, context))
+
+    monkeypatch.setattr(migrate, "patch_resources_noauth",
+                        patch_resources_noauth)
+    return calls
+
+
+def test_batcher_flush_size(patch_calls):
+    batcher = migrate.ResourcePatchBatcher(flush_size=3)
+    for ii in range(2):
+        batcher.add("pkg", f"r{ii}", {"s3_available": True})
+    assert patch_calls == []
+    batcher.add("pkg", "r2", {"s3_available": True})
+    assert len(patch_calls) == 1
+    assert patch_calls[0][0] == "pkg"
+    assert sorted(patch_calls[0][1]) == ["r0", "r1", "r2"]
+    assert batcher.pending == {}
+    # nothing left to flush
+    batcher.flush()
+    assert len(patch_calls) == 1
+
+
+def test_batcher_per_dataset(patch_calls):
+    batcher = migrate.ResourcePatchBatcher(flush_size=2)
+    batcher.add("pkg1", "r1", {"s3_url": "a"}, user="alice")
+    batcher.add("pkg2", "r2", {"s3_url": "b"})
+    batcher.add("pkg2", "r2", {"s3_url": "c"})  # same resource again
+    assert patch_calls == []
+    batcher.add("pkg2", "r3", {"s3_url": "d"})
+    # only the dataset that reached the flush size is patched
+    assert patch_calls == [("pkg2",
+                            {"r2": {"s3_url": "c"}, "r3": {"s3_url": "d"}},
+                            {"ignore_auth": True, "user": "default"})]
+    batcher.flush()
+    assert patch_calls[1] == ("pkg1", {"r1": {"s3_url": "a"}},
+                              {"ignore_auth": True, "user": "alice"})
+    assert len(patch_calls) == 2
+
+
+def test_batcher_callback_error(monkeypatch):
+    def patch_resources_noauth(package_id, resource_patches, context=None):
+        if package_id == "pkg-bad":
+            raise ValueError("validation failed")
+
+    monkeypatch.setattr(migrate, "patch_resources_noauth",
+                        patch_resources_noauth)
+    results = {}
+    batcher = migrate.ResourcePatchBatcher()
+    for pid, rid in [("pkg-bad", "r1"), ("pkg-bad", "r2"), ("pkg", "r3")]:
+        batcher.add(pid, rid, {"s3_available": True},
+                    callback=lambda rid, error: results.update({rid: error}))
+    batcher.flush()
+    assert results["r3"] is None
+    for rid in ["r1", "r2"]:
+        assert results[rid].startswith("Traceback")
+        assert "ValueError: validation failed" in results[rid]
+
+
+@pytest.fixture
+def depot_file(upload_bucket, monkeypatch, tmp_path):
+    """Resource file on block storage with a temporary checksum cache"""
+    cache = checksum_cache.ChecksumCache(tmp_path / "sha256_cache.sqlite3")
+    monkeypatch.setattr(migrate, "get_checksum_cache", lambda: cache)
+    path = tmp_path / "resource"
+    path.write_bytes(b"resource data")
+    return path
+
+
+def migrate_depot_file(path, bucket_name, **kwargs):
+    return migrate.migrate_artifact(resource_id=RID,
+                                    artifact="resource",
+                                    local_path=path,
+                                    bucket_name=bucket_name,
+                                    **kwargs)
+
+
+def test_migrate_artifact_delete(s3_client, upload_bucket, depot_file):
+    result = migrate_depot_file(depot_file, upload_bucket,
+                                delete_after_migration=True)
+    assert result["status"] == "uploaded"
+    assert result["deleted"]
+    assert not depot_file.exists()
+    obj = s3_client.get_object(Bucket=upload_bucket,
+                               Key=get_s3_object_name(RID))
+    assert obj["Body"].read() == b"resource data"
+
+
+def test_migrate_artifact_stale_inventory(s3_client, upload_bucket,
+                                          depot_file, tmp_path):
+    s3_client.create_bucket(Bucket=upload_bucket)
+    # the inventory claims the object exists, but it is not on S3
+    inventory = BucketInventory(upload_bucket, cache_dir=tmp_path)
+    inventory.add(get_s3_object_name(RID), size=depot_file.stat().st_size)
+    result = migrate_depot_file(depot_file, upload_bucket,
+                                inventory=inventory,
+                                delete_after_migration=True)
+    assert result["status"] == "failed"
+    assert "not deleting" in result["error"]
+    assert not result["deleted"]
+    assert depot_file.exists()
+
+
+def test_migrate_artifact_corrupt_object(s3_client, upload_bucket,
+                                         depot_file):
+    # an object of the same size but with different data exists on S3
+    s3_client.create_bucket(Bucket=upload_bucket)
+    s3_client.put_object(Bucket=upload_bucket,
+                         Key=get_s3_object_name(RID),
+                         Body=b"resource DATA")
+    result = migrate_depot_file(depot_file, upload_bucket,
+                                verify_existence=True,
+                                delete_after_migration=True)
+    assert result["status"] == "failed"
+    assert depot_file.exists()
@@ -0,0 +1,93 @@
+import pathlib
+
+import pytest
+
+import ckan.model as model
+import ckan.tests.factories as factories
+
+from dcor_shared.testing import make_dataset_via_s3
+
+from ckanext.dcor_depot import query
+
+
+data_path = pathlib.Path(__file__).parent / "data"
+
+
+@pytest.mark.parametrize("res_dict,expected", [
+    ({}, False),
+    ({"s3_available": True}, True),
+    ({"s3_available": False}, False),
+    ({"s3_available": "True"}, True),
+    ({"s3_available": "true"}, True),
+    ({"s3_available": "false"}, False),
+    ({"s3_available": "False"}, False),
+    ({"s3_available": None}, False),
+])
+def test_is_s3_available(res_dict, expected):
+    assert query.is_s3_available(res_dict) is expected
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_depot dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+def test_iter_dataset_resources():
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    ds_empty = make_dataset_via_s3(create_context=create_context,
+                                   owner_org=owner_org)
+    datasets = [make_dataset_via_s3(
+        create_context=create_context,
+        owner_org=owner_org,
+        resource_path=data_path / "calibration_beads_47.rtdc")
+        for _ in range(3)]
+
+    # store an additional key in the resource extras
+    ds_dict, res_dict = datasets[0]
+    resource = model.Resource.get(res_dict["id"])
+    resource.extras = dict(resource.extras, sha256="a" * 64, color="blue")
+    model.Session.commit()
+
+    # order that differs from the ID order, with unknown IDs
+    dataset_ids = [datasets[2][0]["id"],
+                   "unknown-dataset",
+                   ds_empty["id"],
+                   datasets[0][0]["id"],
+                   datasets[1][0]["id"]]
+    # small batches, so the datasets are spread over multiple queries
+    results = list(query.iter_dataset_resources(dataset_ids, batch_size=2))
+
+    assert [ds["id"] for ds, _ in results] == [
+        datasets[2][0]["id"],
+        ds_empty["id"],
+        datasets[0][0]["id"],
+        datasets[1][0]["id"]]
+
+    for ds, res_dicts in results:
+        assert ds["owner_org"] == owner_org["id"]
+        assert ds["creator_user_id"] == user["id"]
+        assert ds["state"] == "draft"
+
+    # dataset without resources (outer join)
+    assert results[1][1] == []
+
+    # all other datasets have exactly one resource
+    for (ds_ref, res_ref), (ds, res_dicts) in zip(
+            [datasets[2], datasets[0], datasets[1]],
+            [results[0], results[2], results[3]]):
+        assert len(res_dicts) == 1
+        assert res_dicts[0]["id"] == res_ref["id"]
+        assert res_dicts[0]["package_id"] == ds_ref["id"]
+        assert res_dicts[0]["name"] == "calibration_beads_47.rtdc"
+        assert res_dicts[0]["state"] == "active"
+        assert query.is_s3_available(res_dicts[0])
+
+    # the resource extras are merged into the resource dictionary
+    res_extras = results[2][1][0]
+    assert res_extras["sha256"] == "a" * 64
+    assert res_extras["color"] == "blue"
+    assert "color" not in results[3][1][0]
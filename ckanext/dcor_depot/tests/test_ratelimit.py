@@ -0,0 +1,29 @@
+from unittest import mock
+
+import pytest
+
+from ckanext.dcor_depot import ratelimit
+
+
+def test_rate_limiter_disabled():
+    redis_conn = mock.MagicMock()
+    limiter = ratelimit.S3RateLimiter(0, 0, redis_conn=redis_conn)
+    limiter.acquire(num_bytes=1024**3, num_requests=100)
+    assert limiter.bytes_bucket is None
+    assert limiter.requests_bucket is None
+    assert not redis_conn.mock_calls
+
+
+def test_token_bucket(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    sleeps = []
+    monkeypatch.setattr(ratelimit.time, "sleep", sleeps.append)
+    bucket = ratelimit.TokenBucket("test", rate=10,
+                                   redis_conn=fakeredis.FakeRedis())
+    # the first second is free
+    assert bucket.acquire(10) == 0
+    # then the bucket is in debt
+    wait = bucket.acquire(5)
+    assert 0.4 < wait <= 0.5
+    assert sleeps == [wait]
@@ -0,0 +1,150 @@
+import uuid
+
+from dcor_shared import s3
+
+from ckanext.dcor_depot import reconcile
+from ckanext.dcor_depot.util import get_s3_object_name as object_name
+
+
+def make_rid():
+    return str(uuid.uuid4())
+
+
+def write_local(storage_path, rid, suffix=""):
+    path = storage_path / "resources" / rid[:3] / rid[3:6] / (rid[6:] + suffix)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"data")
+    return str(path)
+
+
+def test_object_regex():
+    rid = make_rid()
+    for artifact in ["resource", "condensed", "preview"]:
+        match = reconcile.OBJECT_REGEX.match(object_name(rid, artifact))
+        assert match.group("artifact") == artifact
+        assert match.group("r1") + match.group("r2") + match.group("r3") \
+            == rid
+    assert reconcile.OBJECT_REGEX.match(object_name(rid, "thumbnail")) \
+        is None
+    assert reconcile.OBJECT_REGEX.match(object_name(rid) + ".rtdc") is None
+    assert reconcile.OBJECT_REGEX.match(object_name(rid.upper())) is None
+    assert reconcile.OBJECT_REGEX.match("resource/abc/def") is None
+
+
+def test_iter_local_artifacts(monkeypatch, tmp_path):
+    monkeypatch.setattr(reconcile, "get_ckan_storage_path", lambda: tmp_path)
+    # no resources directory
+    assert list(reconcile.iter_local_artifacts()) == []
+
+    rid = make_rid()
+    path_res = write_local(tmp_path, rid)
+    path_cond = write_local(tmp_path, rid, "_condensed.rtdc")
+    path_prev = write_local(tmp_path, rid, "_preview.jpg")
+    # ignored
+    (tmp_path / "resources" / "unrelated").mkdir()
+    (tmp_path / "resources" / "unrelated" / "file").write_bytes(b"")
+    (tmp_path / "resources" / rid[:3] / rid[3:6] / "subdir").mkdir()
+
+    assert sorted(reconcile.iter_local_artifacts()) == sorted([
+        (path_res, rid, "resource"),
+        (path_cond, rid, "condensed"),
+        (path_prev, rid, "preview"),
+    ])
+
+
+def test_iter_storage_drift(s3_client, monkeypatch, tmp_path):
+    rid_ok = make_rid()  # on S3 and still on block storage
+    rid_missing = make_rid()  # marked s3_available, but not on S3
+    rid_local = make_rid()  # not yet migrated
+    rid_false = make_rid()  # s3_available stored as the string "false"
+    rid_orphan_s3 = make_rid()  # on S3, but not in the database
+    rid_orphan_local = make_rid()  # on block storage, not in the database
+
+    monkeypatch.setattr(reconcile, "get_ckan_storage_path", lambda: tmp_path)
+    monkeypatch.setattr(reconcile, "get_s3_bucket_name",
+                        lambda org: f"circle-{org}")
+    monkeypatch.setattr(reconcile.query, "get_dataset_ids", lambda: ["pkg"])
+    monkeypatch.setattr(
+        reconcile.query, "iter_dataset_resources",
+        lambda dataset_ids: iter([
+            ({"id": "pkg", "owner_org": "org"},
+             [{"id": rid_ok, "s3_available": True},
+              {"id": rid_missing, "s3_available": True},
+              {"id": rid_local},
+              {"id": rid_false, "s3_available": "false"}]),
+            ({"id": "empty", "owner_org": "empty"}, []),
+        ]))
+    monkeypatch.setattr(s3, "iter_buckets",
+                        lambda: iter(["circle-org", "circle-other"]))
+
+    for bucket_name in ["circle-org", "circle-other"]:
+        s3_client.create_bucket(Bucket=bucket_name)
+    for key in [object_name(rid_ok),
+                object_name(rid_ok, "condensed"),
+                object_name(rid_missing, "preview"),
+                "README.md"]:
+        s3_client.put_object(Bucket="circle-org", Key=key, Body=b"data")
+    s3_client.put_object(Bucket="circle-other",
+                         Key=object_name(rid_orphan_s3), Body=b"data")
+
+    path_ok = write_local(tmp_path, rid_ok)
+    # condensed file is on S3, but the preview is not
+    path_ok_cond = write_local(tmp_path, rid_ok, "_condensed.rtdc")
+    path_ok_prev = write_local(tmp_path, rid_ok, "_preview.jpg")
+    path_local = write_local(tmp_path, rid_local)
+    path_local_cond = write_local(tmp_path, rid_local, "_condensed.rtdc")
+    path_orphan = write_local(tmp_path, rid_orphan_local)
+
+    expected = [
+        {"category": "missing_object",
+         "bucket": "circle-org",
+         "object": object_name(rid_missing),
+         "resource_id": rid_missing},
+        {"category": "orphaned_object",
+         "bucket": "circle-other",
+         "object": object_name(rid_orphan_s3),
+         "resource_id": rid_orphan_s3,
+         "size": 4},
+        {"category": "local_leftover",
+         "path": path_ok,
+         "resource_id": rid_ok,
+         "artifact": "resource",
+         "size": 4},
+        {"category": "local_leftover",
+         "path": path_ok_cond,
+         "resource_id": rid_ok,
+         "artifact": "condensed",
+         "size": 4},
+        {"category": "local_only",
+         "path": path_ok_prev,
+         "resource_id": rid_ok,
+         "artifact": "preview",
+         "size": 4},
+        {"category": "local_only",
+         "path": path_local,
+         "resource_id": rid_local,
+         "artifact": "resource",
+         "size": 4},
+        {"category": "local_only",
+         "path": path_local_cond,
+         "resource_id": rid_local,
+         "artifact": "condensed",
+         "size": 4},
+        {"category": "orphaned_local",
+         "path": path_orphan,
+         "resource_id": rid_orphan_local,
+         "artifact": "resource",
+         "size": 4},
+    ]
+
+    def sort_key(finding):
+        return (finding["category"], finding["resource_id"],
+                finding.get("artifact", ""))
+
+    drift = list(reconcile.iter_storage_drift())
+    assert sorted(drift, key=sort_key) == sorted(expected, key=sort_key)
+
+    # without block storage
+    assert {d["category"] for d in
+            reconcile.iter_storage_drift(check_local=False)} \
+        == {"missing_object", "orphaned_object"}
@@ -0,0 +1,230 @@
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from dcor_shared import s3
+
+from ckanext.dcor_depot import s3_util
+
+
+#: smallest part size allowed by S3
+PART_SIZE = 5 * 1024**2
+
+
+def get_tags(s3_client, bucket_name, object_name):
+    tag_set = s3_client.get_object_tagging(Bucket=bucket_name,
+                                           Key=object_name)["TagSet"]
+    return {it["Key"]: it["Value"] for it in tag_set}
+
+
+def test_prune_multipart_uploads(s3_client, monkeypatch):
+    for bucket_name in ["circle-a", "circle-b", "circle-c"]:
+        s3_client.create_bucket(Bucket=bucket_name)
+        for ii in range(3):
+            upload_id = s3_client.create_multipart_upload(
+                Bucket=bucket_name, Key=f"resource/{ii}")["UploadId"]
+            s3_client.upload_part(Bucket=bucket_name, Key=f"resource/{ii}",
+                                  UploadId=upload_id, PartNumber=1,
+                                  Body=b"data")
+    monkeypatch.setattr(s3, "iter_buckets",
+                        lambda for_circles_only: ["circle-a", "circle-b",
+                                                  "circle-c"])
+
+    # moto reports the initiation date 2010-11-10 for all uploads
+    info = s3_util.prune_multipart_uploads(initiated_before_days=365 * 100)
+    assert info["circle-a"] == {"found": 0, "ignored": 3}
+
+    # dry run
+    info = s3_util.prune_multipart_uploads(initiated_before_days=0,
+                                           dry_run=True)
+    assert info["circle-b"] == {"found": 3, "ignored": 0}
+
+    # prune a subset of the buckets, including a missing bucket
+    info = s3_util.prune_multipart_uploads(
+        initiated_before_days=0,
+        bucket_names=["circle-a", "circle-b", "circle-missing"],
+        num_jobs=2,
+        num_abort_jobs=2)
+    assert info == {"circle-a": {"found": 3, "ignored": 0},
+                    "circle-b": {"found": 3, "ignored": 0},
+                    "circle-missing": {"found": 0, "ignored": 0}}
+    for bucket_name, num in [("circle-a", 0), ("circle-b", 0),
+                             ("circle-c", 3)]:
+        uploads = s3_client.list_multipart_uploads(
+            Bucket=bucket_name).get("Uploads", [])
+        assert len(uploads) == num
+
+
+def test_require_bucket_once(monkeypatch):
+    monkeypatch.setattr(s3_util, "_required_buckets", set())
+    created = []
+    monkeypatch.setattr(s3, "require_bucket", created.append)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(s3_util.require_bucket, ["circle-a"] * 8 + ["circle-b"]))
+    assert sorted(created) == ["circle-a", "circle-b"]
+
+
+@pytest.mark.parametrize("size", [0,  # empty
+                                  1000,  # single part
+                                  PART_SIZE,  # exactly one part
+                                  2 * PART_SIZE,  # multiple of part size
+                                  2 * PART_SIZE + 1000,  # multipart
+                                  ])
+def test_upload_stream(s3_client, upload_bucket, size):
+    data = bytes(range(256)) * (size // 256) + b"x" * (size % 256)
+    sha256 = hashlib.sha256(data).hexdigest()
+    s3_url, sha256_up = s3_util.upload_stream(
+        bucket_name=upload_bucket,
+        object_name="resource/abc",
+        fd=io.BytesIO(data),
+        part_size=PART_SIZE,
+        md5=hashlib.md5(data).hexdigest())
+    assert s3_url == f"http://s3.example.com/{upload_bucket}/resource/abc"
+    assert sha256_up == sha256
+    obj = s3_client.get_object(Bucket=upload_bucket, Key="resource/abc")
+    assert obj["Body"].read() == data
+    assert get_tags(s3_client, upload_bucket, "resource/abc")["sha256"] \
+        == sha256
+
+
+@pytest.mark.parametrize("size", [1000, 2 * PART_SIZE + 1000])
+@pytest.mark.parametrize("checksum", ["sha256", "md5"])
+def test_upload_stream_wrong_checksum(s3_client, upload_bucket, size,
+                                      checksum):
+    kwargs = {checksum: "0" * 32}
+    with pytest.raises(ValueError, match="mismatch"):
+        s3_util.upload_stream(bucket_name=upload_bucket,
+                              object_name="resource/abc",
+                              fd=io.BytesIO(b"a" * size),
+                              part_size=PART_SIZE,
+                              **kwargs)
+    # no object and no dangling multipart upload
+    assert "Contents" not in s3_client.list_objects_v2(Bucket=upload_bucket)
+    assert not s3_client.list_multipart_uploads(
+        Bucket=upload_bucket).get("Uploads")
+
+
+@pytest.mark.parametrize("size,expected", [(1000, 999),
+                                           (1000, 1001),
+                                           (2 * PART_SIZE + 1000, PART_SIZE),
+                                           (2 * PART_SIZE + 1000,
+                                            2 * PART_SIZE + 1001)])
+def test_upload_stream_wrong_size(s3_client, upload_bucket, size, expected):
+    with pytest.raises(ValueError, match="Size mismatch"):
+        s3_util.upload_stream(bucket_name=upload_bucket,
+                              object_name="resource/abc",
+                              fd=io.BytesIO(b"a" * size),
+                              part_size=PART_SIZE,
+                              size=expected)
+    assert "Contents" not in s3_client.list_objects_v2(Bucket=upload_bucket)
+    assert not s3_client.list_multipart_uploads(
+        Bucket=upload_bucket).get("Uploads")
+
+
+@pytest.mark.parametrize("sha256_known", [True, False])
+def test_upload_file_sha256_metadata_or_tag(s3_client, upload_bucket,
+                                            tmp_path, sha256_known):
+    path = tmp_path / "data.rtdc"
+    path.write_bytes(b"b" * (PART_SIZE + 1000))
+    sha256 = hashlib.sha256(path.read_bytes()).hexdigest()
+    s3_util.upload_file(bucket_name=upload_bucket,
+                        object_name="resource/abc",
+                        path=path,
+                        sha256=sha256 if sha256_known else None,
+                        private=False,
+                        part_size=PART_SIZE)
+    head = s3_client.head_object(Bucket=upload_bucket, Key="resource/abc")
+    tags = get_tags(s3_client, upload_bucket, "resource/abc")
+    assert tags["public"] == "true"
+    assert tags["sha256"] == sha256
+    if sha256_known:
+        assert head["Metadata"]["sha256"] == sha256
+    else:
+        assert "sha256" not in head["Metadata"]
+    assert s3_util.get_object_sha256(upload_bucket, "resource/abc") == sha256
+
+    # existing objects are not uploaded again
+    path.write_bytes(b"c")
+    _, sha256_up = s3_util.upload_file(bucket_name=upload_bucket,
+                                       object_name="resource/abc",
+                                       path=path,
+                                       sha256="known")
+    assert sha256_up == "known"
+    assert s3_client.head_object(Bucket=upload_bucket, Key="resource/abc")[
+        "ContentLength"] == PART_SIZE + 1000
+
+
+@pytest.fixture
+def plain_object(s3_client, monkeypatch):
+    """Object without SHA256 sum; downloading it is an error"""
+    s3_client.create_bucket(Bucket="circle-verify")
+    s3_client.put_object(Bucket="circle-verify", Key="resource/abc",
+                         Body=b"data")
+
+    def compute_checksum(bucket_name, object_name, max_size=None):
+        raise AssertionError("object should not be downloaded")
+
+    monkeypatch.setattr(s3, "compute_checksum", compute_checksum)
+    return "circle-verify", "resource/abc"
+
+
+def test_verify_checksum_metadata(s3_client, plain_object):
+    bucket_name, _ = plain_object
+    sha256 = hashlib.sha256(b"meta").hexdigest()
+    s3_client.put_object(Bucket=bucket_name, Key="resource/meta",
+                         Body=b"meta", Metadata={"sha256": sha256})
+    assert s3_util.get_object_sha256(bucket_name, "resource/meta") == sha256
+    assert s3_util.verify_checksum(bucket_name, "resource/meta", sha256,
+                                   size=4)
+
+
+def test_verify_checksum_tag(s3_client, plain_object):
+    bucket_name, _ = plain_object
+    sha256 = hashlib.sha256(b"tag").hexdigest()
+    s3_client.put_object(Bucket=bucket_name, Key="resource/tag",
+                         Body=b"tag", Tagging=f"sha256={sha256}")
+    assert s3_util.get_object_sha256(bucket_name, "resource/tag") == sha256
+    assert s3_util.verify_checksum(bucket_name, "resource/tag", sha256)
+
+
+def test_verify_checksum_etag(plain_object):
+    bucket_name, object_name = plain_object
+    assert s3_util.get_object_sha256(bucket_name, object_name) is None
+    assert s3_util.verify_checksum(bucket_name, object_name,
+                                   sha256=hashlib.sha256(b"data").hexdigest(),
+                                   md5=hashlib.md5(b"data").hexdigest())
+
+
+def test_verify_checksum_size_or_missing(plain_object):
+    bucket_name, object_name = plain_object
+    sha256 = hashlib.sha256(b"data").hexdigest()
+    assert not s3_util.verify_checksum(bucket_name, object_name, sha256,
+                                       size=5)
+    assert not s3_util.verify_checksum(bucket_name, "resource/missing",
+                                       sha256)
+
+
+def test_verify_checksum_download(s3_client, plain_object, monkeypatch):
+    bucket_name, object_name = plain_object
+    sha256 = hashlib.sha256(b"data").hexdigest()
+    downloads = []
+
+    def compute_checksum(bucket_name, object_name, max_size=None):
+        downloads.append(object_name)
+        obj = s3_client.get_object(Bucket=bucket_name, Key=object_name)
+        return hashlib.sha256(obj["Body"].read()).hexdigest()
+
+    monkeypatch.setattr(s3, "compute_checksum", compute_checksum)
+    # wrong checksum
+    assert not s3_util.verify_checksum(bucket_name, object_name, "0" * 64)
+    assert "sha256" not in get_tags(s3_client, bucket_name, object_name)
+    # correct checksum (wrong MD5 sum forces the download)
+    assert s3_util.verify_checksum(bucket_name, object_name, sha256,
+                                   size=4, md5="0" * 32)
+    assert downloads == [object_name, object_name]
+    # the SHA256 sum is remembered as a tag
+    assert get_tags(s3_client, bucket_name, object_name)["sha256"] == sha256
+    assert s3_util.verify_checksum(bucket_name, object_name, sha256)
+    assert len(downloads) == 2
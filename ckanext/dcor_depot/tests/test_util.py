@@ -0,0 +1,113 @@
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+from ckanext.dcor_depot import util
+from ckanext.dcor_depot.util import (
+    ByteBudget, check_md5, hash_file, hash_files
+)
+
+
+def test_byte_budget_blocks():
+    budget = ByteBudget(100)
+    assert budget.acquire(60) == 60
+    acquired = threading.Event()
+
+    def worker():
+        budget.acquire(60)
+        acquired.set()
+
+    thr = threading.Thread(target=worker)
+    thr.start()
+    time.sleep(0.1)
+    # 120 bytes do not fit into the budget
+    assert not acquired.is_set()
+    budget.release(60)
+    thr.join(timeout=5)
+    assert acquired.is_set()
+    assert budget.in_flight == 60
+
+
+def test_byte_budget_oversized_and_unlimited():
+    budget = ByteBudget(100)
+    # items larger than the budget are admitted when nothing is in flight
+    assert budget.acquire(500) == 100
+    budget.release(100)
+    assert budget.in_flight == 0
+    # no limit
+    budget = ByteBudget(0)
+    assert budget.acquire(10**12) == 0
+    budget.release(0)
+    assert budget.in_flight == 0
+
+
+@pytest.mark.parametrize("size", [0, 1000, 5 * 2**16 + 3])
+def test_hash_file(tmp_path, size):
+    data = os.urandom(size)
+    path = tmp_path / "data.bin"
+    path.write_bytes(data)
+    # small block size to exercise the reader thread
+    hashers, num = hash_file(path, ["md5", "sha256"], block_size=2**16)
+    assert num == size
+    assert hashers["md5"].hexdigest() == hashlib.md5(data).hexdigest()
+    assert hashers["sha256"].hexdigest() == hashlib.sha256(data).hexdigest()
+    check_md5(path, hashlib.md5(data).hexdigest())
+    with pytest.raises(ValueError, match="MD5 sum mismatch"):
+        check_md5(path, "0" * 32)
+
+
+def test_hash_files(tmp_path):
+    paths = []
+    for ii in range(5):
+        path = tmp_path / f"data_{ii}.bin"
+        path.write_bytes(os.urandom(1000 * ii))
+        paths.append(path)
+    assert hash_files(paths, num_jobs=3) == [
+        hashlib.sha256(path.read_bytes()).hexdigest() for path in paths]
+
+
+def test_get_tmp_dir_stable_fallback(monkeypatch, tmp_path):
+    """Without `tmp_dir`, the same directory must be returned every time"""
+    monkeypatch.setattr(util, "get_ckan_config_option", lambda key: None)
+    monkeypatch.setattr(util.tempfile, "tempdir", str(tmp_path))
+    tmp_dir = util.get_tmp_dir()
+    assert tmp_dir == tmp_path / "ckanext-dcor_depot"
+    assert tmp_dir.is_dir()
+    assert util.get_tmp_dir() == tmp_dir
+    assert tmp_dir.stat().st_mode & 0o777 == 0o700
+
+
+def test_get_tmp_dir_fallback_permissions(monkeypatch, tmp_path):
+    monkeypatch.setattr(util, "get_ckan_config_option", lambda key: None)
+    monkeypatch.setattr(util.tempfile, "tempdir", str(tmp_path))
+    tmp_dir = tmp_path / "ckanext-dcor_depot"
+    tmp_dir.mkdir(mode=0o755)
+    tmp_dir.chmod(0o755)
+    # permissions that are too open are restricted
+    assert util.get_tmp_dir() == tmp_dir
+    assert tmp_dir.stat().st_mode & 0o777 == 0o700
+    # directories of other users are not used
+    uid = os.getuid()
+    monkeypatch.setattr(util.os, "getuid", lambda: uid + 1)
+    with pytest.raises(PermissionError, match="owned by the current user"):
+        util.get_tmp_dir()
+
+
+def test_get_tmp_dir_fallback_symlink(monkeypatch, tmp_path):
+    monkeypatch.setattr(util, "get_ckan_config_option", lambda key: None)
+    monkeypatch.setattr(util.tempfile, "tempdir", str(tmp_path))
+    (tmp_path / "elsewhere").mkdir()
+    (tmp_path / "ckanext-dcor_depot").symlink_to(tmp_path / "elsewhere")
+    with pytest.raises(PermissionError):
+        util.get_tmp_dir()
+
+
+def test_get_s3_object_name():
+    rid = "0123456789abcdef-0123456789abcdef0123"
+    assert util.get_s3_object_name(rid) == \
+        "resource/012/345/6789abcdef-0123456789abcdef0123"
+    assert util.get_s3_object_name(rid, "preview") == \
+        "preview/012/345/6789abcdef-0123456789abcdef0123"
@@ -1,20 +1,203 @@
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
+import os
 import pathlib
+import queue
+import stat
+import tempfile
+import threading
 
+from dcor_shared import get_ckan_config_option
 
-def check_md5(path, md5sum, block_size=2**20):
+
+#: Size of the blocks read by :func:`hash_file`
+HASH_BLOCK_SIZE = 8 * 1024**2
+
+
+class ByteBudget:
+    """Limit the number of bytes that are processed concurrently
+
+    :func:`acquire` blocks until `num_bytes` are available in the
+    budget of `max_bytes`. An item larger than the whole budget is
+    admitted when nothing else is in flight, so that it cannot block
+    forever. If `max_bytes` is 0, there is no limit.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, num_bytes):
+        """Reserve `num_bytes`; returns the number of bytes reserved"""
+        if not self.max_bytes:
+            return 0
+        num_bytes = min(num_bytes, self.max_bytes)
+        with self._cond:
+            while (self.in_flight
+                   and self.in_flight + num_bytes > self.max_bytes):
+                self._cond.wait()
+            self.in_flight += num_bytes
+        return num_bytes
+
+    def release(self, num_bytes):
+        """Release bytes previously reserved with :func:`acquire`"""
+        if not num_bytes:
+            return
+        with self._cond:
+            self.in_flight -= num_bytes
+            self._cond.notify_all()
+
+
+def check_md5(path, md5sum):
     """Check the MD5 sum of a file"""
-    file_hash = hashlib.md5()
-    with path.open("rb") as fd:
-        while True:
-            data = fd.read(block_size)
-            if not data:
-                break
-            file_hash.update(data)
-    if file_hash.hexdigest() != md5sum:
+    hashers, _ = hash_file(path, ["md5"])
+    if hashers["md5"].hexdigest() != md5sum:
         raise ValueError("MD5 sum mismatch for {}!".format(path))
 
 
+def get_s3_bucket_name(organization_id):
+    """Return the S3 bucket name for an organization
+
+    This is equivalent to `s3cc.get_s3_bucket_name_for_resource`, but
+    does not require a database lookup for the resource.
+    """
+    return get_ckan_config_option("dcor_object_store.bucket_name").format(
+        organization_id=organization_id)
+
+
+def get_s3_object_name(resource_id, artifact="resource"):
+    """Return the S3 object name of a resource artifact
+
+    This is the object name returned by
+    `s3cc.get_s3_bucket_object_for_artifact`, without the database
+    lookup for the bucket name.
+    """
+    rid = resource_id
+    return f"{artifact}/{rid[:3]}/{rid[3:6]}/{rid[6:]}"
+
+
+def get_tmp_dir():
+    """Return the temporary directory of the depot
+
+    This is `ckanext.dcor_depot.tmp_dir` if it is configured and if
+    it can be created. Otherwise, it is "ckanext-dcor_depot" in the
+    system temporary directory. The directory must be the same for
+    every call, because it holds the migration journal (`--resume`)
+    and the checksum, inventory, and figshare metadata caches.
+
+    Since the system temporary directory is shared with other users,
+    the fallback directory is created with mode 0o700 and a
+    PermissionError is raised if it is owned by another user.
+    """
+    tmp_dir = get_ckan_config_option("ckanext.dcor_depot.tmp_dir")
+    if tmp_dir:
+        # Make sure the directory exists and don't panic when we cannot
+        # create it.
+        try:
+            pathlib.Path(tmp_dir).mkdir(parents=True, exist_ok=True)
+        except BaseException:
+            tmp_dir = None
+    if not tmp_dir:
+        tmp_dir = pathlib.Path(tempfile.gettempdir()) / "ckanext-dcor_depot"
+        tmp_dir.mkdir(mode=0o700, exist_ok=True)
+        st = os.lstat(tmp_dir)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+            raise PermissionError(f"The temporary directory {tmp_dir} is "
+                                  f"not a directory owned by the current "
+                                  f"user; please set "
+                                  f"`ckanext.dcor_depot.tmp_dir`!")
+        if stat.S_IMODE(st.st_mode) != 0o700:
+            tmp_dir.chmod(0o700)
+    return pathlib.Path(tmp_dir)
+
+
+def hash_file(path, algorithms=("sha256",), block_size=HASH_BLOCK_SIZE):
+    """Hash a file with multiple algorithms in one pass
+
+    The file is read with `readinto` into two preallocated buffers of
+    `block_size` bytes. For files larger than one block, a reader
+    thread fills one buffer while the other one is hashed. Since
+    both, file reads and :mod:`hashlib` updates, release the GIL,
+    reading and hashing overlap and several files can be hashed in
+    parallel with :func:`hash_files`.
+
+    Returns a dictionary with the names in `algorithms` as keys and
+    the corresponding :mod:`hashlib` objects as values and the
+    number of bytes read.
+    """
+    hashers = {name: hashlib.new(name) for name in algorithms}
+    path = pathlib.Path(path)
+    size = 0
+    with path.open("rb", buffering=0) as fd:
+        file_size = os.fstat(fd.fileno()).st_size
+        if file_size <= block_size:
+            # small file, no need for a reader thread
+            buf = bytearray(max(file_size, 2**16))
+            view = memoryview(buf)
+            while num := fd.readinto(buf):
+                size += num
+                for hasher in hashers.values():
+                    hasher.update(view[:num])
+            return hashers, size
+
+        views = [memoryview(bytearray(block_size)) for _ in range(2)]
+        free = queue.Queue()
+        full = queue.Queue()
+        for ii in range(len(views)):
+            free.put(ii)
+        stop = threading.Event()
+
+        def read():
+            try:
+                while not stop.is_set():
+                    ii = free.get()
+                    if ii is None:
+                        break
+                    num = fd.readinto(views[ii])
+                    full.put((ii, num))
+                    if not num:
+                        break
+            except BaseException as e:
+                full.put((None, e))
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        try:
+            while True:
+                ii, num = full.get()
+                if ii is None:
+                    raise num
+                if not num:
+                    break
+                size += num
+                for hasher in hashers.values():
+                    hasher.update(views[ii][:num])
+                free.put(ii)
+        finally:
+            stop.set()
+            free.put(None)
+            reader.join()
+    return hashers, size
+
+
+def hash_files(paths, algorithm="sha256", num_jobs=4):
+    """Return the hex digests of multiple files hashed in parallel
+
+    The files are hashed with :func:`hash_file` in a pool of
+    `num_jobs` threads. The returned list has the same order as
+    `paths`.
+    """
+    def digest(path):
+        hashers, _ = hash_file(path, [algorithm])
+        return hashers[algorithm].hexdigest()
+
+    if num_jobs <= 1 or len(paths) <= 1:
+        return [digest(path) for path in paths]
+    with ThreadPoolExecutor(max_workers=num_jobs) as pool:
+        return list(pool.map(digest, paths))
+
+
 def make_id(data):
     """Return a CKAN identifier by md5-summing the data
 
@@ -44,3 +227,9 @@ def obj2str(obj):
     else:
         raise ValueError("No rule to convert object '{}' to string.".
                          format(obj.__class__))
+
+
+def sha256sum(path):
+    """Compute the SHA256 sum of a file with :func:`hash_file`"""
+    hashers, _ = hash_file(path, ["sha256"])
+    return hashers["sha256"].hexdigest()